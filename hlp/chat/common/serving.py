@@ -0,0 +1,390 @@
+import os
+import json
+import time
+import queue
+import threading
+import itertools
+import numpy as np
+import tensorflow as tf
+import multiprocessing as mp
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _chatter_models(chatter) -> list:
+    """
+    获取聊天器中需要提供服务的模型，transformer/smn为model，seq2seq为encoder和decoder
+    :param chatter: 聊天器实例
+    :return: 模型列表
+    """
+    return [getattr(chatter, name) for name in ("model", "encoder", "decoder") if hasattr(chatter, name)]
+
+
+def export_weights(models: list, weights_path: str):
+    """
+    将模型权重平铺写入一个float32的.npy文件，并在同名.json文件中记录每个权重的shape，
+    该文件供各worker进程以内存映射的方式只读加载，各worker从同一份页缓存读取，不必各自读取并反序列化检查点
+    :param models: 模型列表
+    :param weights_path: 权重文件保存路径
+    :return: 权重文件保存路径
+    """
+    if not os.path.exists(os.path.dirname(weights_path)):
+        os.makedirs(os.path.dirname(weights_path), exist_ok=True)
+
+    weights = [weight for model in models for weight in model.get_weights()]
+    shapes = [list(weight.shape) for weight in weights]
+    total_size = sum(weight.size for weight in weights)
+
+    # 先写入临时文件再重命名，防止worker读到写了一半的权重文件
+    temp_path = weights_path + ".tmp.npy"
+    flat_weights = np.lib.format.open_memmap(temp_path, mode="w+", dtype=np.float32, shape=(total_size,))
+    offset = 0
+    for weight in weights:
+        flat_weights[offset:offset + weight.size] = weight.ravel()
+        offset += weight.size
+    flat_weights.flush()
+    del flat_weights
+
+    with open(weights_path + ".json", "w", encoding="utf-8") as file:
+        json.dump(shapes, file)
+    os.replace(temp_path, weights_path)
+
+    return weights_path
+
+
+def load_weights(models: list, weights_path: str):
+    """
+    以内存映射的方式只读加载export_weights导出的权重，并设置到模型中
+    注意：set_weights会将权重复制到模型自身的TF变量中，因此每个加载的进程仍各持有一份权重内存
+    :param models: 模型列表，需与导出时的模型结构和顺序一致
+    :param weights_path: 权重文件路径
+    :return: 无返回值
+    """
+    with open(weights_path + ".json", "r", encoding="utf-8") as file:
+        shapes = json.load(file)
+    flat_weights = np.load(weights_path, mmap_mode="r")
+
+    weights = []
+    offset = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        weights.append(flat_weights[offset:offset + size].reshape(shape))
+        offset += size
+
+    for model in models:
+        num_weights = len(model.get_weights())
+        model.set_weights(weights[:num_weights])
+        weights = weights[num_weights:]
+
+
+def _worker_loop(worker_id: int, chatter_class: type, chatter_kwargs: dict, weights_path: str,
+                 request_queue: mp.Queue, response_queue: mp.Queue):
+    """
+    worker进程主循环，以serve模式构建聊天器(不读取检查点)并加载权重文件后，串行处理请求队列中的消息，
+    消息格式为(类型, 请求id, 内容)，类型有：respond-回复请求，reload-加载新权重，stop-退出
+    :param worker_id: worker编号
+    :param chatter_class: 聊天器类
+    :param chatter_kwargs: 聊天器初始化参数
+    :param weights_path: 权重文件路径
+    :param request_queue: 该worker的请求队列
+    :param response_queue: 所有worker共享的结果队列
+    :return: 无返回值
+    """
+    chatter = chatter_class(**chatter_kwargs)
+    models = _chatter_models(chatter)
+    load_weights(models, weights_path)
+    response_queue.put((worker_id, "ready", None, weights_path))
+
+    while True:
+        kind, request_id, payload = request_queue.get()
+        if kind == "stop":
+            break
+        try:
+            if kind == "respond":
+                result = chatter.respond(req=payload)
+            else:
+                load_weights(models, payload)
+                result = payload
+            response_queue.put((worker_id, kind, request_id, result))
+        except Exception as e:
+            response_queue.put((worker_id, "error", request_id, repr(e)))
+
+
+class ChatServer(object):
+    """
+    启动时以spawn方式创建多个worker进程的聊天服务，用于在多核机器上绕开GIL进行并发推断
+    - 只有主进程读取检查点，并将权重导出为一个权重文件，各worker以内存映射方式只读加载该文件
+    - 各worker加载权重时会复制到自身的TF变量中，因此权重内存仍为每个worker一份(TensorFlow运行时在fork之后
+      不可用，无法在加载后fork以共享内存)，共享的只是权重文件的页缓存及检查点的读取、反序列化
+    - 请求按各worker未完成的请求数进行负载均衡
+    - 健康检查不经过worker的请求队列：已退出、启动超时或最早的未完成请求超过request_timeout仍无进展的worker会被重启，
+      其未完成的请求会被重新分发，每个请求最多重新分发max_resubmits次，超过后返回错误，避免异常请求反复导致重启
+    - 检查点目录中出现新检查点时，逐个worker滚动加载新权重，服务不中断
+    """
+
+    def __init__(self, chatter_class: type, chatter_kwargs: dict, checkpoint_dir: str, num_workers: int = 4,
+                 health_check_interval: float = 5.0, request_timeout: float = 120.0, max_resubmits: int = 2,
+                 reload_check_interval: float = 60.0, startup_timeout: float = 300.0):
+        """
+        :param chatter_class: 聊天器类
+        :param chatter_kwargs: 聊天器初始化参数，execute_type需为serve，即只构建模型而不读取检查点
+        :param checkpoint_dir: 检查点保存目录路径
+        :param num_workers: worker进程数
+        :param health_check_interval: 健康检查间隔秒数
+        :param request_timeout: worker有未完成的请求且超过该秒数没有完成任何请求时视为不健康
+        :param max_resubmits: 每个请求因worker重启而重新分发的最多次数
+        :param reload_check_interval: 检查是否有新检查点的间隔秒数
+        :param startup_timeout: worker启动并加载完权重所允许的最长秒数
+        :return: 无返回值
+        """
+        self.chatter_class = chatter_class
+        self.chatter_kwargs = chatter_kwargs
+        self.checkpoint_dir = checkpoint_dir
+        self.serving_dir = os.path.join(checkpoint_dir, "serving")
+        self.num_workers = num_workers
+        self.health_check_interval = health_check_interval
+        self.request_timeout = request_timeout
+        self.max_resubmits = max_resubmits
+        self.reload_check_interval = reload_check_interval
+        self.startup_timeout = startup_timeout
+
+        # TensorFlow运行时在fork之后不可用，因此使用spawn方式启动worker
+        self.context = mp.get_context("spawn")
+        self.response_queue = self.context.Queue()
+        self.workers = {}
+        self.request_queues = {}
+        self.in_flight = {}
+        self.started = {}
+        self.last_progress = {}
+        self.ready = {}
+        self.pending = {}
+        self.resubmits = {}
+        self.reload_acks = {}
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count()
+        self.running = False
+
+        # 主进程持有一份模型，用于加载检查点并导出权重文件
+        self.latest_checkpoint = tf.train.latest_checkpoint(checkpoint_dir)
+        if self.latest_checkpoint is None:
+            raise ValueError("检查点目录 {} 中没有检查点，请先执行train模式".format(checkpoint_dir))
+        self.chatter = chatter_class(**chatter_kwargs)
+        self.weights_path = self._export(self.latest_checkpoint)
+
+    def _export(self, checkpoint_path: str):
+        """
+        恢复指定检查点并导出对应的内存映射权重文件
+        :param checkpoint_path: 检查点路径
+        :return: 权重文件路径
+        """
+        self.chatter.checkpoint.restore(checkpoint_path).expect_partial()
+        weights_path = os.path.join(self.serving_dir, os.path.basename(checkpoint_path) + ".npy")
+        return export_weights(_chatter_models(self.chatter), weights_path)
+
+    def _start_worker(self, worker_id: int):
+        """
+        启动指定编号的worker进程
+        :param worker_id: worker编号
+        :return: 无返回值
+        """
+        request_queue = self.context.Queue()
+        process = self.context.Process(target=_worker_loop, daemon=True,
+                                       args=(worker_id, self.chatter_class, self.chatter_kwargs,
+                                             self.weights_path, request_queue, self.response_queue))
+        process.start()
+        self.workers[worker_id] = process
+        self.request_queues[worker_id] = request_queue
+        self.in_flight[worker_id] = 0
+        self.started[worker_id] = time.time()
+        self.last_progress[worker_id] = time.time()
+        self.ready[worker_id] = False
+
+    def start(self):
+        """
+        启动所有worker以及结果分发、健康检查和检查点监控线程
+        :return: 无返回值
+        """
+        self.running = True
+        for worker_id in range(self.num_workers):
+            self._start_worker(worker_id)
+        for target in (self._dispatch_loop, self._health_check_loop, self._reload_loop):
+            threading.Thread(target=target, daemon=True).start()
+        print("聊天服务已启动，worker数量：{}，权重文件：{}".format(self.num_workers, self.weights_path))
+
+    def stop(self):
+        """
+        停止服务，通知所有worker在处理完已接收的请求后退出
+        :return: 无返回值
+        """
+        self.running = False
+        for request_queue in self.request_queues.values():
+            request_queue.put(("stop", None, None))
+        for process in self.workers.values():
+            process.join(timeout=self.request_timeout)
+
+    def _submit(self, request_id: int, req):
+        """
+        将请求分发给当前未完成请求数最少的worker
+        :param request_id: 请求id
+        :param req: 请求内容
+        :return: 无返回值
+        """
+        with self.lock:
+            worker_id = min(self.in_flight, key=self.in_flight.get)
+            self.in_flight[worker_id] += 1
+            future, _ = self.pending[request_id]
+            self.pending[request_id] = (future, (worker_id, req, time.time()))
+            self.request_queues[worker_id].put(("respond", request_id, req))
+
+    def respond(self, req, timeout: float = None):
+        """
+        对外部聊天请求进行回复，可被多个线程并发调用
+        :param req: 请求内容，与对应聊天器respond方法的输入一致
+        :param timeout: 等待回复的超时秒数
+        :return: 系统回复字符串
+        """
+        request_id = next(self.request_ids)
+        future = Future()
+        with self.lock:
+            self.pending[request_id] = (future, None)
+            self.resubmits[request_id] = 0
+        self._submit(request_id, req)
+        return future.result(timeout=timeout)
+
+    def _dispatch_loop(self):
+        """
+        从结果队列中取出worker返回的消息，完成对应的请求
+        """
+        while self.running:
+            try:
+                worker_id, kind, request_id, result = self.response_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            with self.lock:
+                self.last_progress[worker_id] = time.time()
+                if kind == "ready":
+                    self.ready[worker_id] = True
+                elif kind in ("respond", "error") and request_id in self.pending:
+                    future, _ = self.pending.pop(request_id)
+                    self.resubmits.pop(request_id, None)
+                    self.in_flight[worker_id] = max(self.in_flight[worker_id] - 1, 0)
+                    if kind == "respond":
+                        future.set_result(result)
+                    else:
+                        future.set_exception(RuntimeError("worker {} 处理请求出错：{}".format(worker_id, result)))
+                elif kind == "reload":
+                    self.reload_acks[worker_id] = result
+
+    def _is_healthy(self, worker_id: int, now: float):
+        """
+        判断worker是否健康，不向worker发送消息，因此不会排在其正在处理的请求之后：
+        进程需存活，启动后需在startup_timeout内加载完权重，
+        有未完成的请求时，距其最近一次完成请求(或最早的未完成请求分发时)不得超过request_timeout
+        :param worker_id: worker编号
+        :param now: 当前时间
+        :return: 是否健康
+        """
+        if not self.workers[worker_id].is_alive():
+            return False
+        if not self.ready[worker_id]:
+            return now - self.started[worker_id] < self.startup_timeout
+        submitted = [target[2] for _, target in self.pending.values() if target is not None and target[0] == worker_id]
+        if not submitted:
+            return True
+        return now - max(self.last_progress[worker_id], min(submitted)) < self.request_timeout
+
+    def _health_check_loop(self):
+        """
+        定时检查各worker，重启不健康的worker，并重新分发其未完成的请求，
+        重新分发次数超过max_resubmits的请求直接返回错误
+        """
+        while self.running:
+            time.sleep(self.health_check_interval)
+            for worker_id in list(self.workers):
+                with self.lock:
+                    if self._is_healthy(worker_id, time.time()):
+                        continue
+
+                    print("worker {} 不健康，正在重启...".format(worker_id))
+                    self.workers[worker_id].terminate()
+                    lost = []
+                    for request_id, (future, target) in list(self.pending.items()):
+                        if target is None or target[0] != worker_id:
+                            continue
+                        self.resubmits[request_id] += 1
+                        if self.resubmits[request_id] > self.max_resubmits:
+                            self.pending.pop(request_id)
+                            self.resubmits.pop(request_id)
+                            future.set_exception(RuntimeError("请求已重新分发{}次仍未完成，放弃该请求"
+                                                              .format(self.max_resubmits)))
+                        else:
+                            lost.append((request_id, target[1]))
+                    self._start_worker(worker_id)
+                for request_id, req in lost:
+                    self._submit(request_id, req)
+
+    def _reload_loop(self):
+        """
+        监控检查点目录，发现新检查点后导出新权重文件，并逐个worker滚动加载，
+        reload消息排在已接收的请求之后处理，因此不会丢弃任何请求
+        """
+        while self.running:
+            time.sleep(self.reload_check_interval)
+            latest_checkpoint = tf.train.latest_checkpoint(self.checkpoint_dir)
+            if latest_checkpoint is None or latest_checkpoint == self.latest_checkpoint:
+                continue
+
+            print("发现新检查点：{}，开始滚动加载...".format(latest_checkpoint))
+            old_weights_path = self.weights_path
+            self.weights_path = self._export(latest_checkpoint)
+            self.latest_checkpoint = latest_checkpoint
+            for worker_id in list(self.workers):
+                self.request_queues[worker_id].put(("reload", None, self.weights_path))
+                deadline = time.time() + self.request_timeout
+                while self.reload_acks.get(worker_id) != self.weights_path and time.time() < deadline:
+                    time.sleep(0.1)
+
+            # 各worker已映射新文件，旧文件删除后已有映射仍然有效
+            if old_weights_path != self.weights_path:
+                for path in (old_weights_path, old_weights_path + ".json"):
+                    if os.path.exists(path):
+                        os.remove(path)
+            print("检查点加载完毕")
+
+
+def serve_http(server: ChatServer, host: str = "0.0.0.0", port: int = 8000):
+    """
+    以HTTP方式对外提供聊天服务，POST的json格式为{"req": 请求内容}，返回{"response": 回复}，
+    GET /health 返回各worker的存活状态
+    :param server: 已启动的ChatServer
+    :param host: 监听地址
+    :param port: 监听端口
+    :return: 无返回值
+    """
+
+    class _Handler(BaseHTTPRequestHandler):
+        def _reply(self, code: int, body: dict):
+            content = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path != "/health":
+                self._reply(404, {"error": "not found"})
+                return
+            workers = {worker_id: process.is_alive() for worker_id, process in server.workers.items()}
+            self._reply(200 if all(workers.values()) else 503,
+                        {"workers": workers, "checkpoint": server.latest_checkpoint})
+
+        def do_POST(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+                self._reply(200, {"response": server.respond(body["req"])})
+            except Exception as e:
+                self._reply(500, {"error": repr(e)})
+
+    print("HTTP服务监听于 {}:{}".format(host, port))
+    ThreadingHTTPServer((host, port), _Handler).serve_forever()
@@ -11,6 +11,7 @@ import hlp.chat.common.pre_treat as pre_treat
 import hlp.chat.model.seq2seq as seq2seq
 from chat.chatter import Chatter
 from hlp.chat.common.utils import log_operator
+from hlp.chat.common.serving import ChatServer, serve_http
 
 
 class Seq2SeqChatter(Chatter):
@@ -60,19 +61,23 @@ class Seq2SeqChatter(Chatter):
         self.loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
         self.checkpoint = tf.train.Checkpoint(optimizer=self.optimizer, encoder=self.encoder, decoder=self.decoder)
 
-        if execute_type == "chat":
+        if execute_type in ("chat", "serve"):
             print('正在从{}中加载字典...'.format(dict_fn))
             self.token = data_utils.load_token_dict(dict_fn=dict_fn)
-        print('正在检查是否存在检查点...')
-        if self.ckpt:
-            print('存在检查点，正在从{}中加载检查点...'.format(checkpoint_dir))
-            self.checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir)).expect_partial()
+        if execute_type == "serve":
+            # serve模式下模型权重由服务主进程导出的权重文件提供，不读取检查点
+            print('serve模式，跳过检查点加载...')
         else:
-            if execute_type == "train":
-                print('不存在检查点，从头开始训练...')
+            print('正在检查是否存在检查点...')
+            if self.ckpt:
+                print('存在检查点，正在从{}中加载检查点...'.format(checkpoint_dir))
+                self.checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir)).expect_partial()
             else:
-                print('不存在检查点，请先执行train模式，再进入chat模式')
-                exit(0)
+                if execute_type == "train":
+                    print('不存在检查点，从头开始训练...')
+                else:
+                    print('不存在检查点，请先执行train模式，再进入chat模式')
+                    exit(0)
 
         log_operator(level=10).info("启动SMN聊天器，执行类别为：{}，模型参数配置为：vocab_size：{}，"
                                     "embedding_dim：{}，units：{}，max_length：{}".format(execute_type, vocab_size,
@@ -184,6 +189,9 @@ def main():
     parser.add_argument('--epochs', default=5, type=int, required=False, help='训练步数')
     parser.add_argument('--start_sign', default='start', type=str, required=False, help='序列开始标记')
     parser.add_argument('--end_sign', default='end', type=str, required=False, help='序列结束标记')
+    parser.add_argument('--num_workers', default=4, type=int, required=False, help='serve模式下的worker进程数')
+    parser.add_argument('--host', default='0.0.0.0', type=str, required=False, help='serve模式下的监听地址')
+    parser.add_argument('--port', default=8000, type=int, required=False, help='serve模式下的监听端口')
 
     options = parser.parse_args().__dict__
     if options['config_file'] != '':
@@ -229,6 +237,19 @@ def main():
                 exit(0)
             response = chatter.respond(req=req)
             print("Agent: ", response)
+    elif execute_type == 'serve':
+        chatter_kwargs = dict(execute_type='serve', checkpoint_dir=work_path + options['checkpoint'],
+                              beam_size=options['beam_size'], units=options['units'],
+                              embedding_dim=options['embedding_dim'], batch_size=options['batch_size'],
+                              start_sign=options['start_sign'], end_sign=options['end_sign'],
+                              vocab_size=options['vocab_size'], dict_fn=work_path + options['dict_file'],
+                              max_length=options['max_length'], encoder_layers=options['encoder_layers'],
+                              decoder_layers=options['decoder_layers'], cell_type='lstm',
+                              if_bidirectional=True)
+        server = ChatServer(chatter_class=Seq2SeqChatter, chatter_kwargs=chatter_kwargs,
+                            checkpoint_dir=work_path + options['checkpoint'], num_workers=options['num_workers'])
+        server.start()
+        serve_http(server, host=options['host'], port=options['port'])
     elif execute_type == 'pre_treat':
         print("对语料进行处理...")
         pre_treat.preprocess_datasets(dataset_name="lccc",
@@ -245,9 +266,10 @@ if __name__ == "__main__":
     """
     Seq2Seq入口：指令需要附带运行参数
     cmd：python seq2seq2_chatter.py --type [执行模式]
-    执行类别：pre_treat/train/chat，默认为pre_treat
+    执行类别：pre_treat/train/chat/serve，默认为pre_treat
     其他参数参见main方法
 
     chat模式下运行时，输入ESC即退出对话
+    serve模式下启动多进程HTTP聊天服务
     """
     main()
@@ -9,6 +9,7 @@ sys.path.append(os.path.abspath(__file__)[:os.path.abspath(__file__).rfind("\\hl
 import hlp.chat.model.smn as smn
 import hlp.chat.common.utils as utils
 import hlp.chat.common.data_utils as data_utils
+from hlp.chat.common.serving import ChatServer, serve_http
 
 
 class SMNChatter():
@@ -18,7 +19,8 @@ class SMNChatter():
 
     def __init__(self, units: int, vocab_size: int, execute_type: str, dict_fn: str,
                  embedding_dim: int, checkpoint_dir: int, max_utterance: int, max_sentence: int,
-                 learning_rate: float, database_fn: str, solr_server: str):
+                 learning_rate: float, database_fn: str, solr_server: str,
+                 recall_size: int = 300, rank_size: int = 10):
         """
         SMN聊天器初始化，用于加载模型
         :param units: 单元数
@@ -31,6 +33,9 @@ class SMNChatter():
         :param max_sentence: 单个句子最大长度
         :param learning_rate: 学习率
         :param database_fn: 候选数据库路径
+        :param solr_server: solr服务地址
+        :param recall_size: 第一阶段从solr召回的候选数量
+        :param rank_size: 经过粗排后送入SMN精排的候选数量
         :return: 无返回值
         """
         self.dict_fn = dict_fn
@@ -38,6 +43,8 @@ class SMNChatter():
         self.max_utterance = max_utterance
         self.max_sentence = max_sentence
         self.database_fn = database_fn
+        self.recall_size = recall_size
+        self.rank_size = rank_size
         self.optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
         self.solr = pysolr.Solr(url=solr_server, always_commit=True, timeout=10)
         self.train_loss = tf.keras.metrics.Mean()
@@ -53,25 +60,30 @@ class SMNChatter():
         if not ckpt:
             os.makedirs(checkpoint_dir)
 
-        if execute_type == "chat":
+        if execute_type in ("chat", "serve"):
             print('正在从“{}”处加载字典...'.format(self.dict_fn))
             self.token = data_utils.load_token_dict(dict_fn=self.dict_fn)
-        print('正在检查是否存在检查点...')
-        if ckpt:
-            print('存在检查点，正在从“{}”中加载检查点...'.format(checkpoint_dir))
-            self.checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir)).expect_partial()
+        if execute_type == "serve":
+            # serve模式下模型权重由服务主进程导出的权重文件提供，不读取检查点
+            print('serve模式，跳过检查点加载...')
         else:
-            if execute_type == "train":
-                print('不存在检查点，正在train模式...')
+            print('正在检查是否存在检查点...')
+            if ckpt:
+                print('存在检查点，正在从“{}”中加载检查点...'.format(checkpoint_dir))
+                self.checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir)).expect_partial()
             else:
-                print('不存在检查点，请先执行train模式，再进入chat模式')
-                exit(0)
-
-        logger = utils.log_operator(level=10)
-        logger.info("启动SMN聊天器，执行类别为：{}，模型参数配置为：embedding_dim：{}，"
+                if execute_type == "train":
+                    print('不存在检查点，正在train模式...')
+                else:
+                    print('不存在检查点，请先执行train模式，再进入chat模式')
+                    exit(0)
+
+        self.logger = utils.log_operator(level=10)
+        self.logger.info("启动SMN聊天器，执行类别为：{}，模型参数配置为：embedding_dim：{}，"
                     "max_sentence：{}，max_utterance：{}，units：{}，vocab_size：{}，"
-                    "learning_rate：{}".format(execute_type, embedding_dim, max_sentence,
-                                              max_utterance, units, vocab_size, learning_rate))
+                    "learning_rate：{}，recall_size：{}，rank_size：{}".format(execute_type, embedding_dim, max_sentence,
+                                                                         max_utterance, units, vocab_size,
+                                                                         learning_rate, recall_size, rank_size))
 
     def train(self, epochs: int, data_fn: str, batch_size: int, buffer_size: int,
               max_train_data_size: int = 0, max_valid_data_size: int = 0):
@@ -167,11 +179,13 @@ class SMNChatter():
 
     def respond(self, req: str):
         """
-        对外部聊天请求进行回复
-        子类需要利用模型进行推断和搜索以产生回复。
+        对外部聊天请求进行回复，采用两阶段级联检索：
+        先从solr召回recall_size个候选，使用SMN嵌入层的池化向量点积进行粗
+        排，再将得分最高的rank_size个候选送入完整的SMN模型进行精排
         :param req: 输入的语句
         :return: 系统回复字符串
         """
+        start_time = time.time()
         self.solr.ping()
         history = req[-self.max_utterance:]
         pad_sequences = [0] * self.max_sentence
@@ -189,23 +203,70 @@ class SMNChatter():
         for key in tf_idf:
             query += "product(idf(utterance," + key + "),tf(utterance," + key + ")),"
         query += ")"
-        candidates = self.solr.search(q=query, start=0, rows=10).docs
+        candidates = self.solr.search(q=query, start=0, rows=self.recall_size).docs
         candidates = [candidate['utterance'][0] for candidate in candidates]
+        recall_num = len(candidates)
+        recall_time = time.time()
 
-        if candidates is None:
+        if not candidates:
             return "Sorry! I didn't hear clearly, can you say it again?"
         else:
-            utterances = [utterance] * len(candidates)
             responses = data_utils.dict_texts_to_sequences(candidates, self.token)
             responses = tf.keras.preprocessing.sequence.pad_sequences(responses, maxlen=self.max_sentence,
                                                                       padding="post")
-            utterances = tf.convert_to_tensor(utterances)
+            utterance = tf.convert_to_tensor(utterance)
             responses = tf.convert_to_tensor(responses)
+
+            # 粗排：使用轻量的双塔打分筛选出rank_size个候选
+            if len(candidates) > self.rank_size:
+                indices = self._coarse_rank(utterance, responses)
+                candidates = [candidates[index] for index in indices.numpy()]
+                responses = tf.gather(responses, indices)
+            coarse_time = time.time()
+
+            # 精排：完整的SMN匹配
+            utterances = tf.tile(tf.expand_dims(utterance, axis=0), [len(candidates), 1, 1])
             scores = self.model(inputs=[utterances, responses])
             index = tf.argmax(scores[:, 0])
+            rank_time = time.time()
+
+            self.logger.info("SMN级联检索耗时：召回({}个候选)：{:.4f}s，粗排：{:.4f}s，精排({}个候选)：{:.4f}s，"
+                             "总计：{:.4f}s".format(recall_num, recall_time - start_time, coarse_time - recall_time,
+                                                   len(candidates), rank_time - coarse_time, rank_time - start_time))
 
             return candidates[index]
 
+    def _coarse_rank(self, utterance: tf.Tensor, responses: tf.Tensor):
+        """
+        级联检索的第一阶段打分，复用SMN的嵌入层，对上下文和候选回复分别
+        做去除padding的平均池化，以两者的点积作为分数，返回分数最高的rank_size个候选下标
+        :param utterance: 编码后的上下文，shape为(max_utterance, max_sentence)
+        :param responses: 编码后的候选回复，shape为(num_candidates, max_sentence)
+        :return: 粗排保留的候选下标
+        """
+        embedding = self.model.get_layer("encoder")
+
+        utterance = tf.reshape(utterance, [1, -1])
+        context_vector = self._masked_mean_pooling(embedding(utterance), utterance)
+        response_vectors = self._masked_mean_pooling(embedding(responses), responses)
+
+        scores = tf.squeeze(tf.matmul(response_vectors, context_vector, transpose_b=True), axis=-1)
+        _, indices = tf.math.top_k(scores, k=self.rank_size)
+        return indices
+
+    @staticmethod
+    def _masked_mean_pooling(embeddings: tf.Tensor, sequences: tf.Tensor):
+        """
+        对嵌入向量在非padding位置上求平均
+        :param embeddings: 嵌入向量，shape为(batch_size, seq_len, embedding_dim)
+        :param sequences: 对应的编码序列，shape为(batch_size, seq_len)
+        :return: 池化后的向量，shape为(batch_size, embedding_dim)
+        """
+        mask = tf.cast(tf.math.not_equal(sequences, 0), dtype=embeddings.dtype)
+        summed = tf.reduce_sum(embeddings * tf.expand_dims(mask, axis=-1), axis=1)
+        counts = tf.maximum(tf.reduce_sum(mask, axis=1, keepdims=True), 1.0)
+        return summed / counts
+
     def _metrics_rn_1(self, scores: float, labels: tf.Tensor, num: int = 10):
         """
         计算Rn@k指标
@@ -238,6 +299,8 @@ def main():
     parser.add_argument('--max_valid_data_size', default=100, type=int, required=False, help='用于验证的最大数据大小')
     parser.add_argument('--learning_rate', default=0.001, type=float, required=False, help='学习率')
     parser.add_argument('--max_database_size', default=0, type=int, required=False, help='最大数据候选数量')
+    parser.add_argument('--recall_size', default=300, type=int, required=False, help='级联检索中solr召回的候选数量')
+    parser.add_argument('--rank_size', default=10, type=int, required=False, help='级联检索中送入SMN精排的候选数量')
     parser.add_argument('--dict_file', default='\\data\\smn_dict_fn.json', type=str, required=False, help='字典路径')
     parser.add_argument('--checkpoint', default='\\checkpoints\\smn', type=str, required=False, help='检查点路径')
     parser.add_argument('--tokenized_train', default='\\data\\ubuntu_train.txt', type=str, required=False,
@@ -251,6 +314,9 @@ def main():
     parser.add_argument('--epochs', default=5, type=int, required=False, help='训练步数')
     parser.add_argument('--batch_size', default=32, type=int, required=False, help='batch大小')
     parser.add_argument('--buffer_size', default=20000, type=int, required=False, help='Dataset加载缓冲大小')
+    parser.add_argument('--num_workers', default=4, type=int, required=False, help='serve模式下的worker进程数')
+    parser.add_argument('--host', default='0.0.0.0', type=str, required=False, help='serve模式下的监听地址')
+    parser.add_argument('--port', default=8000, type=int, required=False, help='serve模式下的监听端口')
 
     options = parser.parse_args().__dict__
     if options['config_file'] != '':
@@ -296,7 +362,8 @@ def main():
                              solr_server=options['solr_server'], learning_rate=options['learning_rate'],
                              embedding_dim=options['embedding_dim'], checkpoint_dir=work_path + options['checkpoint'],
                              max_utterance=options['max_utterance'], max_sentence=options['max_sentence'],
-                             database_fn=work_path + options['candidate_database'])
+                             database_fn=work_path + options['candidate_database'],
+                             recall_size=options['recall_size'], rank_size=options['rank_size'])
         history = []  # 用于存放历史对话
         print("Agent: 你好！结束聊天请输入ESC。")
         while True:
@@ -307,6 +374,18 @@ def main():
             history.append(req)
             response = chatter.respond(req=history)
             print("Agent: ", response)
+    elif execute_type == 'serve':
+        chatter_kwargs = dict(units=options['units'], vocab_size=options['vocab_size'],
+                              execute_type='serve', dict_fn=work_path + options['dict_file'],
+                              solr_server=options['solr_server'], learning_rate=options['learning_rate'],
+                              embedding_dim=options['embedding_dim'], checkpoint_dir=work_path + options['checkpoint'],
+                              max_utterance=options['max_utterance'], max_sentence=options['max_sentence'],
+                              database_fn=work_path + options['candidate_database'],
+                              recall_size=options['recall_size'], rank_size=options['rank_size'])
+        server = ChatServer(chatter_class=SMNChatter, chatter_kwargs=chatter_kwargs,
+                            checkpoint_dir=work_path + options['checkpoint'], num_workers=options['num_workers'])
+        server.start()
+        serve_http(server, host=options['host'], port=options['port'])
     else:
         parser.error(msg='')
 
@@ -315,9 +394,10 @@ if __name__ == '__main__':
     """
     SMN入口：指令需要附带运行参数
     cmd：python smn_chatter.py --act [执行模式]
-    执行类别：pre_treat/train/evaluate/chat，默认为pre_treat
+    执行类别：pre_treat/train/evaluate/chat/serve，默认为pre_treat
     其他参数参见main方法
 
     chat模式下运行时，输入ESC即退出对话
+    serve模式下启动多进程HTTP聊天服务，请求体为{"req": [历史语句列表]}
     """
     main()
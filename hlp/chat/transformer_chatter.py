@@ -9,6 +9,7 @@ import hlp.chat.common.pre_treat as pre_treat
 import hlp.chat.common.data_utils as data_utils
 import hlp.chat.model.transformer as transformer
 from hlp.chat.chatter import Chatter
+from hlp.chat.common.serving import ChatServer, serve_http
 from hlp.chat.common.utils import log_operator
 
 
@@ -59,19 +60,23 @@ class TransformerChatter(Chatter):
 
         self.checkpoint = tf.train.Checkpoint(transformer=self.model, optimizer=self.optimizer)
 
-        if execute_type == "chat":
+        if execute_type in ("chat", "serve"):
             print('正在从“{}”处加载字典...'.format(dict_fn))
             self.token = data_utils.load_token_dict(dict_fn=dict_fn)
-        print('正在检查是否存在检查点...')
-        if self.ckpt:
-            print('存在检查点，正在从“{}”中加载检查点...'.format(checkpoint_dir))
-            self.checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir)).expect_partial()
+        if execute_type == "serve":
+            # serve模式下模型权重由服务主进程导出的权重文件提供，不读取检查点
+            print('serve模式，跳过检查点加载...')
         else:
-            if execute_type == "train":
-                print('不存在检查点，正在train模式...')
+            print('正在检查是否存在检查点...')
+            if self.ckpt:
+                print('存在检查点，正在从“{}”中加载检查点...'.format(checkpoint_dir))
+                self.checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir)).expect_partial()
             else:
-                print('不存在检查点，请先执行train模式，再进入chat模式')
-                exit(0)
+                if execute_type == "train":
+                    print('不存在检查点，正在train模式...')
+                else:
+                    print('不存在检查点，请先执行train模式，再进入chat模式')
+                    exit(0)
 
         log_operator(level=10).info("启动SMN聊天器，执行类别为：{}，模型参数配置为：num_layers：{}，"
                                     "d_model：{}，num_heads：{}，units：{}，dropout：{}，vocab_size：{}，"
@@ -154,6 +159,9 @@ def main():
     parser.add_argument('--epochs', default=5, type=int, required=False, help='训练步数')
     parser.add_argument('--start_sign', default='start', type=str, required=False, help='序列开始标记')
     parser.add_argument('--end_sign', default='end', type=str, required=False, help='序列结束标记')
+    parser.add_argument('--num_workers', default=4, type=int, required=False, help='serve模式下的worker进程数')
+    parser.add_argument('--host', default='0.0.0.0', type=str, required=False, help='serve模式下的监听地址')
+    parser.add_argument('--port', default=8000, type=int, required=False, help='serve模式下的监听端口')
 
     options = parser.parse_args().__dict__
     if options['config_file'] != '':
@@ -201,6 +209,18 @@ def main():
                 exit(0)
             response = chatter.respond(req=req)
             print("Agent: ", response)
+    elif execute_type == 'serve':
+        chatter_kwargs = dict(execute_type='serve', checkpoint_dir=work_path + options['checkpoint'],
+                              num_layers=options['num_layers'], units=options['units'],
+                              d_model=options['d_model'], num_heads=options['num_heads'],
+                              dropout=options['dropout'], beam_size=options['beam_size'],
+                              start_sign=options['start_sign'], end_sign=options['end_sign'],
+                              vocab_size=options['vocab_size'], dict_fn=work_path + options['dict_file'],
+                              max_length=options['max_length'])
+        server = ChatServer(chatter_class=TransformerChatter, chatter_kwargs=chatter_kwargs,
+                            checkpoint_dir=work_path + options['checkpoint'], num_workers=options['num_workers'])
+        server.start()
+        serve_http(server, host=options['host'], port=options['port'])
     elif execute_type == 'pre_treat':
         pre_treat.preprocess_datasets(dataset_name="lccc", raw_data_path=work_path + options['resource_data'],
                                       tokenized_data_path=work_path + options['tokenized_data'],
@@ -215,9 +235,10 @@ if __name__ == "__main__":
     """
     Transformer入口：指令需要附带运行参数
     cmd：python transformer_chatter.py --act [执行模式]
-    执行类别：pre_treat/train/chat，默认为pre_treat
+    执行类别：pre_treat/train/chat/serve，默认为pre_treat
     其他参数参见main方法
 
     chat模式下运行时，输入ESC即退出对话
+    serve模式下启动多进程HTTP聊天服务
     """
     main()
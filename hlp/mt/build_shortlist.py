@@ -0,0 +1,118 @@
+"""
+构建词表候选集使用的词汇翻译表
+1. 由已编码的训练语料统计源语言与目标语言token的共现，为每个源语言token保留Dice系数最高的若干目标语言token
+2. 在验证文本上对比使用与不使用候选集时的BLEU、翻译速度及平均候选集大小
+"""
+import time
+from argparse import ArgumentParser
+
+import numpy
+
+from hlp.mt.config import get_config as _config
+from hlp.mt.model import nmt_model
+from hlp.mt.common import bleu as _bleu
+from hlp.mt.common import encoded_corpus
+from hlp.mt.common import load_dataset
+from hlp.mt.common import shortlist as _shortlist
+from hlp.mt import preprocess
+from hlp.mt import translator
+
+
+def build(top_k=_config.shortlist_top_k, num_frequent=_config.shortlist_frequent,
+          output_path=_config.lexical_table_path):
+    """
+    由已编码的训练语料构建并保存词汇翻译表
+    @param top_k: 每个源语言token保留的目标语言token数量
+    @param num_frequent: 总是加入候选集的高频目标语言token数量
+    @param output_path: 保存路径
+    @return: 词汇翻译表
+    """
+    source_path = preprocess.get_encoded_sequences_path(_config.source_lang, postfix='_train')
+    target_path = preprocess.get_encoded_sequences_path(_config.target_lang, postfix='_train')
+    if not encoded_corpus.exists(source_path):
+        raise ValueError("未找到已编码的训练语料，请先运行preprocess.py")
+    _, vocab_size_source, _, vocab_size_target = nmt_model._load_tokenizers()
+
+    start = time.time()
+    lexical_table = _shortlist.build_lexical_table(source_path, target_path, vocab_size_source, vocab_size_target,
+                                                   top_k=top_k, num_frequent=num_frequent)
+    _shortlist.save(output_path, lexical_table)
+    print('词汇翻译表已保存至：%s，用时%.2fs' % (output_path, time.time() - start))
+    return lexical_table
+
+
+def report(lexical_table, num_eval=_config.num_eval, batch_size=_config.BATCH_SIZE,
+           beam_size=_config.BEAM_SIZE, ema=False):
+    """
+    在验证文本上对比使用与不使用候选集的翻译结果
+    @param lexical_table: 词汇翻译表
+    @param num_eval: 用于对比的句子数量
+    @param batch_size: 批量翻译的batch大小
+    @param beam_size: beam大小
+    @param ema: 是否使用指数滑动平均权重
+    @return: 各设置的结果字典列表
+    """
+    models, tokenizer_source, tokenizer_target = nmt_model.load_translate_models(ema=ema)
+    source_sentences, target_sentences = load_dataset.load_sentences(_config.path_to_eval_file, num_eval)
+    references = [[sentence.strip()] for sentence in target_sentences]
+
+    # 统计平均候选集大小
+    start_token, end_token = translator._get_special_tokens(tokenizer_target)
+    sequences, lengths = translator._encode_sources(source_sentences, tokenizer_source)
+    order = numpy.argsort(lengths, kind='stable')
+    num_candidates = []
+    for i in range(0, len(order), batch_size):
+        num_candidates.append(len(_shortlist.select(lexical_table, sequences[order[i:i + batch_size]],
+                                                    (start_token, end_token))))
+
+    results = []
+    for name, table in (('全部词表', None), ('候选集', lexical_table)):
+        # 预热，排除首次执行的开销
+        translator.translate(source_sentences[0], models, tokenizer_source, tokenizer_target,
+                             beam_size=beam_size, lexical_table=table)
+        start = time.time()
+        candidates = translator.translate_batch(source_sentences, models, tokenizer_source, tokenizer_target,
+                                                batch_size=batch_size, beam_size=beam_size, verbose=False,
+                                                lexical_table=table)
+        speed = len(source_sentences) / (time.time() - start)
+        results.append({'name': name, 'bleu': _bleu.corpus_bleu(candidates, references, _config.target_lang),
+                        'speed': speed, 'candidates': candidates})
+
+    full, shortlisted = results
+    num_same = sum(a == b for a, b in zip(full['candidates'], shortlisted['candidates']))
+    print('-' * 20)
+    print('目标语言词表大小：%d，平均候选集大小：%.1f'
+          % (models[0].final_layer.units, sum(num_candidates) / len(num_candidates)))
+    print('%-8s%10s%12s' % ('设置', 'BLEU', '句/s'))
+    for result in results:
+        print('%-8s%10.2f%12.2f' % (result['name'], result['bleu'], result['speed']))
+    print('候选集相对全部词表：速度%.2f倍，BLEU变化%+.2f，翻译结果一致的句子：%d/%d'
+          % (shortlisted['speed'] / full['speed'], shortlisted['bleu'] - full['bleu'],
+             num_same, len(source_sentences)))
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='构建词表候选集使用的词汇翻译表，并对比使用候选集前后的BLEU及速度')
+    parser.add_argument('--top_k', default=_config.shortlist_top_k, type=int, required=False,
+                        help='每个源语言token保留的目标语言token数量')
+    parser.add_argument('--num_frequent', default=_config.shortlist_frequent, type=int, required=False,
+                        help='总是加入候选集的高频目标语言token数量')
+    parser.add_argument('--output', default=_config.lexical_table_path, type=str, required=False,
+                        help='词汇翻译表保存路径')
+    parser.add_argument('--report', action='store_true', help='构建后在验证文本上对比BLEU及速度')
+    parser.add_argument('--num_eval', default=_config.num_eval, type=int, required=False, help='用于对比的句子数量')
+    parser.add_argument('--beam_size', default=_config.BEAM_SIZE, type=int, required=False, help='对比时的beam大小')
+    parser.add_argument('--ema', action='store_true', help='对比时使用指数滑动平均权重')
+    options = parser.parse_args()
+
+    lexical_table = build(top_k=options.top_k, num_frequent=options.num_frequent, output_path=options.output)
+    if options.report:
+        if not nmt_model.check_point():
+            print('没有发现训练好的模型，请先训练模型.')
+            return
+        report(lexical_table, num_eval=options.num_eval, beam_size=options.beam_size, ema=options.ema)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,8 @@ import numpy
 from hlp.mt.config import get_config as _config
 from hlp.mt.model import nmt_model, checkpoint
 from hlp.mt.model import transformer as _transformer
+from hlp.mt.common import encoded_corpus
+from hlp.mt import preprocess
 
 
 def _model_build(model, inp, tar):
@@ -16,10 +18,11 @@ def _model_build(model, inp, tar):
 
 def _get_sample_dataset():
     """从保存的文件中读取样例数据进行模型build"""
-    input_path = _config.encoded_sequences_path_prefix + _config.source_lang
-    target_path = _config.encoded_sequences_path_prefix + _config.target_lang
-    input_tensor = tf.cast(numpy.loadtxt(input_path, dtype='int32', max_rows=_config.BATCH_SIZE), tf.int32)
-    target_tensor = tf.cast(numpy.loadtxt(target_path, dtype='int32', max_rows=_config.BATCH_SIZE), tf.int32)
+    input_path = preprocess.get_encoded_sequences_path(_config.source_lang, postfix='_train')
+    target_path = preprocess.get_encoded_sequences_path(_config.target_lang, postfix='_train')
+    indices = numpy.arange(_config.BATCH_SIZE)
+    input_tensor = tf.constant(encoded_corpus.gather(*encoded_corpus.load(input_path), indices))
+    target_tensor = tf.constant(encoded_corpus.gather(*encoded_corpus.load(target_path), indices))
     return input_tensor, target_tensor
 
 
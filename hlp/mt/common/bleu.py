@@ -1,5 +1,18 @@
 import re
+from collections import Counter
+
 import nltk
+import numpy
+
+
+def tokenize(sentence, language):
+    """按bleu_nltk的方式对句子进行分词，中文按字切分，英文在?.!,前添加空格后按空格切分"""
+    if language == "zh":
+        return [w for w in sentence]
+    elif language == "en":
+        sentence = re.sub(r'([?.!,])', r' \1', sentence)  # 在?.!,前添加空格
+        sentence = re.sub(r'[" "]+', " ", sentence)  # 合并连续的空格
+        return sentence.split(' ')
 
 
 def bleu_nltk(candidate_sentence, reference_sentences, language):
@@ -10,21 +23,8 @@ def bleu_nltk(candidate_sentence, reference_sentences, language):
 
     """
     # 根据所选择的语言对句子进行预处理
-    if language == "zh":
-        candidate_sentence = [w for w in candidate_sentence]
-        reference_sentences_sum = []
-        for sentence in reference_sentences:
-            reference_sentences_sum.append([w for w in sentence])
-    elif language == "en":
-        candidate_sentence = re.sub(r'([?.!,])', r' \1', candidate_sentence)  # 在?.!,前添加空格
-        candidate_sentence = re.sub(r'[" "]+', " ", candidate_sentence)  # 合并连续的空格
-        candidate_sentence = candidate_sentence.split(' ')
-        reference_sentences_sum = []
-        for sentence in reference_sentences:
-            sentence = re.sub(r'([?.!,])', r' \1', sentence)  # 在?.!,前添加空格
-            sentence = re.sub(r'[" "]+', " ", sentence)  # 合并连续的空格
-            sentence = sentence.split(' ')
-            reference_sentences_sum.append(sentence)
+    candidate_sentence = tokenize(candidate_sentence, language)
+    reference_sentences_sum = [tokenize(sentence, language) for sentence in reference_sentences]
 
     smooth_function = nltk.translate.bleu_score.SmoothingFunction()
     score = nltk.translate.bleu_score.sentence_bleu(reference_sentences_sum,
@@ -33,6 +33,89 @@ def bleu_nltk(candidate_sentence, reference_sentences, language):
     return score * 100
 
 
+def _ngram_counts(tokens, max_order):
+    """统计句子中1至max_order阶的n-gram数量"""
+    return Counter(tuple(tokens[i:i + n]) for n in range(1, max_order + 1) for i in range(len(tokens) - n + 1))
+
+
+def sentence_statistics(candidate_sentence, reference_sentences, language, max_order=4):
+    """
+    计算单个句子用于语料级BLEU的统计量，每个句子只分词一次
+    :param candidate_sentence:机翻句子
+    :param reference_sentences:参考句子列表
+    :param language:句子的语言
+    :param max_order:最大n-gram阶数
+    :return:统计量数组 (2 * max_order + 2,)，依次为各阶截断匹配数、各阶n-gram总数、机翻句子长度、最接近的参考句子长度
+    """
+    candidate = tokenize(candidate_sentence, language)
+    references = [tokenize(sentence, language) for sentence in reference_sentences]
+
+    candidate_counts = _ngram_counts(candidate, max_order)
+    max_reference_counts = Counter()
+    for reference in references:
+        max_reference_counts |= _ngram_counts(reference, max_order)
+    clipped_counts = candidate_counts & max_reference_counts
+
+    statistics = numpy.zeros(2 * max_order + 2, dtype='int64')
+    for ngram, count in clipped_counts.items():
+        statistics[len(ngram) - 1] += count
+    for n in range(1, max_order + 1):
+        # 与nltk一致，n-gram总数至少计为1
+        statistics[max_order + n - 1] = max(len(candidate) - n + 1, 1)
+    statistics[-2] = len(candidate)
+    # 与nltk的corpus_bleu一致，取长度最接近的参考句子，距离相同时取较短者
+    statistics[-1] = min((len(reference) for reference in references),
+                         key=lambda length: (abs(length - len(candidate)), length))
+    return statistics
+
+
+def corpus_statistics(candidate_sentences, reference_sentences, language, max_order=4):
+    """
+    计算一批句子的语料级BLEU统计量之和
+    :param candidate_sentences:机翻句子列表
+    :param reference_sentences:与机翻句子一一对应的参考句子列表的列表
+    :param language:句子的语言
+    :param max_order:最大n-gram阶数
+    """
+    statistics = numpy.zeros(2 * max_order + 2, dtype='int64')
+    for candidate_sentence, references in zip(candidate_sentences, reference_sentences):
+        statistics += sentence_statistics(candidate_sentence, references, language, max_order)
+    return statistics
+
+
+def bleu_from_statistics(statistics, max_order=4):
+    """
+    由累加的n-gram统计量计算语料级BLEU，各阶精确率在整个语料上汇总后再取几何平均
+    :param statistics:corpus_statistics得到的统计量
+    :param max_order:最大n-gram阶数
+    :return:BLEU(0~100)
+    """
+    matches = statistics[:max_order].astype('float64')
+    totals = statistics[max_order:2 * max_order].astype('float64')
+    candidate_length, reference_length = statistics[-2], statistics[-1]
+    if candidate_length == 0 or matches[0] == 0:
+        return 0.0
+
+    # 与bleu_nltk一致使用method1平滑，匹配数为0的阶以0.1代替
+    precisions = numpy.where(matches > 0, matches, 0.1) / totals
+    brevity_penalty = 1.0 if candidate_length > reference_length \
+        else numpy.exp(1 - reference_length / candidate_length)
+    return float(brevity_penalty * numpy.exp(numpy.mean(numpy.log(precisions))) * 100)
+
+
+def corpus_bleu(candidate_sentences, reference_sentences, language, max_order=4):
+    """
+    语料级BLEU
+    :param candidate_sentences:机翻句子列表
+    :param reference_sentences:与机翻句子一一对应的参考句子列表的列表
+    :param language:句子的语言
+    :param max_order:最大n-gram阶数
+    :return:BLEU(0~100)
+    """
+    return bleu_from_statistics(corpus_statistics(candidate_sentences, reference_sentences, language, max_order),
+                                max_order)
+
+
 def main():
     # 测试语句
     candidate_sentence_zh = '今天的天气真好啊。'
@@ -46,6 +129,11 @@ def main():
     score = bleu_nltk(candidate_sentence_en, [reference_sentence_en], language='en')
     print('NLTK_BLEU:%.2f' % score)
 
+    # 测试语料级BLEU
+    score = corpus_bleu([candidate_sentence_en, candidate_sentence_en], [[reference_sentence_en], [candidate_sentence_en]],
+                        language='en')
+    print('CORPUS_BLEU:%.2f' % score)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,149 @@
+"""
+BPE(SubwordTextEncoder)字典的编译编码器
+将字典中的子词预先编译为前缀树，以最长前缀匹配代替逐长度查表切分子词，
+词到子词编码的结果缓存在有界的LRU中，并支持批量编码及使用进程池编码大规模语料
+编码结果与SubwordTextEncoder.encode一致
+"""
+import sys
+import weakref
+import multiprocessing as mp
+from collections import OrderedDict
+
+_END = ''  # 前缀树中标记子词结束的键，子词均非空故不会与字符冲突
+_encoders = weakref.WeakKeyDictionary()
+_worker_encoder = None
+
+
+class BPEEncoder(object):
+    """
+    编译后的BPE编码器
+    """
+
+    def __init__(self, tokenizer, cache_size=2 ** 16):
+        """
+        @param tokenizer: tfds的SubwordTextEncoder字典
+        @param cache_size: 词到编码结果的LRU缓存大小
+        """
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+        # 文本切分及token预处理沿用字典所在模块的实现，保证与其encode一致
+        encoder_module = sys.modules[type(tokenizer).__module__]
+        self._prepare_tokens = encoder_module._prepare_tokens_for_encode
+        self._underscore_replacement = encoder_module._UNDERSCORE_REPLACEMENT
+
+        # 编译前缀树，子词的内部编号从0开始，encode的最终结果整体加1以空出填充用的0
+        # 与字典一致，子词最长只匹配字典中最长子词的长度
+        self._max_subword_length = max(len(subword) for subword in tokenizer.subwords)
+        self._trie = {}
+        for subword_id, subword in enumerate(tokenizer.subwords):
+            self._insert(subword, subword_id)
+        self._insert(self._underscore_replacement, len(tokenizer.subwords) + ord('_'))
+
+        self.hits = 0
+        self.misses = 0
+
+        self._fallback = False
+        if not self._verify():
+            print('BPE编码器与字典的编码结果不一致，将直接使用字典编码')
+            self._fallback = True
+
+    def __getstate__(self):
+        # 传给子进程时不携带缓存
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
+
+    def _insert(self, subword, subword_id):
+        node = self._trie
+        for char in subword:
+            node = node.setdefault(char, {})
+        node[_END] = subword_id
+
+    def _verify(self):
+        """使用部分子词及保留词拼成的句子检查编码结果是否与字典一致"""
+        probe = ' '.join(subword.rstrip('_') for subword in self.tokenizer.subwords[:50]) + ' hello, World! 123_'
+        return self.encode(probe) == list(self.tokenizer.encode(probe))
+
+    def _token_to_ids(self, token):
+        """在前缀树中对token从左到右做最长前缀匹配，无匹配的字符按字节编码"""
+        ids = []
+        start = 0
+        while start < len(token):
+            node = self._trie
+            match_end, match_id = start, None
+            for position in range(start, min(len(token), start + self._max_subword_length)):
+                node = node.get(token[position])
+                if node is None:
+                    break
+                if _END in node:
+                    match_end, match_id = position + 1, node[_END]
+            if match_id is None:
+                ids.extend(self.tokenizer._byte_encode(token[start]))
+                start += 1
+            else:
+                ids.append(match_id)
+                start = match_end
+        return ids
+
+    def _cached_token_to_ids(self, token):
+        ids = self._cache.get(token)
+        if ids is not None:
+            self._cache.move_to_end(token)
+            self.hits += 1
+            return ids
+        self.misses += 1
+        ids = self.tokenizer._token_to_ids(token) if self._fallback else self._token_to_ids(token)
+        self._cache[token] = ids
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return ids
+
+    def encode(self, sentence):
+        """
+        对一个句子进行编码
+        @param sentence: 句子
+        @return: 编码后的id列表
+        """
+        if isinstance(sentence, bytes):
+            sentence = sentence.decode('utf-8')
+        tokens = self._prepare_tokens(self.tokenizer._tokenizer.tokenize(sentence))
+        ids = []
+        for token in tokens:
+            ids.extend(self._cached_token_to_ids(token))
+        return [i + 1 for i in ids]
+
+    def encode_batch(self, sentences, num_processes=1, chunk_size=10000):
+        """
+        对句子列表进行批量编码
+        @param sentences: 句子列表
+        @param num_processes: 进程数，大于1时使用进程池分块编码，适用于语料预处理
+        @param chunk_size: 使用进程池时每块的句子数量
+        @return: 编码后的id列表的列表，与输入顺序一致
+        """
+        if num_processes <= 1 or len(sentences) <= chunk_size:
+            return [self.encode(sentence) for sentence in sentences]
+
+        chunks = [sentences[i:i + chunk_size] for i in range(0, len(sentences), chunk_size)]
+        with mp.get_context('spawn').Pool(num_processes, initializer=_init_worker, initargs=(self,)) as pool:
+            results = pool.map(_encode_chunk, chunks)
+        return [sequence for chunk in results for sequence in chunk]
+
+
+def _init_worker(encoder):
+    global _worker_encoder
+    _worker_encoder = encoder
+
+
+def _encode_chunk(sentences):
+    return [_worker_encoder.encode(sentence) for sentence in sentences]
+
+
+def get_encoder(tokenizer):
+    """获取字典对应的编码器，每个字典只编译一次"""
+    encoder = _encoders.get(tokenizer)
+    if encoder is None:
+        encoder = BPEEncoder(tokenizer)
+        _encoders[tokenizer] = encoder
+    return encoder
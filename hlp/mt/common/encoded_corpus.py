@@ -0,0 +1,123 @@
+"""
+已编码语料的二进制存储格式
+所有句子的token不经填充地首尾相接保存为一个int32数组，另以offsets数组记录每个句子的起止位置，
+第i个句子即tokens[offsets[i]:offsets[i + 1]]，两个数组均可内存映射读取，按下标取句子为O(1)
+"""
+import os
+import shutil
+
+import numpy
+
+
+def _tokens_path(path):
+    return path + '.tokens.npy'
+
+
+def _offsets_path(path):
+    return path + '.offsets.npy'
+
+
+def exists(path):
+    """检查指定路径的已编码语料是否存在"""
+    return os.path.exists(_tokens_path(path)) and os.path.exists(_offsets_path(path))
+
+
+def save(path, sequences):
+    """
+    保存已编码的句子
+    @param path: 保存路径(前缀)
+    @param sequences: 已编码的句子列表，每个句子为token id列表，不需要填充
+    @return: 最大句子长度
+    """
+    lengths = numpy.fromiter((len(sequence) for sequence in sequences), dtype='int64', count=len(sequences))
+    offsets = numpy.zeros(len(sequences) + 1, dtype='int64')
+    numpy.cumsum(lengths, out=offsets[1:])
+    tokens = numpy.fromiter((token for sequence in sequences for token in sequence), dtype='int32',
+                            count=int(offsets[-1]))
+
+    numpy.save(_tokens_path(path), tokens)
+    numpy.save(_offsets_path(path), offsets)
+    return int(lengths.max()) if len(lengths) > 0 else 0
+
+
+def copy(source_path, target_path):
+    """复制已编码的语料"""
+    shutil.copyfile(_tokens_path(source_path), _tokens_path(target_path))
+    shutil.copyfile(_offsets_path(source_path), _offsets_path(target_path))
+
+
+def concatenate(paths, path):
+    """
+    将多个已编码语料按顺序首尾相接合并为一个，逐个分片写入，不需要将全部语料读入内存
+    @param paths: 按顺序排列的已编码语料路径列表
+    @param path: 合并后的保存路径
+    @return: 最大句子长度
+    """
+    corpora = [load(corpus_path) for corpus_path in paths]
+    num_tokens = sum(len(tokens) for tokens, _ in corpora)
+    num_sentences_sum = sum(num_sentences(offsets) for _, offsets in corpora)
+    merged_tokens = numpy.lib.format.open_memmap(_tokens_path(path), mode='w+', dtype='int32', shape=(num_tokens,))
+    merged_offsets = numpy.zeros(num_sentences_sum + 1, dtype='int64')
+
+    token_start, sentence_start = 0, 0
+    max_length = 0
+    for tokens, offsets in corpora:
+        merged_tokens[token_start:token_start + len(tokens)] = tokens
+        merged_offsets[sentence_start + 1:sentence_start + len(offsets)] = offsets[1:] + token_start
+        token_start += len(tokens)
+        sentence_start += num_sentences(offsets)
+        if len(offsets) > 1:
+            max_length = max(max_length, int(lengths(offsets).max()))
+    merged_tokens.flush()
+    del merged_tokens
+    numpy.save(_offsets_path(path), merged_offsets)
+    return max_length
+
+
+def remove(path):
+    """删除已编码的语料"""
+    os.remove(_tokens_path(path))
+    os.remove(_offsets_path(path))
+
+
+def load(path, mmap=True):
+    """
+    加载已编码的句子
+    @param path: 保存路径(前缀)
+    @param mmap: 是否以内存映射方式读取，为False时一次性读入内存
+    @return: tokens (num_tokens,)，offsets (num_sentences + 1,)
+    """
+    mmap_mode = 'r' if mmap else None
+    tokens = numpy.load(_tokens_path(path), mmap_mode=mmap_mode)
+    offsets = numpy.load(_offsets_path(path), mmap_mode=mmap_mode)
+    return tokens, offsets
+
+
+def num_sentences(offsets):
+    """语料中的句子数量"""
+    return len(offsets) - 1
+
+
+def lengths(offsets):
+    """各句子的长度"""
+    return numpy.diff(offsets)
+
+
+def gather(tokens, offsets, indices, max_length=None):
+    """
+    取出指定下标的句子并填充至其中的最大长度
+    @param tokens: 语料的tokens数组
+    @param offsets: 语料的offsets数组
+    @param indices: 句子下标
+    @param max_length: 截断长度，为None时不截断
+    @return: 填充后的句子 (len(indices), batch_max_length)，dtype为int32
+    """
+    indices = numpy.asarray(indices, dtype='int64')  # 空列表默认为float类型，不能作为下标
+    starts = offsets[indices]
+    ends = offsets[indices + 1]
+    if max_length is not None:
+        ends = numpy.minimum(ends, starts + max_length)
+    batch = numpy.zeros((len(starts), int((ends - starts).max()) if len(starts) > 0 else 0), dtype='int32')
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        batch[i, :end - start] = tokens[start:end]
+    return batch
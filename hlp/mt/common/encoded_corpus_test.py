@@ -0,0 +1,119 @@
+import os
+import tempfile
+
+import numpy
+
+from hlp.mt.common import encoded_corpus
+
+_SEQUENCES = [[1, 5, 7, 2], [1, 2], [1, 9, 8, 6, 4, 2], [1, 3, 2]]
+
+
+def test_save_load():
+    """保存后以内存映射及一次性读入两种方式加载，tokens首尾相接，offsets记录各句子起止位置"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'corpus')
+        assert not encoded_corpus.exists(path)
+        assert encoded_corpus.save(path, _SEQUENCES) == 6
+        assert encoded_corpus.exists(path)
+        for mmap in (True, False):
+            tokens, offsets = encoded_corpus.load(path, mmap=mmap)
+            assert isinstance(tokens, numpy.memmap) == mmap
+            assert tokens.dtype == numpy.int32
+            assert tokens.tolist() == [token for sequence in _SEQUENCES for token in sequence]
+            assert offsets.tolist() == [0, 4, 6, 12, 15]
+            assert encoded_corpus.num_sentences(offsets) == 4
+            assert encoded_corpus.lengths(offsets).tolist() == [4, 2, 6, 3]
+            for i, sequence in enumerate(_SEQUENCES):
+                assert tokens[offsets[i]:offsets[i + 1]].tolist() == sequence
+            del tokens, offsets  # 释放内存映射后才能删除文件
+        encoded_corpus.remove(path)
+        assert not encoded_corpus.exists(path)
+
+
+def test_gather():
+    """按下标取出句子并以0填充至batch内最大长度，下标可以乱序及重复"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'corpus')
+        encoded_corpus.save(path, _SEQUENCES)
+        tokens, offsets = encoded_corpus.load(path)
+        batch = encoded_corpus.gather(tokens, offsets, numpy.array([3, 1, 3]))
+        assert batch.dtype == numpy.int32
+        assert batch.tolist() == [[1, 3, 2], [1, 2, 0], [1, 3, 2]]
+        batch = encoded_corpus.gather(tokens, offsets, [2, 0])
+        assert batch.tolist() == [[1, 9, 8, 6, 4, 2], [1, 5, 7, 2, 0, 0]]
+        del tokens, offsets
+
+
+def test_gather_max_length():
+    """超过max_length的句子被截断，batch宽度为截断后的最大长度"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'corpus')
+        encoded_corpus.save(path, _SEQUENCES)
+        tokens, offsets = encoded_corpus.load(path)
+        batch = encoded_corpus.gather(tokens, offsets, [2, 1, 0], max_length=3)
+        assert batch.tolist() == [[1, 9, 8], [1, 2, 0], [1, 5, 7]]
+        # 所有句子都不超过max_length时与不截断相同
+        batch = encoded_corpus.gather(tokens, offsets, [1, 3], max_length=10)
+        assert batch.tolist() == [[1, 2, 0], [1, 3, 2]]
+        del tokens, offsets
+
+
+def test_empty_corpus():
+    """空语料可以保存及加载，最大长度为0，取空下标得到shape为(0, 0)的batch"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'empty')
+        assert encoded_corpus.save(path, []) == 0
+        tokens, offsets = encoded_corpus.load(path)
+        assert len(tokens) == 0
+        assert offsets.tolist() == [0]
+        assert encoded_corpus.num_sentences(offsets) == 0
+        assert len(encoded_corpus.lengths(offsets)) == 0
+        assert encoded_corpus.gather(tokens, offsets, []).shape == (0, 0)
+        del tokens, offsets
+
+
+def test_empty_sentence():
+    """长度为0的句子占一个offsets位置，取出时为全填充的一行"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'corpus')
+        assert encoded_corpus.save(path, [[1, 2], [], [3]]) == 2
+        tokens, offsets = encoded_corpus.load(path)
+        assert encoded_corpus.lengths(offsets).tolist() == [2, 0, 1]
+        assert encoded_corpus.gather(tokens, offsets, [1, 2]).tolist() == [[0], [3]]
+        del tokens, offsets
+
+
+def test_concatenate():
+    """按顺序合并多个分片，与一次性保存全部句子的结果相同，空分片不影响结果"""
+    with tempfile.TemporaryDirectory() as directory:
+        shards = [_SEQUENCES[:1], [], _SEQUENCES[1:]]
+        paths = [os.path.join(directory, 'shard%d' % i) for i in range(len(shards))]
+        for path, shard in zip(paths, shards):
+            encoded_corpus.save(path, shard)
+        merged_path = os.path.join(directory, 'merged')
+        assert encoded_corpus.concatenate(paths, merged_path) == 6
+
+        expected_path = os.path.join(directory, 'expected')
+        encoded_corpus.save(expected_path, _SEQUENCES)
+        tokens, offsets = encoded_corpus.load(merged_path)
+        expected_tokens, expected_offsets = encoded_corpus.load(expected_path)
+        assert tokens.dtype == expected_tokens.dtype and offsets.dtype == expected_offsets.dtype
+        assert tokens.tolist() == expected_tokens.tolist()
+        assert offsets.tolist() == expected_offsets.tolist()
+        del tokens, offsets, expected_tokens, expected_offsets
+
+        # 全部分片均为空时得到空语料
+        empty_path = os.path.join(directory, 'merged_empty')
+        assert encoded_corpus.concatenate(paths[1:2], empty_path) == 0
+        tokens, offsets = encoded_corpus.load(empty_path)
+        assert len(tokens) == 0 and offsets.tolist() == [0]
+        del tokens, offsets
+
+
+if __name__ == '__main__':
+    test_save_load()
+    test_gather()
+    test_gather_max_length()
+    test_empty_corpus()
+    test_empty_sentence()
+    test_concatenate()
@@ -1,7 +1,8 @@
 import numpy
-from sklearn.model_selection import train_test_split
 import tensorflow as tf
+
 from hlp.mt.config import get_config as _config
+from hlp.mt.common import encoded_corpus
 
 
 def load_single_sentences(path, num_sentences, column):
@@ -34,57 +35,134 @@ def load_sentences(path, num_sentences, reverse=_config.reverse):
         return source_sentences, target_sentences
 
 
-def _generate_batch_from_ram(input_path, target_path, train_size=_config.train_size):
-    """从内存中产生训练和验证批数据
+class DatasetState(tf.Module):
+    """
+    训练集的迭代状态，随检查点一起保存，使中断的训练可从中断时的batch继续
+    seed决定训练集与验证集的划分及各epoch的打乱顺序(第i个epoch的随机数生成器由(seed, i)确定)，
+    epoch为本次训练已完成的epoch数，batch为当前epoch中已训练的batch数
     """
-    input_tensor = numpy.loadtxt(input_path, dtype='int32')
-    target_tensor = numpy.loadtxt(target_path, dtype='int32')
-    x_train, x_test, y_train, y_test = train_test_split(input_tensor, target_tensor, train_size=train_size)
 
-    train_dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train))
-    train_dataset = train_dataset.shuffle(_config.BUFFER_SIZE).batch(_config.BATCH_SIZE, drop_remainder=True)
+    def __init__(self, seed=None):
+        """
+        @param seed: 随机数种子，为None时随机生成，从检查点恢复时被检查点中的值覆盖
+        """
+        super(DatasetState, self).__init__()
+        if seed is None:
+            seed = numpy.random.randint(2 ** 31 - 1)
+        self.seed = tf.Variable(seed, trainable=False, dtype=tf.int64)
+        self.epoch = tf.Variable(0, trainable=False, dtype=tf.int64)
+        self.batch = tf.Variable(0, trainable=False, dtype=tf.int64)
 
-    val_dataset = tf.data.Dataset.from_tensor_slices((x_test, y_test))
-    val_dataset = val_dataset.shuffle(_config.BUFFER_SIZE).batch(_config.BATCH_SIZE, drop_remainder=True)
+    def split_rng(self):
+        """划分训练集与验证集使用的随机数生成器"""
+        return numpy.random.RandomState(int(self.seed.numpy()))
 
-    return train_dataset, val_dataset
+    def epoch_rng(self):
+        """打乱当前epoch使用的随机数生成器，同一epoch重新迭代时得到相同的顺序"""
+        return numpy.random.RandomState([int(self.seed.numpy()), int(self.epoch.numpy())])
 
+    def next_epoch(self):
+        """当前epoch训练完毕"""
+        self.epoch.assign_add(1)
+        self.batch.assign(0)
+
+    def reset(self):
+        """本次训练完毕，再次训练时从第一个epoch开始"""
+        self.epoch.assign(0)
+        self.batch.assign(0)
 
-def _generate_batch_from_file(input_path, target_path, num_steps, start_step, batch_size):
-    """
-    从编码文件中分batch读入数据集
-    自动从配置文件设置确定input_path、target_path
-    num_steps：整个训练集的step数，即数据集中包含多少个batch
-    start_step:从哪个step开始读batch
-    batch_size:batch大小
-
-    return:input_tensor shape=(batch_size, sentence_length), dtype=tf.int32
-           , target_tensor shape=(batch_size, sentence_length), dtype=tf.int32
-    """
 
-    step = int(start_step)
-    while step < num_steps:
-        # TODO: 这个效率有问题
-        input_tensor = numpy.loadtxt(input_path, dtype='int32', skiprows=0 + step * batch_size, max_rows=batch_size)
-        target_tensor = numpy.loadtxt(target_path, dtype='int32', skiprows=0 + step * batch_size, max_rows=batch_size)
-        step += 1
-        yield tf.cast(input_tensor, tf.int32), tf.cast(target_tensor, tf.int32)
+def _fixed_size_batches(indices, batch_size):
+    """按固定句子数量划分batch，丢弃不足一个batch的部分"""
+    return [indices[start:start + batch_size] for start in range(0, len(indices) - batch_size + 1, batch_size)]
 
 
-def get_dataset(input_path, target_path, cache, train_size, steps=None):
+def _token_budget_batches(indices, source_lengths, target_lengths, max_tokens):
+    """
+    将长度相近的句子分为一组，每个batch填充后的源语言与目标语言token总数不超过max_tokens
+    单个句子对超过max_tokens时独自成为一个batch
+
+    @param indices: 使用的句子下标，长度相同的句子保持其在indices中的顺序
+    @param source_lengths: 各源语言句子长度
+    @param target_lengths: 各目标语言句子长度
+    @param max_tokens: 每个batch的最大token数
+    @return: batch下标列表
+    """
+    order = indices[numpy.argsort(source_lengths[indices] + target_lengths[indices], kind='stable')]
+    batches = []
+    batch = []
+    max_source_length, max_target_length = 0, 0
+    for index in order:
+        new_source_length = max(max_source_length, source_lengths[index])
+        new_target_length = max(max_target_length, target_lengths[index])
+        if batch and (len(batch) + 1) * (new_source_length + new_target_length) > max_tokens:
+            batches.append(numpy.asarray(batch))
+            batch = []
+            new_source_length, new_target_length = source_lengths[index], target_lengths[index]
+        batch.append(index)
+        max_source_length, max_target_length = new_source_length, new_target_length
+    if batch:
+        batches.append(numpy.asarray(batch))
+    return batches
+
+
+def _generate_batches(source_corpus, target_corpus, indices, batch_size, shuffle, max_tokens=0, state=None):
+    """
+    按句子下标从已编码语料中分batch取出数据，每个batch只填充至其中的最大句子长度
+    每次迭代(即每个epoch)重新打乱下标及batch顺序，给出state时打乱顺序由其当前epoch确定，
+    并跳过当前epoch中已训练的batch(只跳过下标，不读取数据)
+
+    @param source_corpus: 源语言语料(tokens, offsets)
+    @param target_corpus: 目标语言语料(tokens, offsets)
+    @param indices: 使用的句子下标
+    @param batch_size: batch大小，max_tokens为0时使用
+    @param shuffle: 是否打乱顺序
+    @param max_tokens: 每个batch的最大源语言与目标语言token总数，为0时按batch_size划分batch
+    @param state: 训练集迭代状态DatasetState，为None时使用numpy的全局随机数生成器且不跳过batch
+    """
+    source_lengths = encoded_corpus.lengths(source_corpus[1])
+    target_lengths = encoded_corpus.lengths(target_corpus[1])
+
+    def generator():
+        rng = state.epoch_rng() if state is not None else numpy.random
+        order = rng.permutation(indices) if shuffle else indices
+        if max_tokens > 0:
+            batches = _token_budget_batches(order, source_lengths, target_lengths, max_tokens)
+            if shuffle:
+                rng.shuffle(batches)
+        else:
+            batches = _fixed_size_batches(order, batch_size)
+        skip = int(state.batch.numpy()) if state is not None else 0
+        for batch_indices in batches[skip:]:
+            yield encoded_corpus.gather(*source_corpus, batch_indices), \
+                encoded_corpus.gather(*target_corpus, batch_indices)
+
+    return tf.data.Dataset.from_generator(generator, output_types=(tf.int32, tf.int32),
+                                          output_shapes=(tf.TensorShape([None, None]), tf.TensorShape([None, None]))) \
+        .prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def get_dataset(input_path, target_path, cache, train_size, max_tokens=_config.max_batch_tokens, state=None):
     """从指定的路径中获取数据集
+    已编码语料以二进制格式不填充地保存，按batch取出时再动态填充
 
     @param input_path: 输入已编码文本路径
     @param target_path: 目标已编码文本路径
-    @param cache: 是否一次性加载入内存，即是采用generator
+    @param cache: 是否一次性加载入内存，为False时使用内存映射读取
     @param train_size: 训练集比例
-    @param steps: 训练集文本共含多少个batch,cache为 False时可为None
+    @param max_tokens: 每个batch的最大token数，为0时每个batch固定BATCH_SIZE个句子
+    @param state: 训练集迭代状态DatasetState，给出时由其种子划分数据集及打乱训练集，可从中断的batch继续迭代
+    @return: 训练集，验证集
     """
-    if cache:
-        train_dataset, val_dataset = _generate_batch_from_ram(input_path, target_path, train_size)
-    else:
-        train_dataset = _generate_batch_from_file(input_path, target_path, steps * train_size, 0, _config.BATCH_SIZE)
-        val_dataset = _generate_batch_from_file(input_path, target_path, steps, steps * train_size, _config.BATCH_SIZE)
+    source_corpus = encoded_corpus.load(input_path, mmap=not cache)
+    target_corpus = encoded_corpus.load(target_path, mmap=not cache)
+
+    rng = state.split_rng() if state is not None else numpy.random
+    indices = rng.permutation(encoded_corpus.num_sentences(source_corpus[1]))
+    num_train = int(len(indices) * train_size)
+    train_indices, val_indices = indices[:num_train], indices[num_train:]
+    train_dataset = _generate_batches(source_corpus, target_corpus, train_indices, _config.BATCH_SIZE,
+                                      shuffle=True, max_tokens=max_tokens, state=state)
+    val_dataset = _generate_batches(source_corpus, target_corpus, numpy.sort(val_indices), _config.BATCH_SIZE,
+                                    shuffle=False, max_tokens=max_tokens)
     return train_dataset, val_dataset
-
-
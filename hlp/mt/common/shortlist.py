@@ -0,0 +1,100 @@
+"""
+推断时的目标语言词表候选集(shortlist)
+由已编码的训练语料统计源语言token与目标语言token在句子对中的共现，以Dice系数为每个源语言token
+保留最可能的若干个目标语言token作为词汇翻译表；解码时每个batch只以其源句子token的候选、
+最高频的目标语言token及特殊token组成候选集，输出层只计算候选集中token的logits
+"""
+import os
+
+import numpy
+from scipy import sparse
+
+from hlp.mt.common import encoded_corpus
+
+
+def _incidence_matrix(tokens, offsets, start, end, vocab_size):
+    """句子与token的0/1关联矩阵 (end - start, vocab_size)，一个token在句子中出现多次只记一次"""
+    sentence_offsets = offsets[start:end + 1]
+    row_ids = numpy.repeat(numpy.arange(end - start), numpy.diff(sentence_offsets))
+    matrix = sparse.csr_matrix((numpy.ones(len(row_ids), dtype='float32'),
+                                (row_ids, tokens[sentence_offsets[0]:sentence_offsets[-1]])),
+                               shape=(end - start, vocab_size))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
+
+
+def build_lexical_table(source_path, target_path, vocab_size_source, vocab_size_target,
+                        top_k=50, num_frequent=500, chunk_size=100000):
+    """
+    由已编码的训练语料构建词汇翻译表
+    @param source_path: 已编码源语言语料路径
+    @param target_path: 已编码目标语言语料路径
+    @param vocab_size_source: 源语言字典大小
+    @param vocab_size_target: 目标语言字典大小
+    @param top_k: 每个源语言token保留的目标语言token数量
+    @param num_frequent: 总是加入候选集的高频目标语言token数量
+    @param chunk_size: 每次统计的句子对数量
+    @return: 词汇翻译表字典，table为 (vocab_size_source + 1, top_k)，第i行为源语言token i的候选，不足时以0填充；
+    frequent为 (num_frequent,) 的高频目标语言token
+    """
+    source_tokens, source_offsets = encoded_corpus.load(source_path)
+    target_tokens, target_offsets = encoded_corpus.load(target_path)
+    num_sentences = encoded_corpus.num_sentences(source_offsets)
+
+    cooccurrence = sparse.csr_matrix((vocab_size_source + 1, vocab_size_target + 1), dtype='float32')
+    source_counts = numpy.zeros(vocab_size_source + 1, dtype='float32')
+    target_counts = numpy.zeros(vocab_size_target + 1, dtype='float32')
+    target_frequency = numpy.zeros(vocab_size_target + 1, dtype='int64')
+    for start in range(0, num_sentences, chunk_size):
+        end = min(start + chunk_size, num_sentences)
+        source_matrix = _incidence_matrix(source_tokens, source_offsets, start, end, vocab_size_source + 1)
+        target_matrix = _incidence_matrix(target_tokens, target_offsets, start, end, vocab_size_target + 1)
+        cooccurrence = cooccurrence + source_matrix.T.dot(target_matrix)
+        source_counts += numpy.asarray(source_matrix.sum(axis=0)).ravel()
+        target_counts += numpy.asarray(target_matrix.sum(axis=0)).ravel()
+        target_frequency += numpy.bincount(target_tokens[target_offsets[start]:target_offsets[end]],
+                                           minlength=vocab_size_target + 1)
+
+    # Dice系数：2 * 共现句子数 / (源token出现句子数 + 目标token出现句子数)
+    cooccurrence = cooccurrence.tocoo()
+    scores = 2 * cooccurrence.data / (source_counts[cooccurrence.row] + target_counts[cooccurrence.col])
+    scores = sparse.csr_matrix((scores, (cooccurrence.row, cooccurrence.col)), shape=cooccurrence.shape)
+
+    table = numpy.zeros((vocab_size_source + 1, top_k), dtype='int32')
+    for source_token in range(1, vocab_size_source + 1):
+        row = scores.getrow(source_token)
+        best = row.indices[numpy.argsort(-row.data, kind='stable')[:top_k]]
+        table[source_token, :len(best)] = best
+
+    target_frequency[0] = 0
+    frequent = numpy.argsort(-target_frequency, kind='stable')[:num_frequent]
+    frequent = frequent[target_frequency[frequent] > 0].astype('int32')
+    return {'table': table, 'frequent': frequent}
+
+
+def save(path, lexical_table):
+    """保存词汇翻译表"""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    numpy.savez(path, **lexical_table)
+
+
+def load(path):
+    """加载词汇翻译表"""
+    with numpy.load(path if path.endswith('.npz') else path + '.npz') as data:
+        return {'table': data['table'], 'frequent': data['frequent']}
+
+
+def select(lexical_table, source_sequences, special_tokens=()):
+    """
+    为一个batch的源句子选取目标语言候选集
+    @param lexical_table: 词汇翻译表
+    @param source_sequences: 已编码的源句子 (batch_size, seq_len)
+    @param special_tokens: 总是加入候选集的token，如开始及结束token
+    @return: 升序排列的候选集 (num_candidates,)，第一个元素总为填充token 0
+    """
+    source_tokens = numpy.unique(numpy.asarray(source_sequences))
+    candidates = numpy.concatenate([[0], lexical_table['frequent'], numpy.asarray(special_tokens, dtype='int32'),
+                                    lexical_table['table'][source_tokens].ravel()])
+    return numpy.unique(candidates).astype('int32')
@@ -1,11 +1,14 @@
 import os
+import sys
+from collections import OrderedDict, defaultdict
 
 import tensorflow as tf
-import numpy
 import json
 import tensorflow_datasets as tfds
 
 from hlp.mt.config import get_config as _config
+from hlp.mt.common import encoded_corpus
+from hlp.mt.common import bpe_encoder
 
 
 def _create_and_save_tokenizer_bpe(sentences, save_path, start_word=_config.start_word,
@@ -33,6 +36,11 @@ def _create_and_save_tokenizer_keras(sentences, save_path):
     """
     tokenizer = tf.keras.preprocessing.text.Tokenizer(filters='', oov_token='UNK')
     tokenizer.fit_on_texts(sentences)
+    return _save_tokenizer_keras(tokenizer, save_path)
+
+
+def _save_tokenizer_keras(tokenizer, save_path):
+    """保存字典，返回字典及字典词汇量"""
     json_string = tokenizer.to_json()
     with open(save_path, 'w') as f:
         json.dump(json_string, f)
@@ -63,6 +71,145 @@ def create_and_save_tokenizer(sentences, save_path, language, mode):
         raise ValueError("暂不支持语言(%s)" % language)
 
 
+def _bpe_count_helpers():
+    """
+    获取SubwordTextEncoder.build_from_corpus内部所用的token统计及由统计量生成字典的函数
+    二者均为tfds的私有函数，当前版本的tfds中不存在时返回None，此时改为由全部句子串行生成字典
+    """
+    encoder_class = tfds.features.text.SubwordTextEncoder
+    count_fn = getattr(sys.modules[encoder_class.__module__], '_token_counts_from_generator', None)
+    build_fn = getattr(encoder_class, '_build_from_token_counts', None)
+    if count_fn is None or build_fn is None:
+        return None
+    return count_fn, build_fn
+
+
+def _count_tokens_bpe(sentences, start_word=_config.start_word, end_word=_config.end_word):
+    """按SubwordTextEncoder.build_from_corpus的方式统计各token的出现次数，无法统计时原样返回句子列表"""
+    helpers = _bpe_count_helpers()
+    if helpers is None:
+        return list(sentences)
+    count_fn, _ = helpers
+    return count_fn(sentences, max_chars=None, reserved_tokens=[start_word, end_word])
+
+
+def _count_tokens_keras(sentences):
+    """按Tokenizer.fit_on_texts的方式统计各词的出现次数及出现的句子数"""
+    tokenizer = tf.keras.preprocessing.text.Tokenizer(filters='', oov_token='UNK')
+    tokenizer.fit_on_texts(sentences)
+    return {'word_counts': tokenizer.word_counts,
+            'word_docs': dict(tokenizer.word_docs),
+            'document_count': tokenizer.document_count}
+
+
+def count_tokens(sentences, language, mode):
+    """统计一部分句子中各token的出现次数，用于分片并行地生成字典
+    @param sentences: 经预处理的句子列表
+    @param language: 语言
+    @param mode: 编码方法
+    @return: 统计量，由merge_token_counts合并
+    """
+    if language == 'en' and mode == 'BPE':
+        return _count_tokens_bpe(sentences)
+    return _count_tokens_keras(sentences)
+
+
+def merge_token_counts(counts_list, language, mode):
+    """按分片顺序合并各分片的统计量
+    合并后各token首次出现的顺序与单进程依次统计全部句子时一致，因而由其生成的字典也一致
+    @param counts_list: 按分片顺序排列的count_tokens结果列表
+    @param language: 语言
+    @param mode: 编码方法
+    @return: 合并后的统计量
+    """
+    if language == 'en' and mode == 'BPE':
+        if any(isinstance(counts, list) for counts in counts_list):
+            # tfds中没有统计token的函数时各分片的统计量为句子列表，按顺序拼接
+            return [sentence for sentences in counts_list for sentence in sentences]
+        token_counts = defaultdict(int)
+        for counts in counts_list:
+            for token, count in counts.items():
+                token_counts[token] += count
+        return token_counts
+
+    merged = {'word_counts': OrderedDict(), 'word_docs': defaultdict(int), 'document_count': 0}
+    for counts in counts_list:
+        for word, count in counts['word_counts'].items():
+            merged['word_counts'][word] = merged['word_counts'].get(word, 0) + count
+        for word, count in counts['word_docs'].items():
+            merged['word_docs'][word] += count
+        merged['document_count'] += counts['document_count']
+    return merged
+
+
+def _create_and_save_tokenizer_bpe_from_counts(token_counts, save_path, start_word=_config.start_word,
+                                               end_word=_config.end_word,
+                                               target_vocab_size=_config.target_vocab_size,
+                                               max_subword_length=20):
+    """
+    由token统计量生成字典，与SubwordTextEncoder.build_from_corpus相同，
+    二分搜索子词的最小出现次数，使字典大小接近target_vocab_size
+    token_counts为句子列表时(tfds中没有所需的私有函数)直接由句子串行生成字典
+    """
+    if isinstance(token_counts, list):
+        print('当前版本的tfds不支持由token统计量生成字典，将由全部句子串行生成')
+        return _create_and_save_tokenizer_bpe(token_counts, save_path, start_word=start_word, end_word=end_word,
+                                              target_vocab_size=target_vocab_size)
+    helpers = _bpe_count_helpers()
+    assert helpers is not None, 'token统计量由tfds的私有函数生成，同一版本的tfds中应能由其生成字典'
+    _, build_fn = helpers
+    reserved_tokens = [start_word, end_word]
+
+    def _binary_search(min_token_count, max_token_count):
+        candidate_min = (min_token_count + max_token_count) // 2
+        encoder = build_fn(token_counts=token_counts,
+                           min_token_count=candidate_min,
+                           reserved_tokens=reserved_tokens,
+                           num_iterations=4,
+                           max_subword_length=max_subword_length)
+        vocab_size = encoder.vocab_size
+        if abs(vocab_size - target_vocab_size) * 100 < target_vocab_size \
+                or min_token_count >= max_token_count or candidate_min <= 1:
+            return encoder
+        if vocab_size > target_vocab_size:
+            next_encoder = _binary_search(candidate_min + 1, max_token_count)
+        else:
+            next_encoder = _binary_search(min_token_count, candidate_min - 1)
+        if abs(vocab_size - target_vocab_size) < abs(next_encoder.vocab_size - target_vocab_size):
+            return encoder
+        return next_encoder
+
+    tokenizer = _binary_search(max(min(token_counts.values()), 1), max(token_counts.values()))
+    tokenizer.save_to_file(save_path)
+    return tokenizer, tokenizer.vocab_size
+
+
+def _create_and_save_tokenizer_keras_from_counts(counts, save_path):
+    """由词统计量生成字典"""
+    tokenizer = tf.keras.preprocessing.text.Tokenizer(filters='', oov_token='UNK')
+    tokenizer.word_counts = counts['word_counts']
+    tokenizer.word_docs = counts['word_docs']
+    tokenizer.document_count = counts['document_count']
+    # 不输入句子时fit_on_texts只由已有的统计量生成word_index等
+    tokenizer.fit_on_texts([])
+    return _save_tokenizer_keras(tokenizer, save_path)
+
+
+def create_and_save_tokenizer_from_counts(counts, save_path, language, mode):
+    """由merge_token_counts合并的统计量生成及保存字典，结果与create_and_save_tokenizer一致
+    @param counts: 合并后的统计量
+    @param save_path: 保存的路径
+    @param language: 语言
+    @param mode: 编码方法
+    @return: 字典，字典词汇量
+    """
+    if not os.path.exists(os.path.dirname(save_path)):
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    if language == 'en' and mode == 'BPE':
+        return _create_and_save_tokenizer_bpe_from_counts(counts, save_path)
+    return _create_and_save_tokenizer_keras_from_counts(counts, save_path)
+
+
 def _load_tokenizer_bpe(path):
     """从指定路径加载保存好的字典"""
     tokenizer = tfds.features.text.SubwordTextEncoder.load_from_file(path)
@@ -108,7 +255,7 @@ def _encode_sentences_bpe(sentences, tokenizer):
 
     Returns:编码好的句子
     """
-    sequences = [tokenizer.encode(s) for s in sentences]
+    sequences = bpe_encoder.get_encoder(tokenizer).encode_batch(sentences)
     sequences = tf.keras.preprocessing.sequence.pad_sequences(sequences, padding='post')
     max_sequence_length = len(sequences[0])
     return sequences, max_sequence_length
@@ -171,46 +318,43 @@ def get_start_token(start_word, tokenizer, language):
     return start_token
 
 
-def _encode_and_save_bpe(sentences, tokenizer, path):
+def _encode_and_save_bpe(sentences, tokenizer, path, num_processes=_config.preprocess_processes):
     """
-    将编码好的句子保存至文件，返回最大句子长度
+    将编码好的句子以二进制格式(不填充)保存至文件，返回最大句子长度
     Args:
         sentences: 需要编码的句子
         tokenizer: 字典
         path:文件保存路径
+        num_processes: 编码使用的进程数
 
     Returns:最大句子长度
     """
-    sequences = [tokenizer.encode(s) for s in sentences]
-    sequences = tf.keras.preprocessing.sequence.pad_sequences(sequences, padding='post')
-    max_sequence_length = len(sequences[0])
-    numpy.savetxt(path, sequences)
-    return max_sequence_length
+    sequences = bpe_encoder.get_encoder(tokenizer).encode_batch(sentences, num_processes=num_processes)
+    return encoded_corpus.save(path, sequences)
 
 
 def _encode_and_save_keras(sentences, tokenizer, path):
     """
-    将编码好的句子保存至文件，返回最大句子长度
+    将编码好的句子以二进制格式(不填充)保存至文件，返回最大句子长度
     Args:
         sentences: 需要编码的句子
         tokenizer: 字典
+        path:文件保存路径
 
     Returns:最大句子长度
     """
     sequences = tokenizer.texts_to_sequences(sentences)
-    sequences = tf.keras.preprocessing.sequence.pad_sequences(sequences, padding='post')
-    max_sequence_length = len(sequences[0])
-    numpy.savetxt(path, sequences)
-    return max_sequence_length
+    return encoded_corpus.save(path, sequences)
 
 
-def encode_and_save(save_path, sentences, tokenizer, language, mode):
+def encode_and_save(save_path, sentences, tokenizer, language, mode, num_processes=_config.preprocess_processes):
     """编码并保存句子
     @param save_path:保存的路径
     @param sentences:需要进行编码并保存的句子
     @param tokenizer:使用的字典
     @param language:语言
     @param mode:模式
+    @param num_processes:BPE编码使用的进程数，在进程池的worker中调用时应为1
     @return:最大句子长度
     """
     if not os.path.exists(os.path.dirname(save_path)):
@@ -219,7 +363,7 @@ def encode_and_save(save_path, sentences, tokenizer, language, mode):
         return _encode_and_save_keras(sentences, tokenizer, save_path)
     elif language == 'en':
         if mode == 'BPE':
-            return _encode_and_save_bpe(sentences, tokenizer, save_path)
+            return _encode_and_save_bpe(sentences, tokenizer, save_path, num_processes)
         elif mode == 'WORD':
             return _encode_and_save_keras(sentences, tokenizer, save_path)
     else:
@@ -0,0 +1,64 @@
+import os
+import tempfile
+
+from hlp.mt.common import text_vectorize
+
+_WORDS = ['the', 'cat', 'dog', 'sat', 'on', 'mat', 'running', 'runner', 'quickly', 'jumped', 'over', 'lazy']
+# 按固定规则组合出的句子，各分片中token首次出现的顺序不同
+_SENTENCES = ['<start> %s %s %s %s . <end>' % (_WORDS[i % 12], _WORDS[i * 5 % 12], _WORDS[i * 7 % 12],
+                                                 _WORDS[(i + 3) % 12]) for i in range(60)]
+
+
+def _shard_counts(sentences, language, mode, num_shards=3):
+    """将句子划分为多个分片分别统计token，再按分片顺序合并"""
+    shard_size = (len(sentences) + num_shards - 1) // num_shards
+    counts_list = [text_vectorize.count_tokens(sentences[i:i + shard_size], language, mode)
+                   for i in range(0, len(sentences), shard_size)]
+    return text_vectorize.merge_token_counts(counts_list, language, mode)
+
+
+def _bpe_tokenizers(directory):
+    """分别由全部句子串行生成及由合并的分片统计量生成BPE字典"""
+    serial, _ = text_vectorize._create_and_save_tokenizer_bpe(
+        _SENTENCES, os.path.join(directory, 'serial'), target_vocab_size=300)
+    merged, _ = text_vectorize._create_and_save_tokenizer_bpe_from_counts(
+        _shard_counts(_SENTENCES, 'en', 'BPE'), os.path.join(directory, 'merged'), target_vocab_size=300)
+    return serial, merged
+
+
+def test_bpe_merged_counts():
+    """由合并的分片统计量生成的BPE字典与串行生成的字典相同"""
+    with tempfile.TemporaryDirectory() as directory:
+        serial, merged = _bpe_tokenizers(directory)
+        assert merged.subwords == serial.subwords
+        assert merged.encode(_SENTENCES[0]) == serial.encode(_SENTENCES[0])
+
+
+def test_bpe_without_count_helpers():
+    """tfds中没有统计token的私有函数时，分片统计量为句子列表，合并后串行生成相同的字典"""
+    count_helpers = text_vectorize._bpe_count_helpers
+    text_vectorize._bpe_count_helpers = lambda: None
+    try:
+        assert _shard_counts(_SENTENCES, 'en', 'BPE') == _SENTENCES
+        with tempfile.TemporaryDirectory() as directory:
+            serial, merged = _bpe_tokenizers(directory)
+            assert merged.subwords == serial.subwords
+    finally:
+        text_vectorize._bpe_count_helpers = count_helpers
+
+
+def test_keras_merged_counts():
+    """由合并的分片统计量生成的字典与串行生成的字典的词序号相同"""
+    with tempfile.TemporaryDirectory() as directory:
+        serial, _ = text_vectorize.create_and_save_tokenizer(_SENTENCES, os.path.join(directory, 'serial'),
+                                                             'en', 'WORD')
+        merged, _ = text_vectorize.create_and_save_tokenizer_from_counts(
+            _shard_counts(_SENTENCES, 'en', 'WORD'), os.path.join(directory, 'merged'), 'en', 'WORD')
+        assert merged.word_index == serial.word_index
+        assert merged.word_docs == serial.word_docs
+
+
+if __name__ == '__main__':
+    test_bpe_merged_counts()
+    test_bpe_without_count_helpers()
+    test_keras_merged_counts()
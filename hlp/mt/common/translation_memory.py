@@ -0,0 +1,167 @@
+"""
+翻译记忆
+以规范化后的源句子及模型指纹为键缓存翻译结果，重复出现的句子直接返回已保存的翻译，不再进行beam search
+- 精确匹配：源句子经Unicode NFKC规范化并合并空白后完全一致
+- 模糊匹配(可选)：以字符n-gram倒排索引召回候选，按编辑距离计算相似度，不低于阈值时返回其翻译
+条目数量有上限，超出时按最近最少使用(LRU)淘汰，可保存至磁盘并在下次启动时加载
+模型指纹不同(如更换检查点或解码设置)的条目互不命中
+"""
+import json
+import os
+import unicodedata
+from collections import Counter, OrderedDict
+
+
+def normalize(sentence):
+    """源句子规范化：Unicode NFKC规范化，去掉首尾空白并将连续空白合并为一个空格"""
+    return ' '.join(unicodedata.normalize('NFKC', sentence).split())
+
+
+def _ngrams(text, n):
+    """字符n-gram集合，文本短于n时以整个文本作为唯一的n-gram"""
+    if len(text) < n:
+        return {text}
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _edit_distance(a, b):
+    """字符级Levenshtein距离"""
+    if len(a) > len(b):
+        a, b = b, a
+    current = list(range(len(a) + 1))
+    for i in range(1, len(b) + 1):
+        previous, current = current, [i] + [0] * len(a)
+        for j in range(1, len(a) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1,
+                             previous[j - 1] + (a[j - 1] != b[i - 1]))
+    return current[len(a)]
+
+
+def similarity(a, b):
+    """由编辑距离得到的相似度，1为完全一致"""
+    if not a and not b:
+        return 1.0
+    return 1 - _edit_distance(a, b) / max(len(a), len(b))
+
+
+class TranslationMemory(object):
+    """
+    带LRU淘汰及可选模糊匹配的翻译记忆
+    """
+
+    def __init__(self, fingerprint, path=None, max_entries=100000, fuzzy=False, fuzzy_threshold=0.9,
+                 ngram_size=3, max_fuzzy_candidates=10):
+        """
+        @param fingerprint: 当前模型及解码设置的指纹，只命中相同指纹下保存的条目
+        @param path: 保存路径，文件存在时加载已保存的条目，为None时不持久化
+        @param max_entries: 最大条目数量
+        @param fuzzy: 是否进行模糊匹配
+        @param fuzzy_threshold: 模糊匹配的最低相似度
+        @param ngram_size: 模糊匹配倒排索引的字符n-gram长度
+        @param max_fuzzy_candidates: 模糊匹配时计算编辑距离的最多候选数量
+        """
+        self.fingerprint = fingerprint
+        self.path = path
+        self.max_entries = max_entries
+        self.fuzzy = fuzzy
+        self.fuzzy_threshold = fuzzy_threshold
+        self.ngram_size = ngram_size
+        self.max_fuzzy_candidates = max_fuzzy_candidates
+        self._entries = OrderedDict()  # (指纹, 规范化源句子) -> 翻译，按最近使用顺序排列
+        self._index = {}  # n-gram -> 当前指纹下包含该n-gram的规范化源句子集合
+        self.lookups = self.exact_hits = self.fuzzy_hits = self.evictions = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _index_add(self, text):
+        for ngram in _ngrams(text, self.ngram_size):
+            self._index.setdefault(ngram, set()).add(text)
+
+    def _index_remove(self, text):
+        for ngram in _ngrams(text, self.ngram_size):
+            texts = self._index.get(ngram)
+            if texts is not None:
+                texts.discard(text)
+                if not texts:
+                    del self._index[ngram]
+
+    def _fuzzy_lookup(self, text):
+        """在倒排索引中召回共有n-gram最多的候选，返回相似度不低于阈值的最佳条目的键"""
+        ngrams = _ngrams(text, self.ngram_size)
+        counts = Counter()
+        for ngram in ngrams:
+            counts.update(self._index.get(ngram, ()))
+        best_key, best_similarity = None, self.fuzzy_threshold
+        for candidate, count in counts.most_common(self.max_fuzzy_candidates):
+            # n-gram的Dice系数过低时编辑距离相似度不可能达到阈值附近，跳过以节省计算
+            if 2 * count / (len(ngrams) + len(_ngrams(candidate, self.ngram_size))) < self.fuzzy_threshold / 2:
+                continue
+            candidate_similarity = similarity(text, candidate)
+            if candidate_similarity >= best_similarity:
+                best_key, best_similarity = (self.fingerprint, candidate), candidate_similarity
+        return best_key
+
+    def lookup(self, sentence):
+        """
+        查找源句子的翻译
+        @param sentence: 源句子
+        @return: 命中时为保存的翻译，否则为None
+        """
+        self.lookups += 1
+        key = (self.fingerprint, normalize(sentence))
+        if key in self._entries:
+            self.exact_hits += 1
+        elif self.fuzzy:
+            key = self._fuzzy_lookup(key[1])
+            if key is None:
+                return None
+            self.fuzzy_hits += 1
+        else:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def add(self, sentence, translation):
+        """
+        保存源句子的翻译，超出最大条目数量时淘汰最近最少使用的条目
+        @param sentence: 源句子
+        @param translation: 翻译结果
+        """
+        key = (self.fingerprint, normalize(sentence))
+        if key not in self._entries and self.fuzzy:
+            self._index_add(key[1])
+        self._entries[key] = translation
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            (fingerprint, text), _ = self._entries.popitem(last=False)
+            if self.fuzzy and fingerprint == self.fingerprint:
+                self._index_remove(text)
+            self.evictions += 1
+
+    def stats(self):
+        """命中率统计"""
+        hits = self.exact_hits + self.fuzzy_hits
+        return {'entries': len(self._entries), 'lookups': self.lookups, 'exact_hits': self.exact_hits,
+                'fuzzy_hits': self.fuzzy_hits, 'misses': self.lookups - hits, 'evictions': self.evictions,
+                'hit_rate': hits / self.lookups if self.lookups else 0.0}
+
+    def save(self, path=None):
+        """按最近使用顺序保存全部条目"""
+        path = path or self.path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='UTF-8') as file:
+            json.dump([[fingerprint, text, translation]
+                       for (fingerprint, text), translation in self._entries.items()], file, ensure_ascii=False)
+
+    def load(self, path):
+        """加载保存的条目，超出最大条目数量时只保留最近使用的条目"""
+        with open(path, encoding='UTF-8') as file:
+            entries = json.load(file)
+        for fingerprint, text, translation in entries[-self.max_entries:]:
+            self._entries[(fingerprint, text)] = translation
+            if self.fuzzy and fingerprint == self.fingerprint:
+                self._index_add(text)
@@ -18,6 +18,7 @@ validation_data = conf["validation_data"]  # 是否从给定文本数据集用
 checkpoint_name = conf['checkpoint_name']  # 检查点名字
 validation_freq = conf['validation_freq']  # 验证频率，即每训练几个epoch进行验证
 checkpoints_save_freq = conf['checkpoints_save_freq']  # 检查点保存频率
+checkpoint_save_minutes = conf['checkpoint_save_minutes']  # 训练中按时间保存训练状态的间隔(分钟)，为0时只在epoch结束时保存
 max_checkpoints_num = conf['max_checkpoints_num']  # 保存最大检查点数量
 source_lang = conf['source_lang']  # 源语言
 target_lang = conf['target_lang']  # 目标语言
@@ -33,6 +34,9 @@ num_eval = conf['num_eval']  # 用于计算指标的句子对数量
 checkpoint_path = os.path.join(conf["checkpoint_path_dir"], conf['source_lang']+'_'+conf['target_lang'])   # 检查点路径
 BUFFER_SIZE = conf['BUFFER_SIZE']
 BATCH_SIZE = conf['BATCH_SIZE']
+preprocess_processes = conf['preprocess_processes']  # 语料预处理使用的进程数，大于1时分片并行处理
+preprocess_shard_size = conf['preprocess_shard_size']  # 并行预处理时每个分片的句子对数量
+max_batch_tokens = conf['max_batch_tokens']  # 每个batch的最大源语言与目标语言token总数，为0时按BATCH_SIZE划分batch
 train_size = conf['train_size']  # 训练数据中test数据占比
 num_sentences = conf["num_sentences"]  # 用于训练的句子对数量
 num_layers = conf["num_layers"]  # encoder 与 decoder 中包含的 encoder 与 decoder 层数
@@ -42,22 +46,53 @@ num_heads = conf["num_heads"]  # 多头注意力的头数
 dropout_rate = conf["dropout_rate"]
 EPOCHS = conf["EPOCHS"]  # 训练轮次
 max_target_length = conf['max_target_length']  # 最大生成目标句子长度
+max_length_a = conf['max_length_a']  # 每个句子的最大解码长度为 max_length_a * 源句子长度 + max_length_b，a不大于0时不限制
+max_length_b = conf['max_length_b']
+length_penalty = conf['length_penalty']  # beam search长度惩罚((5 + 长度) / 6) ^ length_penalty的指数，为0时不进行长度惩罚
 target_vocab_size = conf["target_vocab_size"]  # 英语分词target_vocab_size
 start_word = conf["start_word"]  # 句子开始标志
 end_word = conf["end_word"]  # 句子结束标志
 BEAM_SIZE = conf["BEAM_SIZE"]  # BEAM_SIZE
 checkpoint_ensembling = conf["checkpoint_ensembling"]  # 是否采用checkpoint_ensembling
+ema_decay = conf["ema_decay"]  # 训练时维护权重指数滑动平均的衰减率，为0时不维护
+lexical_table_path = conf["lexical_table_path"]  # 词表候选集使用的词汇翻译表路径
+shortlist_top_k = conf["shortlist_top_k"]  # 词汇翻译表中每个源语言token保留的目标语言token数量
+shortlist_frequent = conf["shortlist_frequent"]  # 总是加入候选集的高频目标语言token数量
+
+tm_path = conf["translation_memory"]["path"]  # 翻译记忆保存路径
+tm_max_entries = conf["translation_memory"]["max_entries"]  # 翻译记忆最大条目数量，超出时按LRU淘汰
+tm_fuzzy_match = conf["translation_memory"]["fuzzy_match"]  # 翻译记忆是否进行模糊匹配
+tm_fuzzy_threshold = conf["translation_memory"]["fuzzy_threshold"]  # 模糊匹配的最低编辑距离相似度
+tm_ngram_size = conf["translation_memory"]["ngram_size"]  # 模糊匹配倒排索引的字符n-gram长度
+
+student_checkpoint_path = checkpoint_path + '_student'  # 知识蒸馏学生模型的检查点路径
+student_num_encoder_layers = conf["distillation"]["num_encoder_layers"]  # 学生模型编码器层数
+student_num_decoder_layers = conf["distillation"]["num_decoder_layers"]  # 学生模型解码器层数
+student_d_model = conf["distillation"]["d_model"]
+student_dff = conf["distillation"]["dff"]
+student_num_heads = conf["distillation"]["num_heads"]
+distill_beam_size = conf["distillation"]["beam_size"]  # 教师模型翻译训练语料时的beam大小
+distill_batch_size = conf["distillation"]["batch_size"]  # 教师模型翻译训练语料时的batch大小
+
+pruned_checkpoint_path = checkpoint_path + '_pruned'  # 结构化剪枝模型的检查点路径
+prune_head_ratio = conf["pruning"]["head_ratio"]  # 剪掉的注意力头占全部头的比例
+prune_ffn_ratio = conf["pruning"]["ffn_ratio"]  # 每层前馈网络剪掉的神经元比例
+prune_num_batches = conf["pruning"]["num_batches"]  # 计算重要性使用的验证集batch数量
+prune_finetune_epochs = conf["pruning"]["finetune_epochs"]  # 剪枝后微调的epoch数
 
 lm_path_to_train_file = conf["language_model"]["path_to_train_file_lm"]  # 语言模型训练文本路径
 lm_language = conf["language_model"]["language"]
 lm_tokenize_type = conf["language_model"]["tokenize_type"]
 lm_EPOCHS = conf["language_model"]["EPOCHS"]
 lm_num_sentences = conf["language_model"]["num_sentences"]
-lm_BATCH_SIZE = conf["language_model"]["BATCH_SIZE"]
+lm_BATCH_SIZE = conf["language_model"]["BATCH_SIZE"]  # batch大小，训练时为token流切分的通道数量
+lm_bptt_length = conf["language_model"]["bptt_length"]  # 截断反向传播的长度
 lm_train_size = conf["language_model"]["train_size"]
 lm_checkpoint_path = os.path.join(conf["checkpoint_path_dir"], 'lm')
 lm_d_embedding = conf["language_model"]["d_embedding"]
 lm_d_rnn = conf["language_model"]["d_rnn"]
+lm_rescore_weight = conf["language_model"]["rescore_weight"]  # 使用语言模型对n-best候选重排序时语言模型得分的权重
+lm_fusion_weight = conf["language_model"]["fusion_weight"]  # beam search中与语言模型浅融合的权重，为0时不进行浅融合
 lm_max_checkpoints_num = conf["language_model"]["max_checkpoints_num"]
 lm_checkpoints_save_freq = conf["language_model"]["checkpoints_save_freq"]
 lm_validation_freq = conf["language_model"]["validation_freq"]
@@ -0,0 +1,186 @@
+"""
+序列级知识蒸馏
+1. 使用训练好的教师模型(config.json中的模型结构及检查点)以批量beam search翻译训练语料的源语言句子
+2. 以教师模型的翻译结果替换已编码训练语料的目标语言部分，原目标语言语料另行备份
+3. 按config.json中distillation的结构(如深编码器、浅解码器)通过trainer.train训练学生模型，检查点单独保存
+4. 在验证文本上对比教师与学生模型的BLEU、单句延迟及批量吞吐量
+"""
+import time
+from argparse import ArgumentParser
+
+import numpy
+import tensorflow as tf
+
+from hlp.mt.config import get_config as _config
+from hlp.mt.model import nmt_model
+from hlp.mt.common import bleu as _bleu
+from hlp.mt.common import encoded_corpus
+from hlp.mt.common import load_dataset
+from hlp.mt import preprocess
+from hlp.mt import trainer
+from hlp.mt import translator
+
+
+def _truncate(predict_idx, end_token):
+    """将解码得到的编码序列截断至结束token并去掉填充，未生成结束token时在末尾补上"""
+    end_positions = numpy.where(predict_idx == end_token)[0]
+    if len(end_positions) > 0:
+        predict_idx = predict_idx[:end_positions[0] + 1]
+    predict_idx = predict_idx[predict_idx != 0]
+    if predict_idx[-1] != end_token:
+        predict_idx = numpy.append(predict_idx, end_token)
+    return predict_idx
+
+
+def distill_corpus(models, tokenizer_target, source_path, target_path,
+                   batch_size=_config.distill_batch_size, beam_size=_config.distill_beam_size):
+    """
+    使用教师模型翻译已编码的源语言语料，并将翻译结果按已编码语料的格式保存
+    源句子按长度排序后分batch进行beam search，翻译结果直接以编码序列保存，无需解码后再编码
+    @param models: 教师模型列表
+    @param tokenizer_target: 目标语言字典
+    @param source_path: 已编码源语言语料路径
+    @param target_path: 翻译结果保存路径
+    @param batch_size: 每个batch的句子数量
+    @param beam_size: beam大小
+    @return: 翻译结果的最大长度
+    """
+    start_token, end_token = translator._get_special_tokens(tokenizer_target)
+    tokens, offsets = encoded_corpus.load(source_path)
+    num_sentences = encoded_corpus.num_sentences(offsets)
+    order = numpy.argsort(encoded_corpus.lengths(offsets), kind='stable')
+
+    sequences = [None] * num_sentences
+    start = time.time()
+    for i in range(0, num_sentences, batch_size):
+        batch_order = order[i:i + batch_size]
+        inp_sequences = tf.constant(encoded_corpus.gather(tokens, offsets, batch_order))
+        predict_idxes = translator._predict_index(models, inp_sequences, start_token, end_token, beam_size)
+        for index, predict_idx in zip(batch_order, predict_idxes.numpy()):
+            sequences[index] = _truncate(predict_idx, end_token)
+        print('\r已翻译%d/%d个句子' % (min(i + batch_size, num_sentences), num_sentences), end='')
+    elapsed = time.time() - start
+    print('\n翻译用时%.2fs，%.2f句/s' % (elapsed, num_sentences / elapsed))
+
+    return encoded_corpus.save(target_path, sequences)
+
+
+def distill(ema=False):
+    """
+    使用教师模型生成蒸馏语料，替换训练语料的目标语言部分
+    原目标语言语料首次蒸馏时备份至后缀为_train_reference的路径，重复蒸馏时始终翻译同一源语言语料
+    @param ema: 教师模型是否使用指数滑动平均权重
+    """
+    source_path = preprocess.get_encoded_sequences_path(_config.source_lang, postfix='_train')
+    target_path = preprocess.get_encoded_sequences_path(_config.target_lang, postfix='_train')
+    reference_path = preprocess.get_encoded_sequences_path(_config.target_lang, postfix='_train_reference')
+    if not encoded_corpus.exists(source_path):
+        raise ValueError("未找到已编码的训练语料，请先运行preprocess.py")
+    if not encoded_corpus.exists(reference_path):
+        encoded_corpus.copy(target_path, reference_path)
+        print('原目标语言语料已备份至：%s' % reference_path)
+
+    models, _, tokenizer_target = nmt_model.load_translate_models(ema=ema)
+    print('正在使用教师模型翻译训练语料...')
+    max_length = distill_corpus(models, tokenizer_target, source_path, target_path)
+    print('蒸馏语料已保存至：%s，最大句子长度:%d' % (target_path, max_length))
+
+
+def train_student():
+    """在蒸馏语料上训练学生模型"""
+    tokenizer_source, vocab_size_source, tokenizer_target, vocab_size_target = nmt_model._load_tokenizers()
+    student = nmt_model.create_model(vocab_size_source, vocab_size_target, student=True)
+    ema_model = nmt_model.create_model(vocab_size_source, vocab_size_target, student=True) \
+        if _config.ema_decay > 0 else None
+    print('学生模型：%d层编码器，%d层解码器，d_model=%d，%d头'
+          % (_config.student_num_encoder_layers, _config.student_num_decoder_layers,
+             _config.student_d_model, _config.student_num_heads))
+    trainer.train(student,
+                  validation_data=_config.validation_data,
+                  validation_split=1 - _config.train_size,
+                  validation_freq=_config.validation_freq,
+                  ema_model=ema_model,
+                  checkpoint_path=_config.student_checkpoint_path)
+
+
+def _evaluate(models, tokenizer_source, tokenizer_target, source_sentences, target_sentences,
+              batch_size, beam_size, num_latency):
+    """
+    计算BLEU、批量翻译吞吐量及单句翻译延迟
+    @return: BLEU，句/s，单句平均延迟(ms)
+    """
+    translator.translate(source_sentences[0], models, tokenizer_source, tokenizer_target, beam_size=beam_size)
+
+    start = time.time()
+    candidates = translator.translate_batch(source_sentences, models, tokenizer_source, tokenizer_target,
+                                            batch_size=batch_size, beam_size=beam_size, verbose=False)
+    throughput = len(source_sentences) / (time.time() - start)
+    references = [[sentence.strip()] for sentence in target_sentences]
+    bleu = _bleu.corpus_bleu(candidates, references, _config.target_lang)
+
+    start = time.time()
+    for sentence in source_sentences[:num_latency]:
+        translator.translate(sentence, models, tokenizer_source, tokenizer_target, beam_size=beam_size)
+    latency = (time.time() - start) / min(num_latency, len(source_sentences)) * 1000
+    return bleu, throughput, latency
+
+
+def report(num_eval=_config.num_eval, batch_size=_config.BATCH_SIZE, beam_size=_config.BEAM_SIZE,
+           num_latency=100, ema=False):
+    """
+    在验证文本上对比教师与学生模型
+    @param num_eval: 用于计算BLEU及吞吐量的句子数量
+    @param batch_size: 批量翻译的batch大小
+    @param beam_size: beam大小
+    @param num_latency: 用于测量单句延迟的句子数量
+    @param ema: 是否使用指数滑动平均权重
+    @return: 各模型的结果字典列表
+    """
+    source_sentences, target_sentences = load_dataset.load_sentences(_config.path_to_eval_file, num_eval)
+    results = []
+    for name, student in (('教师', False), ('学生', True)):
+        models, tokenizer_source, tokenizer_target = nmt_model.load_translate_models(ema=ema, student=student)
+        model = models[0]
+        bleu, throughput, latency = _evaluate(models, tokenizer_source, tokenizer_target,
+                                              source_sentences, target_sentences,
+                                              batch_size, beam_size, num_latency)
+        results.append({'name': name, 'encoder_layers': model.encoder.num_layers,
+                        'decoder_layers': model.decoder.num_layers,
+                        'params': sum(int(numpy.prod(v.shape)) for v in model.trainable_variables),
+                        'bleu': bleu, 'throughput': throughput, 'latency': latency})
+
+    print('-' * 20)
+    print('%-6s%8s%8s%12s%8s%12s%12s' % ('模型', '编码层', '解码层', '参数量', 'BLEU', '吞吐量(句/s)', '延迟(ms)'))
+    for result in results:
+        print('%-6s%8d%8d%12d%8.2f%12.2f%12.2f' % (result['name'], result['encoder_layers'],
+                                                   result['decoder_layers'], result['params'], result['bleu'],
+                                                   result['throughput'], result['latency']))
+    teacher, student = results
+    print('学生模型相对教师模型：BLEU变化%+.2f，单句延迟%.2f倍，吞吐量%.2f倍'
+          % (student['bleu'] - teacher['bleu'], student['latency'] / teacher['latency'],
+             student['throughput'] / teacher['throughput']))
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='序列级知识蒸馏：教师模型翻译训练语料，在其上训练更快的学生模型')
+    parser.add_argument('--step', default='all', choices=['distill', 'train', 'report', 'all'],
+                        help='执行的步骤：生成蒸馏语料、训练学生模型、对比报告或全部')
+    parser.add_argument('--num_eval', default=_config.num_eval, type=int, required=False, help='用于对比的句子数量')
+    parser.add_argument('--beam_size', default=_config.BEAM_SIZE, type=int, required=False, help='对比时的beam大小')
+    parser.add_argument('--ema', action='store_true', help='教师模型及对比时使用指数滑动平均权重')
+    options = parser.parse_args()
+
+    if options.step in ('distill', 'all'):
+        if not nmt_model.check_point():
+            print('没有发现训练好的教师模型，请先训练模型.')
+            return
+        distill(ema=options.ema)
+    if options.step in ('train', 'all'):
+        train_student()
+    if options.step in ('report', 'all'):
+        report(num_eval=options.num_eval, beam_size=options.beam_size, ema=options.ema)
+
+
+if __name__ == '__main__':
+    main()
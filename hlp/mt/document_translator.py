@@ -0,0 +1,226 @@
+"""
+多进程文档翻译
+将文档切分为句子后分块分发给多个worker进程，每个worker只加载一次模型并固定其计算线程，
+翻译结果按原顺序流式返回，同时在途的块数有上限，内存占用与文档大小无关
+"""
+import os
+import re
+import time
+import itertools
+import multiprocessing as mp
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+from hlp.mt.config import get_config as _config
+
+_worker_state = {}
+# 句子边界：英文句末标点(可带右引号或右括号)之后的空白处，或中文句末标点(可带右引号或右括号)之后
+_SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+|(?<=[.!?]["\'”’)])\s+'
+                                r'|(?<=[。！？])(?![”’」』）])\s*|(?<=[。！？][”’」』）])\s*')
+# 句末的常见缩写及以点分隔的首字母缩写(如e.g.、U.S.)，其后的点不是句子结束；
+# 单个字母后的点不在此列，以免把"So did I."、"He got an A."这样的句子与下一句合并
+_ABBREVIATION = re.compile(r'(?:\b(?:Mr|Mrs|Ms|Dr|Prof|Sr|Jr|St|vs|etc|No)|(?<![\w.])[A-Za-z](?:\.[A-Za-z])+)\.$')
+
+
+def split_sentences(document):
+    """
+    按句末标点将文档(段落)切分为句子列表
+    英文标点之后需有空白才切分，不会切开小数(如3.14)；中文标点之后直接切分，句末的右引号及右括号留在句子中；
+    以常见缩写或首字母缩写(如Mr.、e.g.)结尾的片段与下一片段重新合并
+    """
+    sentences = []
+    for sentence in _SENTENCE_BOUNDARY.split(document.strip()):
+        if not sentence.strip():
+            continue
+        if sentences and _ABBREVIATION.search(sentences[-1]):
+            sentences[-1] += ' ' + sentence
+        else:
+            sentences.append(sentence)
+    return sentences
+
+
+def _init_worker(threads_per_worker, cores_queue, batch_size, beam_size):
+    """
+    worker进程初始化，设置TensorFlow线程数并绑定CPU核，加载一次模型常驻于进程中
+    @param threads_per_worker: 每个worker的intra-op线程数
+    @param cores_queue: 分配给各worker的CPU核列表队列
+    @param batch_size: 翻译的batch大小
+    @param beam_size: beam大小
+    """
+    cores = cores_queue.get()
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_worker)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    from hlp.mt.model import nmt_model
+    models, tokenizer_source, tokenizer_target = nmt_model.load_translate_models()
+    _worker_state.update(models=models, tokenizer_source=tokenizer_source, tokenizer_target=tokenizer_target,
+                         batch_size=batch_size, beam_size=beam_size)
+
+
+def _translate_chunk(sentences):
+    """在worker进程中翻译一块句子"""
+    from hlp.mt import translator
+    return translator.translate_batch(sentences, _worker_state['models'], _worker_state['tokenizer_source'],
+                                      _worker_state['tokenizer_target'], batch_size=_worker_state['batch_size'],
+                                      beam_size=_worker_state['beam_size'], verbose=False)
+
+
+class DocumentTranslator(object):
+    """
+    基于worker进程池的文档翻译器
+    """
+
+    def __init__(self, num_workers=None, threads_per_worker=None, batch_size=_config.BATCH_SIZE,
+                 beam_size=_config.BEAM_SIZE, chunk_size=64, max_in_flight=None):
+        """
+        @param num_workers: worker进程数，默认为CPU核数
+        @param threads_per_worker: 每个worker的intra-op线程数，默认平分CPU核
+        @param batch_size: 每个worker翻译时的batch大小
+        @param beam_size: beam大小
+        @param chunk_size: 每次分发给worker的句子数量
+        @param max_in_flight: 同时在途的最大块数，默认为worker数的2倍
+        """
+        num_cores = os.cpu_count() or 1
+        self.num_workers = num_workers or num_cores
+        self.threads_per_worker = threads_per_worker or max(num_cores // self.num_workers, 1)
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight or 2 * self.num_workers
+
+        # TensorFlow运行时在fork之后不可用，因此使用spawn方式启动worker，并为每个worker分配互不重叠的CPU核
+        context = mp.get_context('spawn')
+        cores_queue = context.Queue()
+        for i in range(self.num_workers):
+            start = i * self.threads_per_worker
+            cores = [core % num_cores for core in range(start, start + self.threads_per_worker)]
+            cores_queue.put(cores if self.num_workers * self.threads_per_worker <= num_cores else None)
+        # worker意外退出时进程池不会补充新的worker，在途及之后提交的块均抛出BrokenProcessPool，而不是一直等待
+        self.pool = ProcessPoolExecutor(self.num_workers, mp_context=context, initializer=_init_worker,
+                                        initargs=(self.threads_per_worker, cores_queue, batch_size, beam_size))
+
+    def translate_sentences(self, sentences):
+        """
+        翻译句子序列，按原顺序逐句返回翻译结果
+        输入可为惰性的迭代器，在途的块数不超过max_in_flight；有worker意外退出时抛出BrokenProcessPool
+        @param sentences: 句子迭代器
+        @return: 翻译结果生成器
+        """
+        sentences = iter(sentences)
+        pending = []
+        while True:
+            while len(pending) < self.max_in_flight:
+                chunk = list(itertools.islice(sentences, self.chunk_size))
+                if not chunk:
+                    break
+                pending.append(self.pool.submit(_translate_chunk, chunk))
+            if not pending:
+                break
+            for translation in pending.pop(0).result():
+                yield translation
+
+    def translate_documents(self, documents):
+        """
+        翻译文档序列，每个文档切分为句子翻译后再按目标语言拼接，按原顺序逐个返回
+        @param documents: 文档(段落)迭代器
+        @return: 翻译后的文档生成器
+        """
+        join_str = '' if _config.target_lang == 'zh' else ' '
+        counts = []
+
+        def _sentences():
+            for document in documents:
+                document_sentences = split_sentences(document)
+                counts.append(len(document_sentences))
+                for sentence in document_sentences:
+                    yield sentence
+
+        # 文档是惰性读取的，counts随翻译进行逐步增长，凑齐一个文档的全部句子后即输出
+        buffer = []
+        document_index = 0
+        for translation in self.translate_sentences(_sentences()):
+            buffer.append(translation)
+            while document_index < len(counts) and len(buffer) >= counts[document_index]:
+                count = counts[document_index]
+                yield join_str.join(buffer[:count])
+                del buffer[:count]
+                document_index += 1
+        # 末尾可能还有不含句子的空文档
+        for _ in counts[document_index:]:
+            yield ''
+
+    def close(self):
+        """关闭进程池"""
+        self.pool.shutdown(wait=True)
+
+
+def translate_document_file(input_path, output_path, translator):
+    """
+    翻译文档文件，输入文件每行一个段落，翻译结果逐行流式写入输出文件
+    @param input_path: 输入文件路径
+    @param output_path: 输出文件路径
+    @param translator: DocumentTranslator实例
+    """
+    start = time.time()
+    num_documents = 0
+    with open(input_path, encoding='UTF-8') as input_file, open(output_path, 'w', encoding='UTF-8') as output_file:
+        for translation in translator.translate_documents(line.rstrip('\n') for line in input_file):
+            output_file.write(translation + '\n')
+            num_documents += 1
+    print('已翻译%d个段落，用时%.2fs' % (num_documents, time.time() - start))
+
+
+def benchmark(sentences, worker_counts, chunk_size=64):
+    """
+    测试不同worker数量下的翻译吞吐量
+    @param sentences: 用于测试的句子列表
+    @param worker_counts: 需要测试的worker数量列表
+    @param chunk_size: 每次分发给worker的句子数量
+    @return: worker数量到句子/s的字典
+    """
+    num_cores = os.cpu_count() or 1
+    results = {}
+    for num_workers in worker_counts:
+        translator = DocumentTranslator(num_workers=num_workers, threads_per_worker=max(num_cores // max(worker_counts), 1),
+                                        chunk_size=chunk_size)
+        # 预热，确保各worker已完成模型加载
+        list(translator.translate_sentences(sentences[:chunk_size * num_workers]))
+        start = time.time()
+        list(translator.translate_sentences(sentences))
+        elapsed = time.time() - start
+        translator.close()
+
+        results[num_workers] = len(sentences) / elapsed
+        print('worker数量:%d - %.2f句/s - 加速比:%.2f' % (num_workers, results[num_workers],
+                                                     results[num_workers] / results[worker_counts[0]]))
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='多进程文档翻译')
+    parser.add_argument('--input', type=str, required=True, help='需要翻译的文档路径，每行一个段落')
+    parser.add_argument('--output', default='', type=str, required=False, help='翻译结果保存路径')
+    parser.add_argument('--num_workers', default=0, type=int, required=False, help='worker进程数，默认为CPU核数')
+    parser.add_argument('--chunk_size', default=64, type=int, required=False, help='每次分发给worker的句子数量')
+    parser.add_argument('--benchmark', action='store_true', help='测试1至num_workers个worker的吞吐量')
+    options = parser.parse_args()
+
+    num_workers = options.num_workers or os.cpu_count() or 1
+    if options.benchmark:
+        with open(options.input, encoding='UTF-8') as file:
+            sentences = [sentence for line in file for sentence in split_sentences(line)]
+        worker_counts = sorted({2 ** i for i in range(num_workers.bit_length())} | {num_workers})
+        benchmark(sentences, worker_counts, chunk_size=options.chunk_size)
+        return
+
+    output_path = options.output if options.output != '' else options.input + '.' + _config.target_lang
+    translator = DocumentTranslator(num_workers=num_workers, chunk_size=options.chunk_size)
+    translate_document_file(options.input, output_path, translator)
+    translator.close()
+    print('翻译结果已保存至：%s' % output_path)
+
+
+if __name__ == '__main__':
+    main()
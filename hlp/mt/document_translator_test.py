@@ -0,0 +1,23 @@
+from hlp.mt.document_translator import split_sentences
+
+
+def test_split_sentences():
+    """英文句末标点之后有空白才切分，中文句末标点之后直接切分，句末的右引号及右括号留在句子中"""
+    assert split_sentences('It costs 3.14 dollars. Buy it!  Why? ') == ['It costs 3.14 dollars.', 'Buy it!', 'Why?']
+    assert split_sentences('He said "stop." Then he left.') == ['He said "stop."', 'Then he left.']
+    assert split_sentences('今天下雨。“明天呢？”他问。') == ['今天下雨。', '“明天呢？”', '他问。']
+    assert split_sentences('   ') == []
+
+
+def test_split_sentences_abbreviation():
+    """常见缩写及以点分隔的首字母缩写之后不切分，单个字母结尾的句子照常切分"""
+    assert split_sentences('Mr. Smith is here. Dr. Lee too.') == ['Mr. Smith is here.', 'Dr. Lee too.']
+    assert split_sentences('Fruits, e.g. apples, are in the U.S. market.') == \
+        ['Fruits, e.g. apples, are in the U.S. market.']
+    assert split_sentences('So did I. Then we left.') == ['So did I.', 'Then we left.']
+    assert split_sentences('He got an A. It was great.') == ['He got an A.', 'It was great.']
+
+
+if __name__ == '__main__':
+    test_split_sentences()
+    test_split_sentences_abbreviation()
@@ -1,3 +1,6 @@
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
 from hlp.mt.common import bleu as _bleu
 from hlp.mt.common import load_dataset
@@ -7,33 +10,130 @@ from hlp.mt import translator
 
 
 # BLEU指标计算
-def _calc_bleu(path, transformer, tokenizer_source, tokenizer_target):
+def _calc_bleu(path, models, tokenizer_source, tokenizer_target, num_eval=_config.num_eval,
+               batch_size=_config.BATCH_SIZE, beam_size=1, chunk_size=512, show_sentences=False):
+    """
+    对验证文本批量翻译并计算语料级BLEU
+    文本按chunk_size个句子分块，解码在主线程进行，已翻译块的BLEU统计量在另一线程中计算，两者并行
+
+    @param path: 验证文本路径
+    @param models: 模型列表
+    @param tokenizer_source: 源语言字典
+    @param tokenizer_target: 目标语言字典
+    @param num_eval: 用于计算指标的句子对数量
+    @param batch_size: 翻译的batch大小
+    @param beam_size: beam大小
+    @param chunk_size: 每块句子数量
+    @param show_sentences: 是否打印每个句子的翻译结果
+    @return: 语料级BLEU
+    """
     # 读入文本
-    source_sentences, target_sentences = load_dataset.load_sentences(path, _config.num_eval)
+    source_sentences, target_sentences = load_dataset.load_sentences(path, num_eval)
+    target_sentences = [sentence.strip() for sentence in target_sentences]
 
     print('开始计算BLEU指标...')
-    bleu_sum = 0
-    for i in range(_config.num_eval):
-        candidate_sentence = translator.translate(source_sentences[i], transformer, tokenizer_source,
-                                                  tokenizer_target, beam_size=1)[0]
-        print('-' * 20)
-        print('第%d/%d个句子：' % (i + 1, _config.num_eval))
-        print('源句子:' + source_sentences[i].strip())
-        print('机翻句子:' + candidate_sentence)
-        print('参考句子:' + target_sentences[i])
-        bleu_i = _bleu.bleu_nltk(candidate_sentence, [target_sentences[i]], language=_config.target_lang)
-        print('此句子BLEU指标:%.2f' % bleu_i)
-        bleu_sum += bleu_i
-    bleu = bleu_sum / _config.num_eval
+    decode_time = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = []
+        for start in range(0, num_eval, chunk_size):
+            sources = source_sentences[start:start + chunk_size]
+            references = [[sentence] for sentence in target_sentences[start:start + chunk_size]]
+
+            decode_start = time.time()
+            candidates = translator.translate_batch(sources, models, tokenizer_source, tokenizer_target,
+                                                    batch_size=batch_size, beam_size=beam_size, verbose=False)
+            decode_time += time.time() - decode_start
+            futures.append(executor.submit(_bleu.corpus_statistics, candidates, references, _config.target_lang))
+
+            if show_sentences:
+                for i, (source, candidate, reference) in enumerate(zip(sources, candidates, references)):
+                    print('-' * 20)
+                    print('第%d/%d个句子：' % (start + i + 1, num_eval))
+                    print('源句子:' + source.strip())
+                    print('机翻句子:' + candidate)
+                    print('参考句子:' + reference[0])
+            print('\r已翻译%d/%d个句子' % (min(start + chunk_size, num_eval), num_eval), end='')
+
+        statistics = sum(future.result() for future in futures)
+
+    bleu = _bleu.bleu_from_statistics(statistics)
+    print()
+    print('-' * 20)
+    print('语料级BLEU指标为：%.2f' % bleu)
+    print('解码用时%.2fs，%.2f句/s，目标语言%.2f tokens/s'
+          % (decode_time, num_eval / decode_time, statistics[-2] / decode_time))
+    return bleu
+
+
+def compare_decoding(path, models, tokenizer_source, tokenizer_target, num_eval=_config.num_eval,
+                     batch_size=_config.BATCH_SIZE, beam_size=_config.BEAM_SIZE):
+    """
+    在验证文本上对比原有解码方式(最多解码max_target_length步、不进行长度惩罚、所有候选结束才停止)
+    与按源句子长度限制解码长度、长度惩罚及提前停止的解码方式，输出解码步数、节省的步数、BLEU及速度
+
+    @param path: 验证文本路径
+    @param models: 模型列表
+    @param tokenizer_source: 源语言字典
+    @param tokenizer_target: 目标语言字典
+    @param num_eval: 用于对比的句子数量
+    @param batch_size: 翻译的batch大小
+    @param beam_size: beam大小
+    @return: 各解码方式的结果字典列表
+    """
+    source_sentences, target_sentences = load_dataset.load_sentences(path, num_eval)
+    references = [[sentence.strip()] for sentence in target_sentences]
+    settings = (('原有解码', {'max_length_a': 0, 'length_penalty': 0.0, 'early_stop': False}),
+                ('长度限制', {'early_stop': False}),
+                ('长度限制+提前停止', {}))
+
+    results = []
+    for name, options in settings:
+        stats = {}
+        start = time.time()
+        candidates = translator.translate_batch(source_sentences, models, tokenizer_source, tokenizer_target,
+                                                batch_size=batch_size, beam_size=beam_size, verbose=False,
+                                                decode_options=dict(options, stats=stats))
+        elapsed = time.time() - start
+        results.append({'name': name, 'steps': stats['steps'], 'time': elapsed,
+                        'bleu': _bleu.corpus_bleu(candidates, references, _config.target_lang)})
+
+    baseline = results[0]
     print('-' * 20)
-    print('平均BLEU指标为：%.2f' % bleu)
+    print('最大解码长度：%g * 源句子长度 + %g (不超过%d)，长度惩罚alpha=%g'
+          % (_config.max_length_a, _config.max_length_b, _config.max_target_length, _config.length_penalty))
+    print('%-20s%10s%12s%10s%10s' % ('解码方式', '解码步数', '节省步数', '用时(s)', 'BLEU'))
+    for result in results:
+        print('%-20s%10d%12s%10.2f%10.2f' % (result['name'], result['steps'],
+                                             '%.1f%%' % ((1 - result['steps'] / baseline['steps']) * 100),
+                                             result['time'], result['bleu']))
+    return results
 
 
 def main():
-    if nmt_model.check_point():  # 检测是否有检查点
+    parser = ArgumentParser(description='在验证文本上批量翻译并计算语料级BLEU')
+    parser.add_argument('--num_eval', default=_config.num_eval, type=int, required=False, help='用于计算指标的句子对数量')
+    parser.add_argument('--batch_size', default=_config.BATCH_SIZE, type=int, required=False, help='批量翻译的batch大小')
+    parser.add_argument('--beam_size', default=1, type=int, required=False, help='beam大小')
+    parser.add_argument('--show_sentences', action='store_true', help='打印每个句子的翻译结果')
+    parser.add_argument('--ema', action='store_true', help='使用训练时维护的指数滑动平均权重')
+    parser.add_argument('--student', action='store_true', help='使用知识蒸馏(distill.py)得到的学生模型')
+    parser.add_argument('--pruned', action='store_true', help='使用结构化剪枝(prune.py)得到的模型')
+    parser.add_argument('--compare_decoding', action='store_true',
+                        help='对比原有解码方式与按源句子长度限制解码长度及提前停止的解码步数、BLEU及速度')
+    options = parser.parse_args()
+
+    # 检测是否有检查点
+    if nmt_model.check_point(nmt_model.get_checkpoint_dir(student=options.student, pruned=options.pruned)):
         # 读取保存的需要的配置
-        transformer, _, tokenizer_source, tokenizer_target = nmt_model.load_model()
-        _calc_bleu(_config.path_to_eval_file, transformer, tokenizer_source, tokenizer_target)
+        models, tokenizer_source, tokenizer_target = nmt_model.load_translate_models(
+            ema=options.ema, student=options.student, pruned=options.pruned)
+        if options.compare_decoding:
+            compare_decoding(_config.path_to_eval_file, models, tokenizer_source, tokenizer_target,
+                             num_eval=options.num_eval, batch_size=options.batch_size, beam_size=options.beam_size)
+            return
+        _calc_bleu(_config.path_to_eval_file, models, tokenizer_source, tokenizer_target,
+                   num_eval=options.num_eval, batch_size=options.batch_size, beam_size=options.beam_size,
+                   show_sentences=options.show_sentences)
     else:
         print('没有发现训练好的模型，请先训练模型.')
 
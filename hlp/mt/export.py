@@ -0,0 +1,277 @@
+"""
+将翻译模型导出为SavedModel
+编码、增量解码及beam search整个过程在图中的tf.while_loop内完成，自注意力使用定长缓存，
+导出的模型只依赖TensorFlow，可在不包含hlp源码的环境中加载：
+    translator = tf.saved_model.load(export_dir)
+    outputs = translator.signatures['translate'](source_ids=tf.constant(source_ids, tf.int32))
+outputs['target_ids']为不含开始token的目标语言编码序列，结束token之后以0填充
+最大解码长度、长度惩罚及提前停止与eager解码(translator._predict_index)相同，导出时固定为config.json中的设置
+源语言及目标语言字典文件一并复制到export_dir/assets.extra中，用于编码源句子及解码翻译结果
+"""
+import glob
+import os
+import shutil
+import time
+from argparse import ArgumentParser
+
+import numpy
+import tensorflow as tf
+
+from hlp.mt.config import get_config as _config
+from hlp.mt.model import nmt_model
+from hlp.mt.common import load_dataset
+from hlp.mt import preprocess
+from hlp.mt import translator
+
+
+class TranslatorModule(tf.Module):
+    """
+    包装已恢复检查点的模型，提供图模式的翻译函数
+    多于一个模型时与eager解码一致，在log概率上平均进行checkpoint_ensembling
+    """
+
+    def __init__(self, models, start_token, end_token, beam_size=_config.BEAM_SIZE,
+                 max_length=_config.max_target_length, max_length_a=_config.max_length_a,
+                 max_length_b=_config.max_length_b, length_penalty=_config.length_penalty, early_stop=True):
+        """
+        @param models: 已恢复检查点的模型列表
+        @param start_token: 目标语言开始token
+        @param end_token: 目标语言结束token
+        @param beam_size: translate签名使用的beam大小，translate_greedy签名固定为贪婪解码
+        @param max_length: 最大解码长度，即定长缓存的长度
+        @param max_length_a: 最大解码长度关于源句子长度的系数，不大于0时最大解码长度为max_length
+        @param max_length_b: 最大解码长度的常数项
+        @param length_penalty: 长度惩罚的alpha，为0时直接比较log概率之和
+        @param early_stop: 是否在没有未结束候选能超过已结束的最优候选时提前停止搜索
+        """
+        super(TranslatorModule, self).__init__()
+        self.models = models
+        self.beam_size = beam_size
+        self.max_length = max_length
+        self._max_length_a = max_length_a
+        self._max_length_b = max_length_b
+        self._length_penalty = length_penalty
+        self._early_stop = early_stop
+        self._start_token = start_token
+        self._end_token = end_token
+        # 解码参数随模型一起保存，供加载方查询
+        self.start_token = tf.Variable(start_token, trainable=False, dtype=tf.int32)
+        self.end_token = tf.Variable(end_token, trainable=False, dtype=tf.int32)
+        self.max_target_length = tf.Variable(max_length, trainable=False, dtype=tf.int32)
+        self.max_length_a = tf.Variable(max_length_a, trainable=False, dtype=tf.float32)
+        self.max_length_b = tf.Variable(max_length_b, trainable=False, dtype=tf.float32)
+        self.length_penalty = tf.Variable(length_penalty, trainable=False, dtype=tf.float32)
+        self.early_stop = tf.Variable(early_stop, trainable=False, dtype=tf.bool)
+
+    @tf.function(input_signature=[tf.TensorSpec([None, None], tf.int32, name='source_ids')])
+    def translate(self, source_ids):
+        """以beam search翻译一个batch的已编码源句子"""
+        return self._beam_search(source_ids, self.beam_size)
+
+    @tf.function(input_signature=[tf.TensorSpec([None, None], tf.int32, name='source_ids')])
+    def translate_greedy(self, source_ids):
+        """以贪婪解码翻译一个batch的已编码源句子"""
+        return self._beam_search(source_ids, 1)
+
+    def _beam_search(self, source_ids, beam_size):
+        """
+        图模式的beam search，逻辑与translator._predict_index一致，beam_size为1时即贪婪解码
+        各循环变量的shape在解码过程中保持不变：定长缓存按步写入，已解码的token写入定长的输出序列，
+        循环的步数由batch中最大的解码长度决定，各句子达到其解码长度或提前停止后只续接填充token
+        @param source_ids: 已编码的源句子 (batch_size, inp_seq_len)
+        @param beam_size: beam大小
+        @return: 字典，target_ids为得分最高的编码序列 (batch_size, max_length)，
+        scores为其长度惩罚后的得分 (batch_size,)，lengths为不含填充的序列长度 (batch_size,)
+        """
+        batch_size = tf.shape(source_ids)[0]
+        num_hypotheses = batch_size * beam_size
+        max_length = self.max_length
+
+        # 以reshape代替多个newaxis的切片，使导出的图可转换为TFLite的内置算子
+        enc_padding_mask = tf.reshape(tf.cast(tf.equal(source_ids, 0), tf.float32), [batch_size, 1, 1, -1])
+        source_indices = tf.repeat(tf.range(batch_size), beam_size)
+        memories = []
+        for model in self.models:
+            memory = model.compute_memory(model.encode(source_ids, enc_padding_mask))
+            memory, hypotheses_mask = model.gather_memory(memory, enc_padding_mask, source_indices)
+            memories.append(memory)
+        caches = [model.init_decode_cache(num_hypotheses, max_length=max_length) for model in self.models]
+
+        last_tokens = tf.fill([num_hypotheses], self._start_token)
+        target_ids = tf.zeros([num_hypotheses, max_length], dtype=tf.int32)
+        scores = tf.tile(tf.constant([[0.0] + [-1e9] * (beam_size - 1)]), [batch_size, 1])
+        finished = tf.zeros([batch_size, beam_size], dtype=tf.bool)  # 以结束token结束或已停止搜索的候选
+        ended = tf.zeros([batch_size, beam_size], dtype=tf.bool)  # 以结束token结束的候选
+        lengths = tf.zeros([batch_size, beam_size], dtype=tf.int32)  # 不含开始token及填充的候选长度
+        beam_offsets = tf.expand_dims(tf.range(batch_size) * beam_size, axis=1)
+        positions = tf.range(max_length)
+        max_lengths = translator._decode_budget(source_ids, self._max_length_a, self._max_length_b, max_length)
+        max_length_penalty = translator._length_penalty(max_lengths, self._length_penalty)[:, tf.newaxis]
+        num_steps = tf.reduce_max(max_lengths)
+
+        def cond(step, last_tokens, target_ids, scores, finished, ended, lengths, caches):
+            return tf.logical_and(step < num_steps, tf.logical_not(tf.reduce_all(finished)))
+
+        def body(step, last_tokens, target_ids, scores, finished, ended, lengths, caches):
+            log_probs_sum = 0
+            new_caches = []
+            for model, cache, memory in zip(self.models, caches, memories):
+                predictions, cache = model.decode_step(last_tokens[:, tf.newaxis], step, cache, memory,
+                                                       hypotheses_mask, fixed_cache=True)
+                log_probs_sum += tf.nn.log_softmax(predictions, axis=-1)
+                new_caches.append(cache)
+            log_probs = log_probs_sum / len(self.models)
+            vocab_size = log_probs.shape[-1]
+            log_probs = tf.reshape(log_probs, (batch_size, beam_size, vocab_size))
+
+            # 已结束的候选只能以0分续接填充token
+            pad_only = tf.one_hot(0, vocab_size, on_value=0.0, off_value=-1e9)
+            log_probs = tf.where(finished[:, :, tf.newaxis], pad_only, log_probs)
+
+            total_scores = tf.reshape(scores[:, :, tf.newaxis] + log_probs, (batch_size, beam_size * vocab_size))
+            scores, top_indices = tf.math.top_k(total_scores, k=beam_size)
+            parent_indices = tf.reshape(top_indices // vocab_size + beam_offsets, [-1])
+            tokens = tf.cast(top_indices % vocab_size, tf.int32)
+            last_tokens = tf.reshape(tokens, [-1])
+
+            target_ids = tf.where(tf.equal(positions, step)[tf.newaxis, :], last_tokens[:, tf.newaxis],
+                                  tf.gather(target_ids, parent_indices))
+            new_caches = [model.reorder_cache(cache, parent_indices)
+                          for model, cache in zip(self.models, new_caches)]
+            parent_finished = tf.reshape(tf.gather(tf.reshape(finished, [-1]), parent_indices),
+                                         [batch_size, beam_size])
+            lengths = tf.reshape(tf.gather(tf.reshape(lengths, [-1]), parent_indices), [batch_size, beam_size]) \
+                + tf.cast(tf.logical_not(parent_finished), tf.int32)
+            ended = tf.logical_or(tf.reshape(tf.gather(tf.reshape(ended, [-1]), parent_indices),
+                                             [batch_size, beam_size]),
+                                  tf.equal(tokens, self._end_token))
+            finished = tf.logical_or(parent_finished, tf.equal(tokens, self._end_token))
+            # 与eager解码相同：达到最大解码长度或没有未结束候选能超过已结束的最优候选时停止该句子的搜索
+            stopped = tf.greater_equal(step + 1, max_lengths)
+            if self._early_stop:
+                best_ended = tf.reduce_max(
+                    tf.where(ended, scores / translator._length_penalty(lengths, self._length_penalty), -numpy.inf),
+                    axis=-1)
+                live_bound = tf.reduce_max(tf.where(finished, -numpy.inf, scores / max_length_penalty), axis=-1)
+                stopped = tf.logical_or(stopped, tf.greater_equal(best_ended, live_bound))
+            finished = tf.logical_or(finished, stopped[:, tf.newaxis])
+            return step + 1, last_tokens, target_ids, scores, finished, ended, lengths, new_caches
+
+        _, _, target_ids, scores, _, ended, lengths, _ = tf.while_loop(
+            cond, body, (tf.constant(0), last_tokens, target_ids, scores, finished, ended, lengths, caches))
+
+        # 以长度惩罚后的得分选择候选，句子中有以结束token结束的候选时只在其中选择
+        scores = scores / translator._length_penalty(lengths, self._length_penalty)
+        scores = tf.where(tf.logical_or(ended, tf.logical_not(tf.reduce_any(ended, axis=-1, keepdims=True))),
+                          scores, -numpy.inf)
+        best = tf.argmax(scores, axis=-1, output_type=tf.int32)
+        target_ids = tf.gather(target_ids, tf.reshape(best[:, tf.newaxis] + beam_offsets, [-1]))
+        return {'target_ids': target_ids,
+                'scores': tf.gather(scores, best, batch_dims=1),
+                'lengths': tf.math.count_nonzero(target_ids, axis=-1, dtype=tf.int32)}
+
+
+def _copy_tokenizers(export_dir):
+    """将源语言及目标语言字典文件复制到导出目录的assets.extra中"""
+    assets_dir = os.path.join(export_dir, 'assets.extra')
+    os.makedirs(assets_dir, exist_ok=True)
+    for language in (_config.source_lang, _config.target_lang):
+        tokenizer_path = preprocess.get_tokenizer_path(language, preprocess.get_tokenizer_mode(language))
+        for path in glob.glob(tokenizer_path + '*'):
+            shutil.copy(path, assets_dir)
+
+
+def export(export_dir, models, tokenizer_target, beam_size=_config.BEAM_SIZE):
+    """
+    将模型导出为带translate及translate_greedy签名的SavedModel
+    @param export_dir: 导出目录
+    @param models: 已恢复检查点的模型列表
+    @param tokenizer_target: 目标语言字典，用于确定开始及结束token
+    @param beam_size: translate签名使用的beam大小
+    @return: 导出的模块
+    """
+    start_token, end_token = translator._get_special_tokens(tokenizer_target)
+    module = TranslatorModule(models, start_token, end_token, beam_size=beam_size)
+    # 在eager模式下先解码一步，使模型的变量在追踪图之前创建好
+    translator._predict_index(models, tf.constant([[1]]), start_token, end_token, 1)
+
+    signatures = {'translate': module.translate.get_concrete_function(),
+                  'translate_greedy': module.translate_greedy.get_concrete_function()}
+    tf.saved_model.save(module, export_dir, signatures=signatures)
+    print('模型已导出至：%s' % export_dir)
+    return module
+
+
+def benchmark(export_dir, models, tokenizer_source, tokenizer_target, num_sentences=_config.num_eval,
+              batch_size=_config.BATCH_SIZE, beam_size=_config.BEAM_SIZE):
+    """
+    在验证文本上对比导出的SavedModel与eager解码的速度，并检查两者的解码结果是否一致
+    SavedModel由tf.saved_model.load加载，不依赖hlp中的模型代码
+    @param export_dir: 导出目录
+    @param models: eager解码使用的模型列表
+    @param tokenizer_source: 源语言字典
+    @param tokenizer_target: 目标语言字典
+    @param num_sentences: 用于测试的句子数量
+    @param batch_size: batch大小
+    @param beam_size: beam大小，需与导出时一致
+    """
+    source_sentences, _ = load_dataset.load_sentences(_config.path_to_eval_file, num_sentences)
+    sequences, lengths = translator._encode_sources(source_sentences, tokenizer_source)
+    order = numpy.argsort(lengths, kind='stable')
+    batches = []
+    for i in range(0, len(order), batch_size):
+        batch_order = order[i:i + batch_size]
+        batches.append(tf.constant(sequences[batch_order, :max(int(lengths[batch_order].max()), 1)]))
+
+    start_token, end_token = translator._get_special_tokens(tokenizer_target)
+    saved_translate = tf.saved_model.load(export_dir).signatures['translate' if beam_size > 1 else 'translate_greedy']
+    # 预热，排除图的首次执行开销
+    saved_translate(source_ids=batches[0])
+    translator._predict_index(models, batches[0], start_token, end_token, beam_size)
+
+    start = time.time()
+    eager_results = [translator._predict_index(models, batch, start_token, end_token, beam_size)
+                     for batch in batches]
+    eager_time = time.time() - start
+
+    start = time.time()
+    saved_results = [saved_translate(source_ids=batch)['target_ids'] for batch in batches]
+    saved_time = time.time() - start
+
+    num_same = 0
+    for eager_idxes, saved_idxes in zip(eager_results, saved_results):
+        for eager_idx, saved_idx in zip(eager_idxes.numpy(), saved_idxes.numpy()):
+            eager_idx = eager_idx[1:]  # 去掉开始token
+            saved_idx = saved_idx[:len(eager_idx)]
+            num_same += int(numpy.array_equal(eager_idx, saved_idx))
+
+    print('eager解码：用时%.2fs，%.2f句/s' % (eager_time, len(order) / eager_time))
+    print('SavedModel解码：用时%.2fs，%.2f句/s，加速%.2f倍' % (saved_time, len(order) / saved_time,
+                                                    eager_time / saved_time))
+    print('解码结果一致的句子：%d/%d' % (num_same, len(order)))
+
+
+def main():
+    parser = ArgumentParser(description='将翻译模型导出为图模式解码的SavedModel')
+    parser.add_argument('--export_dir', default='./data/saved_model', type=str, required=False, help='导出目录')
+    parser.add_argument('--beam_size', default=_config.BEAM_SIZE, type=int, required=False,
+                        help='translate签名使用的beam大小')
+    parser.add_argument('--ema', action='store_true', help='使用训练时维护的指数滑动平均权重')
+    parser.add_argument('--benchmark', action='store_true', help='导出后在验证文本上与eager解码对比速度')
+    parser.add_argument('--num_sentences', default=_config.num_eval, type=int, required=False,
+                        help='速度对比使用的句子数量')
+    options = parser.parse_args()
+
+    if nmt_model.check_point():  # 检测是否有检查点
+        models, tokenizer_source, tokenizer_target = nmt_model.load_translate_models(ema=options.ema)
+        export(options.export_dir, models, tokenizer_target, beam_size=options.beam_size)
+        _copy_tokenizers(options.export_dir)
+        if options.benchmark:
+            benchmark(options.export_dir, models, tokenizer_source, tokenizer_target,
+                      num_sentences=options.num_sentences, beam_size=options.beam_size)
+    else:
+        print('没有发现训练好的模型，请先训练模型.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import numpy
+import tensorflow as tf
+
+from hlp.mt.model import transformer as _transformer
+from hlp.utils.beamsearch import BeamSearch
+
+
+def _small_model():
+    """随机初始化的小模型，编码器与解码器层数不同以覆盖深编码器、浅解码器结构"""
+    tf.random.set_seed(0)
+    return _transformer.Transformer(num_layers=2, d_model=16, num_heads=4, dff=32, input_vocab_size=20,
+                                    target_vocab_size=30, pe_input=50, pe_target=50, num_decoder_layers=1)
+
+
+def _sample_batch():
+    """两个源句子，第二个带填充，使编码器填充遮挡参与计算"""
+    inp = tf.constant([[1, 5, 7, 9, 2], [1, 4, 2, 0, 0]])
+    tar = tf.constant([[1, 3, 8, 11, 6, 2], [1, 12, 4, 2, 0, 0]])
+    return inp, tar
+
+
+def _full_logits(model, inp, tar):
+    """整个目标序列一次性输入的logits (batch_size, tar_seq_len, target_vocab_size)"""
+    enc_padding_mask, combined_mask, dec_padding_mask = _transformer.create_masks(inp, tar)
+    logits, _ = model(inp, tar, False, enc_padding_mask, combined_mask, dec_padding_mask)
+    return logits.numpy()
+
+
+def _step_logits(model, inp, tar, max_length=None, permutation=None):
+    """
+    逐步调用decode_step得到各时间步的logits
+    @param max_length: 给出时使用定长缓存(导出模型的while_loop所用方式)
+    @param permutation: 给出时每步之后按该排列用reorder_cache重排缓存，下一步的输入也随之重排，模拟beam重排
+    @return: 各时间步的logits，按原batch顺序排列 (batch_size, tar_seq_len, target_vocab_size)
+    """
+    enc_padding_mask, _, dec_padding_mask = _transformer.create_masks(inp, tar[:, :1])
+    memory = model.compute_memory(model.encode(inp, enc_padding_mask))
+    cache = model.init_decode_cache(inp.shape[0], max_length)
+    order = numpy.arange(inp.shape[0])  # 缓存batch维的每一行对应的原句子下标
+    outputs = []
+    for step in range(tar.shape[1]):
+        memory_step, mask_step = _transformer.Transformer.gather_memory(memory, dec_padding_mask, order)
+        logits, cache = model.decode_step(tf.gather(tar, order)[:, step:step + 1], step, cache, memory_step,
+                                          mask_step, fixed_cache=max_length is not None)
+        restored = numpy.empty_like(logits.numpy())
+        restored[order] = logits.numpy()
+        outputs.append(restored)
+        if permutation is not None:
+            cache = _transformer.Transformer.reorder_cache(cache, permutation)
+            order = order[permutation]
+    return numpy.stack(outputs, axis=1)
+
+
+def _assert_close(expected, actual, tar, name):
+    # 目标序列填充位置的输出不参与比较：完整解码遮挡填充的token，增量解码时解码结束后不再有填充输入
+    error = numpy.abs(expected - actual)[tar.numpy() != 0].max()
+    assert error < 1e-4, '%s与完整解码的logits不一致，最大误差%g' % (name, error)
+    print('%s：最大误差%g' % (name, error))
+
+
+def test_growing_cache():
+    """追加式缓存的增量解码与完整解码的logits一致"""
+    model = _small_model()
+    inp, tar = _sample_batch()
+    expected = _full_logits(model, inp, tar)
+    actual = _step_logits(model, inp, tar)
+    _assert_close(expected, actual, tar, '追加式缓存')
+
+
+def test_fixed_cache():
+    """定长缓存(导出模型所用)的增量解码与完整解码的logits一致，缓存长度大于目标序列长度时也是如此"""
+    model = _small_model()
+    inp, tar = _sample_batch()
+    expected = _full_logits(model, inp, tar)
+    _assert_close(expected, _step_logits(model, inp, tar, max_length=tar.shape[1]), tar, '定长缓存')
+    _assert_close(expected, _step_logits(model, inp, tar, max_length=tar.shape[1] + 4), tar, '更长的定长缓存')
+
+
+def test_reorder_cache():
+    """每步按beam重排缓存后，各句子的logits仍与完整解码一致"""
+    model = _small_model()
+    inp, tar = _sample_batch()
+    expected = _full_logits(model, inp, tar)
+    permutation = numpy.array([1, 0])
+    _assert_close(expected, _step_logits(model, inp, tar, permutation=permutation), tar, '追加式缓存重排')
+    _assert_close(expected, _step_logits(model, inp, tar, max_length=tar.shape[1], permutation=permutation),
+                  tar, '定长缓存重排')
+
+
+def test_beam_search_reduce_end():
+    """相邻的两个候选同时遇到结束符时都被移出，不会跳过其后的候选"""
+    end_sign = 2
+    beam_search = BeamSearch(beam_size=3, max_length=10, worst_score=0)
+    beam_search.reset(tf.constant([[1, 5, 2]]), tf.constant([[1]]))
+    beam_search.get_candidates()
+    # 第一步得到[1, 3]、[1, 4]、[1, 5]三个候选
+    beam_search.expand(tf.constant([[0.0, 0.0, 0.0, 0.5, 0.3, 0.2]]), end_sign)
+    beam_search.get_candidates()
+    # 前两个候选扩展结束符后在候选列表中相邻，第三个扩展token 3
+    beam_search.expand(tf.constant([[0.0, 0.0, 0.9, 0.06, 0.02, 0.02],
+                                    [0.0, 0.0, 0.9, 0.06, 0.02, 0.02],
+                                    [0.0, 0.0, 0.02, 0.9, 0.06, 0.02]]), end_sign)
+    ended = sorted(dec.numpy()[0].tolist() for _, dec in beam_search.result)
+    remaining = [dec.numpy()[0].tolist() for _, dec in beam_search.candidates]
+    assert ended == [[1, 3, 2], [1, 4, 2]], ended
+    assert remaining == [[1, 5, 3]], remaining
+    assert beam_search.beam_size == 1
+    assert len(beam_search.candidates_plus) == 1
+    print('BeamSearch._reduce_end：结束的候选%s，剩余候选%s' % (ended, remaining))
+
+
+if __name__ == '__main__':
+    test_growing_cache()
+    test_fixed_cache()
+    test_reorder_cache()
+    test_beam_search_reduce_end()
@@ -8,47 +8,70 @@ from hlp.mt.config import get_config as _config
 
 class LanguageModel(tf.keras.Model):
     """
-    语言模型，将input输入
+    语言模型，两层LSTM，状态由调用方显式传入及取出
+    每层为tf.keras.layers.LSTM，整个序列在一个融合的循环算子中计算，可由GPU上的cuDNN实现加速
     """
 
-    def __init__(self, vocab_size, d_embedding, batch_size, d_rnn):
+    def __init__(self, vocab_size, d_embedding, d_rnn):
         super(LanguageModel, self).__init__()
         # 初始参数
-        self.batch_size = batch_size
+        self.vocab_size = vocab_size
         self.d_rnn = d_rnn
         self.d_embedding = d_embedding
         self.embedding = tf.keras.layers.Embedding(vocab_size+1, d_embedding)
-        self.state0 = [tf.zeros([batch_size, d_rnn]), tf.zeros([batch_size, d_rnn])]
-        self.state1 = [tf.zeros([batch_size, d_rnn]), tf.zeros([batch_size, d_rnn])]
 
-        self.cell0 = tf.keras.layers.LSTMCell(d_rnn)
-        self.cell1 = tf.keras.layers.LSTMCell(d_rnn)
+        self.rnn0 = tf.keras.layers.LSTM(d_rnn, return_sequences=True, return_state=True)
+        self.rnn1 = tf.keras.layers.LSTM(d_rnn, return_sequences=True, return_state=True)
+        # cell0/cell1与LSTM层共享权重，仅供lm_train._unrolled_forward在吞吐量测试中逐步计算作对比
+        self.cell0 = self.rnn0.cell
+        self.cell1 = self.rnn1.cell
 
-        self.output_layer = tf.keras.layers.Dense(vocab_size)
+        # 字典编码从1开始，输出层需包含下标vocab_size
+        self.output_layer = tf.keras.layers.Dense(vocab_size + 1)
 
-    def call(self, sequences):
+    def initial_states(self, batch_size):
+        """返回给定batch大小的全零初始状态"""
+        return ([tf.zeros([batch_size, self.d_rnn]), tf.zeros([batch_size, self.d_rnn])],
+                [tf.zeros([batch_size, self.d_rnn]), tf.zeros([batch_size, self.d_rnn])])
+
+    def _forward(self, sequences, states):
+        """从给定状态开始计算整个序列，返回预测序列及最终状态"""
+        state0, state1 = states
+        sequences = self.embedding(sequences)  # shape ---> (batch_size, seq_len, d_embedding)
+        sequences *= tf.math.sqrt(tf.cast(self.d_embedding, tf.float32))
+        out0, *state0 = self.rnn0(sequences, initial_state=state0)  # out0.shape --> (batch_size, seq_len, d_rnn)
+        out1, *state1 = self.rnn1(out0, initial_state=state1)
+        predictions = self.output_layer(out1)  # prediction.shape --> (batch_size, seq_len, vocab_size)
+        return predictions, (state0, state1)
+
+    def step(self, tokens, states):
+        """
+        增量计算一步，只输入每个候选最新的token，历史token的信息已包含在状态中
+        @param tokens: 最新的token (batch_size,)
+        @param states: 各候选的状态(state0, state1)
+        @return: 下一个token的log概率 (batch_size, vocab_size + 1)，更新后的状态
+        """
+        predictions, states = self._forward(tokens[:, tf.newaxis], states)
+        return tf.nn.log_softmax(predictions[:, 0], axis=-1), states
+
+    @staticmethod
+    def reorder_states(states, indices):
+        """按beam search选出的父候选下标重排各候选的状态"""
+        return tf.nest.map_structure(lambda state: tf.gather(state, indices), states)
+
+    def call(self, sequences, states=None, return_states=False):
         """
         传入已编码的句子,shape ---> (batch_size, seq_len)
-        返回预测序列
+        states为None时从全零状态开始计算，否则从给定状态开始计算
+        返回预测序列，return_states为True时一并返回最终状态，用于截断反向传播时在相邻的块间传递状态
         """
-        output = []
-        sequences = self.embedding(sequences)  # shape ---> (batch_size, seq_len, vocab_size)
-        sequences *= tf.math.sqrt(tf.cast(self.d_embedding, tf.float32))
-        # output 为输出的字符列表，每个列表元素shape --> (batch_size, vocab_size)
-        for sequences_t in tf.unstack(sequences, axis=1):  # sequences_t.shape --> (batch_size, vocab_size)
-            out0, self.state0 = self.cell0(sequences_t, self.state0)  # out0.shape --> (batch_size, vocab_size)
-            out1, self.state1 = self.cell1(out0, self.state1)
-            out1 = self.output_layer(out1)
-            output.append(out1)
-
-        predictions = tf.stack(output, axis=1)  # prediction.shape --> (batch_size, seq_len, vocab_size)
+        if states is None:
+            states = self.initial_states(tf.shape(sequences)[0])
+        predictions, states = self._forward(sequences, states)
+        if return_states:
+            return predictions, states
         return predictions
 
-    def reset_states(self):
-        super(LanguageModel, self).reset_states()
-        self.state0 = [tf.zeros([self.batch_size, self.d_rnn]), tf.zeros([self.batch_size, self.d_rnn])]
-        self.state1 = [tf.zeros([self.batch_size, self.d_rnn]), tf.zeros([self.batch_size, self.d_rnn])]
-
 
 def check_point():
     """
@@ -62,3 +85,19 @@ def check_point():
     if_ckpt = tf.io.gfile.listdir(checkpoint_dir)
     return if_ckpt
 
+
+def check_checkpoint(model, checkpoint_path):
+    """
+    检查检查点的输出层是否与模型一致
+    旧版本的输出层为vocab_size维，不含下标vocab_size，其检查点无法恢复至当前的模型，
+    恢复被延迟到首次调用时才会报出难以理解的shape错误，因此在恢复前检查
+    @param model: 语言模型
+    @param checkpoint_path: 检查点路径，为None时不检查
+    """
+    if checkpoint_path is None:
+        return
+    for name, shape in tf.train.list_variables(checkpoint_path):
+        if name.startswith('language_model/output_layer/kernel/') and shape[-1] != model.vocab_size + 1:
+            raise ValueError("检查点 %s 的输出层为%d维，当前语言模型的输出层为%d维(字典大小+1)，"
+                             "该检查点由旧版本的语言模型训练得到，请删除 %s 中的检查点后重新运行lm_train.py训练语言模型"
+                             % (checkpoint_path, shape[-1], model.vocab_size + 1, os.path.dirname(checkpoint_path)))
@@ -2,7 +2,7 @@ import tensorflow as tf
 import numpy
 from sklearn.model_selection import train_test_split
 
-from hlp.mt.common import load_dataset, text_vectorize, text_split
+from hlp.mt.common import load_dataset, text_vectorize, text_split, encoded_corpus
 from hlp.mt.config import get_config as _config
 
 
@@ -55,16 +55,46 @@ def train_preprocess():
     return tokenizer, vocab_size, max_sequence_length
 
 
-def get_dataset(sequences_path, train_size=_config.lm_train_size):
-    """加载并划分数据集
+def _to_lanes(tokens, offsets, indices, batch_size):
+    """
+    将给定句子按顺序首尾相接为连续的token流，再切分为batch_size条等长的通道，每条通道为流中连续的一段
+    @return: (batch_size, lane_length)
     """
-    tensor = numpy.loadtxt(sequences_path, dtype='int32')
+    stream = numpy.concatenate([tokens[offsets[i]:offsets[i + 1]] for i in indices]).astype('int32')
+    lane_length = len(stream) // batch_size
+    return stream[:lane_length * batch_size].reshape(batch_size, lane_length)
 
-    train_dataset, val_dataset = train_test_split(tensor, train_size=train_size)
-    train_dataset = tf.data.Dataset.from_tensor_slices(train_dataset)
-    train_dataset = train_dataset.shuffle(_config.lm_BATCH_SIZE).batch(_config.lm_BATCH_SIZE, drop_remainder=True)
-    val_dataset = tf.data.Dataset.from_tensor_slices(val_dataset)
-    val_dataset = val_dataset.shuffle(_config.lm_BATCH_SIZE).batch(_config.lm_BATCH_SIZE, drop_remainder=True)
 
-    return train_dataset, val_dataset
+def _chunk_dataset(lanes, bptt_length):
+    """
+    按截断反向传播的长度将各通道依次切分为相邻的块，目标为输入右移一个token
+    块之间不打乱，第i个batch中每条通道紧接第i-1个batch中同一通道，训练时将上一块的最终状态作为下一块的初始状态
+    """
+    def generator():
+        for start in range(0, lanes.shape[1] - 1, bptt_length):
+            end = min(start + bptt_length, lanes.shape[1] - 1)
+            yield lanes[:, start:end], lanes[:, start + 1:end + 1]
+
+    return tf.data.Dataset.from_generator(generator, output_types=(tf.int32, tf.int32),
+                                          output_shapes=(tf.TensorShape([lanes.shape[0], None]),
+                                                         tf.TensorShape([lanes.shape[0], None])))
 
+
+def get_dataset(sequences_path, train_size=_config.lm_train_size, batch_size=_config.lm_BATCH_SIZE,
+                bptt_length=_config.lm_bptt_length):
+    """加载并划分数据集
+    按句子划分训练集及验证集后，各自将句子连接为连续的token流并切分为batch_size条通道，按bptt_length分块
+
+    @param sequences_path: 已编码句子路径
+    @param train_size: 训练集比例
+    @param batch_size: 通道数量
+    @param bptt_length: 截断反向传播的长度
+    @return: 训练集，验证集，每个元素为(输入块, 目标块)，shape均为 (batch_size, <=bptt_length)
+    """
+    tokens, offsets = encoded_corpus.load(sequences_path, mmap=False)
+    train_indices, val_indices = train_test_split(numpy.arange(encoded_corpus.num_sentences(offsets)),
+                                                  train_size=train_size)
+
+    train_dataset = _chunk_dataset(_to_lanes(tokens, offsets, train_indices, batch_size), bptt_length)
+    val_dataset = _chunk_dataset(_to_lanes(tokens, offsets, val_indices, batch_size), bptt_length)
+    return train_dataset, val_dataset
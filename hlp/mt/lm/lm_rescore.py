@@ -1,35 +1,90 @@
 import os
 
+import numpy
 import tensorflow as tf
 from pathlib import Path
 
 from hlp.mt.config import get_config as _config
-from hlp.mt.common import text_vectorize
-from hlp.mt.lm import language_model
+from hlp.mt.common import text_vectorize, text_split
+from hlp.mt.lm import language_model, lm_preprocess
 
 
-def sentence_rescore(sentences, model, tokenizer):
-    """给句子列表打分
+def _score_sequences(model, sequences):
+    """
+    对一个batch的已编码句子进行一次前向计算，取出每个位置实际token的log概率并按掩码求和
+
+    @param model: 语言模型实例
+    @param sequences: 已编码的句子 (batch_size, seq_len)，以0填充
+    @return: 每个句子的log概率之和 (batch_size,)
+    """
+    seq_input = sequences[:, :-1]
+    seq_real = sequences[:, 1:]
+    predictions = model(seq_input, states=model.initial_states(sequences.shape[0]))  # (batch_size, seq_len, vocab_size)
+    log_probs = tf.nn.log_softmax(predictions, axis=-1)
+    token_log_probs = tf.gather(log_probs, seq_real, batch_dims=2)  # (batch_size, seq_len)
+    mask = tf.cast(tf.not_equal(seq_real, 0), token_log_probs.dtype)
+    return tf.reduce_sum(token_log_probs * mask, axis=-1)
+
 
-    @param sentences: 需要进行打分的句子列表
+def sentence_rescore(sentences, model, tokenizer, batch_size=_config.lm_BATCH_SIZE):
+    """批量给句子列表打分
+    句子按长度排序后分batch填充，每个batch只进行一次前向计算
+
+    @param sentences: 需要进行打分的句子列表(未经过预处理)
     @param model: 打分使用的语言模型实例
     @param tokenizer: 字典
+    @param batch_size: 每个batch的句子数量
+    @return: 每个句子的log概率之和列表
     """
     language = _config.lm_language
     mode = _config.lm_tokenize_type
+    if len(sentences) == 0:
+        return []
+
+    sentences = text_split.preprocess_sentences(sentences, language, mode)
+    sequences, _ = text_vectorize.encode_sentences(sentences, tokenizer, language, mode)
+    sequences = numpy.asarray(sequences, dtype='int32')
+    lengths = numpy.count_nonzero(sequences, axis=1)
+    order = numpy.argsort(lengths, kind='stable')
+
+    scores = numpy.zeros(len(sentences), dtype='float32')
+    for i in range(0, len(order), batch_size):
+        batch_order = order[i:i + batch_size]
+        batch = tf.constant(sequences[batch_order, :max(int(lengths[batch_order].max()), 2)])
+        scores[batch_order] = _score_sequences(model, batch).numpy()
+    return scores.tolist()
+
 
-    scores_list = []
-    for i, sentence in enumerate(sentences):
-        score = 0
-        sequence = text_vectorize.encode_sentences([sentence], tokenizer, language, mode)
-        seq_input = sequence[:, :-1]
-        seq_real = sequence[:, 1:]
-        prediction = model(seq_input)  # (1, seq_len, vocab_size)
-        for j in range(prediction.shape[0]):
-            score += prediction[seq_real[0][j]]
-        scores_list.append(score)
+def nbest_rescore(nbest_lists, model, tokenizer, batch_size=_config.lm_BATCH_SIZE):
+    """给多个句子的n-best列表打分，所有候选合并后批量打分
 
-    return scores_list
+    @param nbest_lists: n-best列表的列表，每个n-best列表为一个源句子的候选翻译
+    @param model: 打分使用的语言模型实例
+    @param tokenizer: 字典
+    @param batch_size: 每个batch的句子数量
+    @return: 与nbest_lists结构一致的分数列表
+    """
+    flat_scores = sentence_rescore([sentence for nbest in nbest_lists for sentence in nbest],
+                                   model, tokenizer, batch_size)
+    scores = []
+    start = 0
+    for nbest in nbest_lists:
+        scores.append(flat_scores[start:start + len(nbest)])
+        start += len(nbest)
+    return scores
+
+
+def load_language_model():
+    """加载语言模型及其字典，用于翻译时的重打分
+
+    @return: 语言模型，字典
+    """
+    mode = _config.lm_tokenize_type
+    tokenizer_path = lm_preprocess.get_tokenizer_path(_config.lm_language, mode)
+    tokenizer, vocab_size = text_vectorize.load_tokenizer(tokenizer_path, _config.lm_language, mode)
+    model = language_model.LanguageModel(vocab_size, _config.lm_d_embedding, _config.lm_d_rnn)
+    load_checkpoint(model)
+    return model, tokenizer
 
 
 def load_checkpoint(model, checkpoint_path=None):
@@ -43,15 +98,17 @@ def load_checkpoint(model, checkpoint_path=None):
         is_exist = Path(checkpoint_dir)
     else:
         checkpoint_dir = os.path.dirname(checkpoint_path)
-        is_exist = Path(checkpoint_path)
+        is_exist = Path(checkpoint_path + '.index')  # 检查点路径为文件名前缀
 
     ckpt = tf.train.Checkpoint(language_model=model, optimizer=tf.keras.optimizers.Adam())
     ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_dir, max_to_keep=_config.max_checkpoints_num)
     if not is_exist.exists():
-        ValueError("路径 %s 不存在" % checkpoint_path)
+        raise ValueError("路径 %s 不存在" % (checkpoint_path or checkpoint_dir))
     elif checkpoint_path is None:
         if language_model.check_point():
+            language_model.check_checkpoint(model, ckpt_manager.latest_checkpoint)
             ckpt.restore(ckpt_manager.latest_checkpoint)
             print('已恢复至最新检查点！')
     else:
+        language_model.check_checkpoint(model, checkpoint_path)
         ckpt.restore(checkpoint_path)
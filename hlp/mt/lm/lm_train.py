@@ -1,54 +1,89 @@
 import time
+from argparse import ArgumentParser
 
+import numpy
 import tensorflow as tf
 
 from hlp.mt.config import get_config as _config
+from hlp.mt.common import encoded_corpus
 from hlp.mt.lm import language_model, lm_preprocess
 from hlp.utils import optimizers
 from hlp.utils import train_history
 
 
-def _train_step(sequences, lm, optimizer, train_loss, train_accuracy):
-    """一个训练步
-    @param sequences: 已编码的一个batch的数据集  shape --> (batch_size, seq_length)
-    @param lm: 语言模型实例
-    @param optimizer: 优化器
-    """
-    seq_input = sequences[:, :-1]
-    seq_real = sequences[:, 1:]
-
-    with tf.GradientTape() as tape:
-        predictions = lm(seq_input)
-        loss = optimizers.loss_func_mask(seq_real, predictions)
-
-    gradients = tape.gradient(loss, lm.trainable_variables)
-    optimizer.apply_gradients(zip(gradients, lm.trainable_variables))
+def _state_signature(lm, batch_size):
+    """语言模型状态的TensorSpec，与initial_states的结构一致"""
+    spec = [tf.TensorSpec([batch_size, lm.d_rnn], tf.float32)] * 2
+    return spec, spec
 
-    train_loss(loss)
-    train_accuracy(seq_real, predictions)
 
-
-def _train_epoch(dataset, model, optimizer, train_loss, train_accuracy, sample_sum):
+def _make_train_step(lm, optimizer, train_loss, train_accuracy, batch_size):
+    """
+    创建tf.function编译的训练步
+    以固定的输入签名编译，最后一个较短的块不会触发重新编译
     """
-    对dataset进行训练并打印相关信息
+    @tf.function(input_signature=[tf.TensorSpec([batch_size, None], tf.int32),
+                                  tf.TensorSpec([batch_size, None], tf.int32),
+                                  _state_signature(lm, batch_size)])
+    def train_step(seq_input, seq_real, states):
+        """一个训练步
+        @param seq_input: 各通道的一块输入  shape --> (batch_size, <=bptt_length)
+        @param seq_real: 输入右移一个token的目标
+        @param states: 上一块的最终状态，梯度不经过该状态向前传播，即截断反向传播
+        @return: 本块的最终状态
+        """
+        with tf.GradientTape() as tape:
+            predictions, states = lm(seq_input, states=states, return_states=True)
+            loss = optimizers.loss_func_mask(seq_real, predictions)
+
+        gradients = tape.gradient(loss, lm.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, lm.trainable_variables))
+
+        train_loss(loss)
+        train_accuracy(seq_real, predictions)
+        return states
+
+    return train_step
+
+
+def _make_eval_step(lm, val_loss, val_accuracy, batch_size):
+    """创建tf.function编译的验证步，不更新权重"""
+    @tf.function(input_signature=[tf.TensorSpec([batch_size, None], tf.int32),
+                                  tf.TensorSpec([batch_size, None], tf.int32),
+                                  _state_signature(lm, batch_size)])
+    def eval_step(seq_input, seq_real, states):
+        predictions, states = lm(seq_input, states=states, return_states=True)
+        val_loss(optimizers.loss_func_mask(seq_real, predictions))
+        val_accuracy(seq_real, predictions)
+        return states
+
+    return eval_step
+
+
+def _run_epoch(dataset, step, lm, loss, accuracy, batch_size):
     """
-    trained_seq_sum = 0
-    for batch, sequences in enumerate(dataset):
-        _train_step(sequences, model, optimizer, train_loss, train_accuracy)
-        trained_seq_sum += _config.lm_BATCH_SIZE
-        print('\r{}/{} [batch {} loss {:.4f} accuracy {:.4f}]'.format(trained_seq_sum,
-                                                                      sample_sum,
-                                                                      batch + 1,
-                                                                      train_loss.result()
-                                                                      , train_accuracy.result()), end='')
-    print('\r{}/{} [==============================]'.format(sample_sum, sample_sum), end='')
+    按顺序遍历dataset中相邻的块，将上一块的最终状态作为下一块的初始状态，并打印相关信息
+    @return: batch数量，token数量
+    """
+    states = lm.initial_states(batch_size)
+    num_tokens = 0
+    start = time.time()
+    for batch, (seq_input, seq_real) in enumerate(dataset):
+        states = step(seq_input, seq_real, states)
+        num_tokens += int(tf.size(seq_input))
+        print('\r[batch {} loss {:.4f} accuracy {:.4f} - {:.0f} tokens/s]'
+              .format(batch + 1, loss.result(), accuracy.result(), num_tokens / (time.time() - start)), end='')
+    print('\r{} tokens [==============================]'.format(num_tokens), end='')
+    return batch + 1, num_tokens
 
 
 def train(epochs=_config.lm_EPOCHS, validation_split=0.0,
           min_delta=0.00003, patience=10, validation_freq=1):
     """训练
+    将语料连接为连续的token流并切分为lm_BATCH_SIZE条通道，按lm_bptt_length分块进行截断反向传播，
+    每个epoch开始时状态清零，之后每块的初始状态为同一通道上一块的最终状态
+
     @param epochs: 训练轮次
-    @return: 训练过程history
     @param validation_split: 验证集划分比例
     @param min_delta: 增大或减小的阈值，只有大于这个部分才算作improvement
     @param patience: 能够容忍多少个val_accuracy都没有improvement
@@ -57,30 +92,31 @@ def train(epochs=_config.lm_EPOCHS, validation_split=0.0,
     """
     max_acc = 0
     patience_num = 0
+    batch_size = _config.lm_BATCH_SIZE
 
     optimizer = tf.keras.optimizers.Adam()
     train_loss = tf.keras.metrics.Mean(name='train_loss')
     train_accuracy = tf.keras.metrics.SparseCategoricalAccuracy(name='train_accuracy')
+    val_loss = tf.keras.metrics.Mean(name='val_loss')
+    val_accuracy = tf.keras.metrics.SparseCategoricalAccuracy(name='val_accuracy')
     history = {'accuracy': [], 'loss': [], 'val_accuracy': [], 'val_loss': []}
     encoded_sequences_path_train = lm_preprocess.get_encoded_sequences_path(_config.lm_language, postfix='_train')
 
     tokenizer, vocab_size, max_sequence_length = lm_preprocess.train_preprocess()
-    train_dataset, val_dataset = lm_preprocess.get_dataset(encoded_sequences_path_train, train_size=validation_split)
+    train_dataset, val_dataset = lm_preprocess.get_dataset(encoded_sequences_path_train, train_size=1 - validation_split)
 
-    lm = language_model.LanguageModel(vocab_size, _config.lm_d_embedding, _config.lm_BATCH_SIZE, _config.lm_d_rnn)
+    lm = language_model.LanguageModel(vocab_size, _config.lm_d_embedding, _config.lm_d_rnn)
+    train_step = _make_train_step(lm, optimizer, train_loss, train_accuracy, batch_size)
+    eval_step = _make_eval_step(lm, val_loss, val_accuracy, batch_size)
 
     # 检查点设置，如果检查点存在，则恢复最新的检查点。
     ckpt = tf.train.Checkpoint(language_model=lm, optimizer=optimizer)
     ckpt_manager = tf.train.CheckpointManager(ckpt, _config.lm_checkpoint_path, max_to_keep=_config.max_checkpoints_num)
     if language_model.check_point():
+        language_model.check_checkpoint(lm, ckpt_manager.latest_checkpoint)
         ckpt.restore(ckpt_manager.latest_checkpoint)
         print('已恢复至最新检查点！')
 
-    train_batch_sum = int((_config.lm_num_sentences*_config.lm_train_size)//_config.lm_BATCH_SIZE)
-    val_batch_sum = int((_config.lm_num_sentences*(1-_config.lm_train_size))//_config.lm_BATCH_SIZE)
-    train_seq_sum = int(train_batch_sum * _config.lm_BATCH_SIZE)
-    val_seq_sum = int(val_batch_sum * _config.lm_BATCH_SIZE)
-
     print("开始训练...")
     for epoch in range(epochs):
         print('Epoch {}/{}'.format(epoch + 1, epochs))
@@ -88,35 +124,36 @@ def train(epochs=_config.lm_EPOCHS, validation_split=0.0,
         train_loss.reset_states()
         train_accuracy.reset_states()
 
-        _train_epoch(train_dataset, lm, optimizer, train_loss, train_accuracy, train_seq_sum)
+        num_batches, num_tokens = _run_epoch(train_dataset, train_step, lm, train_loss, train_accuracy, batch_size)
 
         history['accuracy'].append(train_accuracy.result().numpy())
         history['loss'].append(train_loss.result().numpy())
 
         epoch_time = (time.time() - start)
-        step_time = epoch_time * _config.BATCH_SIZE / (_config.lm_num_sentences*_config.lm_train_size)
+        step_time = epoch_time / num_batches
+        print(' - {:.0f}s - {:.0f}ms/step - {:.0f} tokens/s - loss: {:.4f} - accuracy {:.4f}'
+              .format(epoch_time, step_time * 1000, num_tokens / epoch_time,
+                      train_loss.result(), train_accuracy.result()), end='')
 
         # 验证部分
-        # 若到达所设置验证频率或最后一个epoch，并且validate_from_txt为False和train_size不同时满足时使用验证集验证
-        if (epoch + 1) % validation_freq == 0 or (epoch + 1) == _config.EPOCHS:
-            temp_loss = train_loss.result()
-            temp_acc = train_accuracy.result()
-            train_loss.reset_states()
-            train_accuracy.reset_states()
-
-            _train_epoch(val_dataset, lm, optimizer, train_loss, train_accuracy, train_seq_sum+val_seq_sum)
-
-            history['val_accuracy'].append(train_accuracy.result().numpy())
-            history['val_loss'].append(train_loss.result().numpy())
-            print(' - {:.0f}s - {:.0f}ms/step - loss: {:.4f} - accuracy {:.4f} - val_loss: {:.4f} - val_accuracy {:.4f}'
-                  .format(epoch_time, step_time * 1000, temp_loss, temp_acc, train_loss.result(),
-                          train_accuracy.result()))
+        # 若到达所设置验证频率或最后一个epoch，则在验证集上计算损失及准确率，不更新权重
+        if (epoch + 1) % validation_freq == 0 or (epoch + 1) == epochs:
+            val_loss.reset_states()
+            val_accuracy.reset_states()
+
+            _run_epoch(val_dataset, eval_step, lm, val_loss, val_accuracy, batch_size)
+
+            history['val_accuracy'].append(val_accuracy.result().numpy())
+            history['val_loss'].append(val_loss.result().numpy())
+            print(' - val_loss: {:.4f} - val_accuracy {:.4f}'.format(val_loss.result(), val_accuracy.result()))
             # stop-early判断
-            if train_accuracy.result().numpy() >= (max_acc * (1 + min_delta)):
-                max_acc = train_accuracy.result().numpy()
+            if val_accuracy.result().numpy() >= (max_acc * (1 + min_delta)):
+                max_acc = val_accuracy.result().numpy()
                 patience_num = 0
             else:
                 patience_num += 1
+        else:
+            print()
 
         if (epoch + 1) % _config.checkpoints_save_freq == 0:
             ckpt_save_path = ckpt_manager.save()
@@ -135,8 +172,82 @@ def train(epochs=_config.lm_EPOCHS, validation_split=0.0,
     return history
 
 
+def _unrolled_forward(lm, sequences):
+    """旧版的前向计算：从全零状态开始，在Python循环中对每个时间步依次调用两层LSTMCell，仅用于对比速度"""
+    state0, state1 = lm.initial_states(sequences.shape[0])
+    output = []
+    sequences = lm.embedding(sequences) * tf.math.sqrt(tf.cast(lm.d_embedding, tf.float32))
+    for sequences_t in tf.unstack(sequences, axis=1):
+        out0, state0 = lm.cell0(sequences_t, state0)
+        out1, state1 = lm.cell1(out0, state1)
+        output.append(lm.output_layer(out1))
+    return tf.stack(output, axis=1)
+
+
+def benchmark(num_batches=20):
+    """
+    对比训练速度(有效token/s，不含填充)：
+    旧版以填充的独立句子为batch，逐步计算且不编译；新版以连续token流分块，融合的LSTM层及tf.function编译的截断反向传播
+    两者均不计首个batch(含tf.function的编译)
+    @param num_batches: 各自计时的batch数量
+    @return: 旧版及新版的token/s
+    """
+    batch_size = _config.lm_BATCH_SIZE
+    tokenizer, vocab_size, _ = lm_preprocess.train_preprocess()
+    sequences_path = lm_preprocess.get_encoded_sequences_path(_config.lm_language, postfix='_train')
+
+    # 旧版：打乱的句子填充至batch内最大长度
+    tokens, offsets = encoded_corpus.load(sequences_path, mmap=False)
+    indices = numpy.random.permutation(encoded_corpus.num_sentences(offsets))
+    lm = language_model.LanguageModel(vocab_size, _config.lm_d_embedding, _config.lm_d_rnn)
+    optimizer = tf.keras.optimizers.Adam()
+    num_tokens, elapsed = 0, 0.0
+    for batch in range(num_batches + 1):
+        sequences = tf.constant(encoded_corpus.gather(tokens, offsets,
+                                                      indices[batch * batch_size:(batch + 1) * batch_size]))
+        start = time.time()
+        with tf.GradientTape() as tape:
+            loss = optimizers.loss_func_mask(sequences[:, 1:], _unrolled_forward(lm, sequences[:, :-1]))
+        gradients = tape.gradient(loss, lm.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, lm.trainable_variables))
+        if batch > 0:
+            elapsed += time.time() - start
+            num_tokens += int(tf.math.count_nonzero(sequences[:, 1:]))
+    before = num_tokens / elapsed
+
+    # 新版：连续token流，截断反向传播
+    train_dataset, _ = lm_preprocess.get_dataset(sequences_path, train_size=_config.lm_train_size)
+    lm = language_model.LanguageModel(vocab_size, _config.lm_d_embedding, _config.lm_d_rnn)
+    train_step = _make_train_step(lm, tf.keras.optimizers.Adam(), tf.keras.metrics.Mean(),
+                                  tf.keras.metrics.SparseCategoricalAccuracy(), batch_size)
+    states = lm.initial_states(batch_size)
+    num_tokens, elapsed = 0, 0.0
+    for batch, (seq_input, seq_real) in enumerate(train_dataset.take(num_batches + 1)):
+        start = time.time()
+        states = train_step(seq_input, seq_real, states)
+        states[1][1].numpy()  # 等待计算完成
+        if batch > 0:
+            elapsed += time.time() - start
+            num_tokens += int(tf.size(seq_input))
+    after = num_tokens / elapsed
+
+    print('-' * 20)
+    print('旧版(填充句子，逐步计算，eager)：%.0f tokens/s' % before)
+    print('新版(连续token流，融合LSTM，tf.function，截断长度%d)：%.0f tokens/s' % (_config.lm_bptt_length, after))
+    print('速度提升%.2f倍' % (after / before))
+    return before, after
+
+
 def main():
-    train(validation_split=1-_config.train_size)
+    parser = ArgumentParser(description='训练语言模型')
+    parser.add_argument('--benchmark', action='store_true', help='不训练，只对比旧版与新版训练步的速度(tokens/s)')
+    parser.add_argument('--num_batches', default=20, type=int, required=False, help='对比速度时计时的batch数量')
+    options = parser.parse_args()
+
+    if options.benchmark:
+        benchmark(options.num_batches)
+    else:
+        train(validation_split=1-_config.lm_train_size)
 
 
 if __name__ == '__main__':
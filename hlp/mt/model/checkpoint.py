@@ -6,21 +6,38 @@ from tensorflow.python.training.tracking import graph_view
 from hlp.mt.config import get_config as _config
 
 
-def load_checkpoint(transformer, optimizer, checkpoint_path=_config.checkpoint_path):
+def has_ema_weights(checkpoint_path):
+    """检查点中是否保存了训练时维护的指数滑动平均权重"""
+    return any(name.startswith('ema_transformer/') for name, _ in tf.train.list_variables(checkpoint_path))
+
+
+def load_checkpoint(transformer, optimizer=None, checkpoint_path=_config.checkpoint_path, ema=False):
     """
     获取检查点
     @param transformer: 模型实例
-    @param optimizer: 优化器
+    @param optimizer: 优化器，仅推断时可为None，此时不恢复优化器状态
     @param checkpoint_path:检查点的路径
+    @param ema: 是否将检查点中的指数滑动平均权重而非训练权重恢复至模型
     """
     # 加载检查点
     checkpoint_dir = os.path.dirname(checkpoint_path)
-    ckpt = tf.train.Checkpoint(transformer=transformer,
-                               optimizer=optimizer)
+    if ema:
+        if optimizer is not None:
+            raise ValueError("恢复指数滑动平均权重时不能同时恢复优化器")
+        if not has_ema_weights(checkpoint_path):
+            raise ValueError("检查点 %s 中没有指数滑动平均权重" % checkpoint_path)
+        trackables = {'ema_transformer': transformer}
+    else:
+        trackables = {'transformer': transformer}
+    if optimizer is not None:
+        trackables['optimizer'] = optimizer
+    ckpt = tf.train.Checkpoint(**trackables)
     ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_dir, max_to_keep=_config.max_checkpoints_num)
     if ckpt_manager.latest_checkpoint:
         # ckpt.restore(ckpt_manager.latest_checkpoint)
-        ckpt.restore(checkpoint_path)
+        status = ckpt.restore(checkpoint_path)
+        if optimizer is None:
+            status.expect_partial()
         # print('已恢复至最新的检查点！')
         print('正在使用检查点:'+checkpoint_path)
 
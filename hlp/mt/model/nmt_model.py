@@ -1,17 +1,53 @@
+import json
 import os
 
 from pathlib import Path
 import tensorflow as tf
 
 from hlp.mt.model import transformer as _transformer
+from hlp.mt.model import checkpoint
 from hlp.mt.config import get_config as _config
 from hlp.mt.common import text_vectorize
 from hlp.utils import optimizers as _optimizers
 from hlp.mt import preprocess
 
 
-def create_model(vocab_size_source, vocab_size_target):
-    """获取模型"""
+def _layer_dims_path(checkpoint_dir=_config.pruned_checkpoint_path):
+    return os.path.join(checkpoint_dir, 'layer_dims.json')
+
+
+def save_layer_dims(layer_dims, checkpoint_dir=_config.pruned_checkpoint_path):
+    """保存剪枝后各层的维度，与剪枝模型的检查点保存在同一目录"""
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    with open(_layer_dims_path(checkpoint_dir), 'w', encoding='UTF-8') as file:
+        json.dump(layer_dims, file, indent=2)
+
+
+def load_layer_dims(checkpoint_dir=_config.pruned_checkpoint_path):
+    """加载剪枝后各层的维度"""
+    with open(_layer_dims_path(checkpoint_dir), encoding='UTF-8') as file:
+        return json.load(file)
+
+
+def create_model(vocab_size_source, vocab_size_target, student=False, layer_dims=None):
+    """
+    获取模型
+    @param vocab_size_source: 源语言字典大小
+    @param vocab_size_target: 目标语言字典大小
+    @param student: 是否按知识蒸馏学生模型的结构创建
+    @param layer_dims: 结构化剪枝后各层的维度，为None时按config.json中的结构创建
+    """
+    if student:
+        return _transformer.Transformer(_config.student_num_encoder_layers,
+                                        _config.student_d_model,
+                                        _config.student_num_heads,
+                                        _config.student_dff,
+                                        vocab_size_source + 1,
+                                        vocab_size_target + 1,
+                                        pe_input=vocab_size_source + 1,
+                                        pe_target=vocab_size_target + 1,
+                                        rate=_config.dropout_rate,
+                                        num_decoder_layers=_config.student_num_decoder_layers)
     transformer = _transformer.Transformer(_config.num_layers,
                                            _config.d_model,
                                            _config.num_heads,
@@ -20,13 +56,15 @@ def create_model(vocab_size_source, vocab_size_target):
                                            vocab_size_target + 1,
                                            pe_input=vocab_size_source + 1,
                                            pe_target=vocab_size_target + 1,
-                                           rate=_config.dropout_rate)
+                                           rate=_config.dropout_rate,
+                                           layer_dims=layer_dims)
     return transformer
 
 
-def load_model():
+def _load_tokenizers():
     """
-    进行翻译或评估前数据恢复工作
+    加载源语言及目标语言字典
+    @return: 源语言字典，源语言字典大小，目标语言字典，目标语言字典大小
     """
     # 获取字典保存路径
     source_mode = preprocess.get_tokenizer_mode(_config.source_lang)
@@ -47,6 +85,15 @@ def load_model():
     print('目标语言字典大小:%d' % vocab_size_target)
     print('目标语言字典加载完毕！\n')
 
+    return tokenizer_source, vocab_size_source, tokenizer_target, vocab_size_target
+
+
+def load_model():
+    """
+    进行翻译或评估前数据恢复工作
+    """
+    tokenizer_source, vocab_size_source, tokenizer_target, vocab_size_target = _load_tokenizers()
+
     # 创建模型及相关变量
     learning_rate = _optimizers.CustomSchedule(_config.d_model)
     optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.98, epsilon=1e-9)
@@ -55,12 +102,50 @@ def load_model():
     return transformer, optimizer, tokenizer_source, tokenizer_target
 
 
-def check_point():
+def get_checkpoint_dir(student=False, pruned=False):
+    """
+    翻译所用模型的检查点目录
+    @param student: 是否为知识蒸馏得到的学生模型
+    @param pruned: 是否为结构化剪枝得到的模型
+    @return: 检查点目录
+    """
+    if pruned:
+        return _config.pruned_checkpoint_path
+    return _config.student_checkpoint_path if student else _config.checkpoint_path
+
+
+def load_translate_models(ema=False, student=False, pruned=False):
+    """
+    加载翻译所需的模型
+    每个检查点对应一个常驻内存的模型实例，只在启动时恢复一次，翻译时不再读取检查点
+    若不采用checkpoint_ensembling，则只加载最新的检查点
+    @param ema: 是否加载训练时维护的指数滑动平均权重
+    @param student: 是否加载知识蒸馏得到的学生模型
+    @param pruned: 是否加载结构化剪枝得到的模型
+    @return: 模型列表，源语言字典，目标语言字典
+    """
+    tokenizer_source, vocab_size_source, tokenizer_target, vocab_size_target = _load_tokenizers()
+
+    checkpoint_dir = get_checkpoint_dir(student=student, pruned=pruned)
+    layer_dims = load_layer_dims(checkpoint_dir) if pruned else None
+    checkpoints_path = checkpoint.get_checkpoints_path(checkpoint_dir)
+    if _config.checkpoint_ensembling == "False":
+        checkpoints_path = checkpoints_path[-1:]
+
+    models = []
+    for checkpoint_path in checkpoints_path:
+        transformer = create_model(vocab_size_source, vocab_size_target, student=student, layer_dims=layer_dims)
+        checkpoint.load_checkpoint(transformer, checkpoint_path=checkpoint_path, ema=ema)
+        models.append(transformer)
+
+    return models, tokenizer_source, tokenizer_target
+
+
+def check_point(checkpoint_dir=_config.checkpoint_path):
     """
     检测检查点目录下是否有文件
+    @param checkpoint_dir: 检查点目录，默认为由语言对确定的检查点路径
     """
-    # 进行语言对判断从而确定检查点路径
-    checkpoint_dir = _config.checkpoint_path
     is_exist = Path(checkpoint_dir)
     if not is_exist.exists():
         os.makedirs(checkpoint_dir, exist_ok=True)
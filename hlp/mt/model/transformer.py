@@ -22,10 +22,11 @@ def point_wise_feed_forward_network(d_model, dff):
 
 # 编码器层（Encoder layer）
 class EncoderLayer(tf.keras.layers.Layer):
-    def __init__(self, d_model, num_heads, dff, rate=0.1):
+    def __init__(self, d_model, num_heads, dff, rate=0.1, depth=None):
+        """depth为每个头的维度，为None时为d_model // num_heads，剪枝后的层头数减少而depth不变"""
         super(EncoderLayer, self).__init__()
 
-        self.mha = layers.MultiHeadAttention(d_model, num_heads)
+        self.mha = layers.MultiHeadAttention(d_model, num_heads, depth)
         self.ffn = point_wise_feed_forward_network(d_model, dff)
 
         self.layernorm1 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
@@ -48,11 +49,15 @@ class EncoderLayer(tf.keras.layers.Layer):
 
 # 解码器层
 class DecoderLayer(tf.keras.layers.Layer):
-    def __init__(self, d_model, num_heads, dff, rate=0.1):
+    def __init__(self, d_model, num_heads, dff, rate=0.1, depth=None, cross_num_heads=None):
+        """
+        depth为每个头的维度，为None时为d_model // num_heads
+        cross_num_heads为交叉注意力的头数，为None时与自注意力相同，剪枝后两者可以不同
+        """
         super(DecoderLayer, self).__init__()
 
-        self.mha1 = layers.MultiHeadAttention(d_model, num_heads)
-        self.mha2 = layers.MultiHeadAttention(d_model, num_heads)
+        self.mha1 = layers.MultiHeadAttention(d_model, num_heads, depth)
+        self.mha2 = layers.MultiHeadAttention(d_model, cross_num_heads or num_heads, depth)
 
         self.ffn = point_wise_feed_forward_network(d_model, dff)
 
@@ -83,6 +88,79 @@ class DecoderLayer(tf.keras.layers.Layer):
 
         return out3, attn_weights_block1, attn_weights_block2
 
+    def init_cache(self, batch_size, max_length=None):
+        """
+        初始化本层增量解码所用的自注意力缓存
+        @param batch_size: 初始候选数量
+        @param max_length: 为None时K/V初始为空、每步向后追加；
+        否则预先分配max_length个位置的定长缓存，每步写入对应位置，供图模式的while_loop使用
+        @return: 本层缓存字典，各张量shape为 (batch_size, num_heads, seq_len, depth)
+        """
+        cache = tf.zeros((batch_size, self.mha1.num_heads, max_length or 0, self.mha1.depth))
+        return {'k': cache, 'v': cache}
+
+    def compute_memory(self, enc_output):
+        """
+        由编码器输出预先计算本层交叉注意力的K/V，整个解码过程中只计算一次
+        其batch维与源句子一一对应，不随beam重排，解码时通过广播或按源句子下标选取
+        @param enc_output: 编码器输出 (batch_size, input_seq_len, d_model)
+        @return: 本层交叉注意力K/V字典，各张量shape为 (batch_size, num_heads, input_seq_len, depth)
+        """
+        batch_size = tf.shape(enc_output)[0]
+        return {
+            'k': self.mha2.split_heads(self.mha2.wk(enc_output), batch_size),
+            'v': self.mha2.split_heads(self.mha2.wv(enc_output), batch_size)
+        }
+
+    def call_step(self, x, cache, memory, padding_mask, step=None):
+        """
+        增量解码的单步调用，只计算当前时间步，历史时间步的K/V从缓存中读取
+        @param x: 当前时间步的输入 (batch_size, 1, d_model)
+        @param cache: 本层自注意力缓存字典
+        @param memory: 本层交叉注意力K/V字典，batch维为1时在所有候选间广播
+        @param padding_mask: 编码器输出的填充遮挡，batch维与memory一致
+        @param step: 为None时缓存为追加式；否则缓存为定长，当前K/V写入第step个位置，之后的位置被遮挡
+        @return: 当前时间步的输出 (batch_size, 1, d_model)，更新后的缓存
+        """
+        batch_size = tf.shape(x)[0]
+
+        # 自注意力，当前时间步的K/V写入缓存，只需对单个query计算
+        q = self.mha1.split_heads(self.mha1.wq(x), batch_size)
+        new_k = self.mha1.split_heads(self.mha1.wk(x), batch_size)
+        new_v = self.mha1.split_heads(self.mha1.wv(x), batch_size)
+        if step is None:
+            # 追加式缓存中只有已解码的位置，无需遮挡
+            k = tf.concat([cache['k'], new_k], axis=2)
+            v = tf.concat([cache['v'], new_v], axis=2)
+            self_mask = None
+        else:
+            # 定长缓存的shape在各步间不变，尚未解码的位置通过遮挡排除
+            max_length = tf.shape(cache['k'])[2]
+            position = tf.one_hot(step, max_length)[tf.newaxis, tf.newaxis, :, tf.newaxis]
+            k = cache['k'] * (1.0 - position) + new_k * position
+            v = cache['v'] * (1.0 - position) + new_v * position
+            self_mask = tf.cast(tf.range(max_length) > step, tf.float32)
+        attn1 = self._merge_heads(self.mha1, layers.scaled_dot_product_attention(q, k, v, self_mask)[0], batch_size)
+        out1 = self.layernorm1(attn1 + x)
+
+        # 交叉注意力，直接使用预先计算的编码器输出K/V
+        q = self.mha2.split_heads(self.mha2.wq(out1), batch_size)
+        attn2, _ = layers.scaled_dot_product_attention(q, memory['k'], memory['v'], padding_mask)
+        attn2 = self._merge_heads(self.mha2, attn2, batch_size)
+        out2 = self.layernorm2(attn2 + out1)
+
+        ffn_output = self.ffn(out2)
+        out3 = self.layernorm3(ffn_output + out2)
+
+        return out3, {'k': k, 'v': v}
+
+    @staticmethod
+    def _merge_heads(mha, scaled_attention, batch_size):
+        """将多头注意力的输出合并并经过输出层，(batch_size, num_heads, seq_len, depth) --> (batch_size, seq_len, d_model)"""
+        scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])
+        concat_attention = tf.reshape(scaled_attention, (batch_size, -1, mha.attention_dim))
+        return mha.dense(concat_attention)
+
 
 def create_masks(inp, tar):
     # 编码器填充遮挡
@@ -113,7 +191,10 @@ class Encoder(tf.keras.layers.Layer):
     """
 
     def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size,
-                 maximum_position_encoding, rate=0.1):
+                 maximum_position_encoding, rate=0.1, layer_dims=None):
+        """
+        layer_dims为各层剪枝后的维度列表，每项为{'num_heads': 头数, 'dff': 前馈网络维度}，为None时各层相同
+        """
         super(Encoder, self).__init__()
 
         self.d_model = d_model
@@ -123,8 +204,13 @@ class Encoder(tf.keras.layers.Layer):
         self.pos_encoding = layers.positional_encoding(maximum_position_encoding,
                                                        self.d_model)
 
-        self.enc_layers = [EncoderLayer(d_model, num_heads, dff, rate)
-                           for _ in range(num_layers)]
+        if layer_dims is None:
+            self.enc_layers = [EncoderLayer(d_model, num_heads, dff, rate)
+                               for _ in range(num_layers)]
+        else:
+            self.enc_layers = [EncoderLayer(d_model, dims['num_heads'], dims['dff'], rate,
+                                            depth=d_model // num_heads)
+                               for dims in layer_dims]
 
         self.dropout = tf.keras.layers.Dropout(rate)
 
@@ -155,7 +241,11 @@ class Decoder(tf.keras.layers.Layer):
     """
 
     def __init__(self, num_layers, d_model, num_heads, dff, target_vocab_size,
-                 maximum_position_encoding, rate=0.1):
+                 maximum_position_encoding, rate=0.1, layer_dims=None):
+        """
+        layer_dims为各层剪枝后的维度列表，每项为{'num_heads': 自注意力头数, 'cross_num_heads': 交叉注意力头数,
+        'dff': 前馈网络维度}，为None时各层相同
+        """
         super(Decoder, self).__init__()
 
         self.d_model = d_model
@@ -164,8 +254,13 @@ class Decoder(tf.keras.layers.Layer):
         self.embedding = tf.keras.layers.Embedding(target_vocab_size, d_model)
         self.pos_encoding = layers.positional_encoding(maximum_position_encoding, d_model)
 
-        self.dec_layers = [DecoderLayer(d_model, num_heads, dff, rate)
-                           for _ in range(num_layers)]
+        if layer_dims is None:
+            self.dec_layers = [DecoderLayer(d_model, num_heads, dff, rate)
+                               for _ in range(num_layers)]
+        else:
+            self.dec_layers = [DecoderLayer(d_model, dims['num_heads'], dims['dff'], rate,
+                                            depth=d_model // num_heads, cross_num_heads=dims['cross_num_heads'])
+                               for dims in layer_dims]
         self.dropout = tf.keras.layers.Dropout(rate)
 
     def call(self, x, enc_output, training,
@@ -189,6 +284,37 @@ class Decoder(tf.keras.layers.Layer):
         # x.shape == (batch_size, target_seq_len, d_model)
         return x, attention_weights
 
+    def init_cache(self, batch_size, max_length=None):
+        """初始化各解码器层的自注意力缓存"""
+        return [dec_layer.init_cache(batch_size, max_length) for dec_layer in self.dec_layers]
+
+    def compute_memory(self, enc_output):
+        """计算各解码器层交叉注意力的K/V"""
+        return [dec_layer.compute_memory(enc_output) for dec_layer in self.dec_layers]
+
+    def call_step(self, x, step, cache, memory, padding_mask, fixed_cache=False):
+        """
+        增量解码的单步调用
+        @param x: 当前时间步的输入token (batch_size, 1)
+        @param step: 当前时间步在目标序列中的位置，用于选取位置编码
+        @param cache: 各解码器层的自注意力缓存列表
+        @param memory: 各解码器层的交叉注意力K/V列表
+        @param padding_mask: 编码器输出的填充遮挡
+        @param fixed_cache: 缓存是否为定长缓存
+        @return: 当前时间步的输出 (batch_size, 1, d_model)，更新后的缓存列表
+        """
+        x = self.embedding(x)  # (batch_size, 1, d_model)
+        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
+        x += self.pos_encoding[:, step:step + 1, :]
+
+        new_cache = []
+        for i in range(self.num_layers):
+            x, layer_cache = self.dec_layers[i].call_step(x, cache[i], memory[i], padding_mask,
+                                                          step if fixed_cache else None)
+            new_cache.append(layer_cache)
+
+        return x, new_cache
+
 
 # Transformer模型
 class Transformer(tf.keras.Model):
@@ -197,12 +323,21 @@ class Transformer(tf.keras.Model):
     """
 
     def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size,
-                 target_vocab_size, pe_input, pe_target, rate=0.1):
+                 target_vocab_size, pe_input, pe_target, rate=0.1, num_decoder_layers=None, layer_dims=None):
+        """
+        num_layers为编码器层数，num_decoder_layers为解码器层数，为None时与编码器相同
+        深编码器、浅解码器的结构可降低自回归解码的延迟
+        layer_dims为结构化剪枝后各层的维度字典{'encoder': [...], 'decoder': [...]}(见Encoder及Decoder)，
+        为None时各层均为num_heads个头、dff维的前馈网络
+        """
         super(Transformer, self).__init__()
 
-        self.encoder = Encoder(num_layers, d_model, num_heads, dff, input_vocab_size, pe_input, rate)
+        layer_dims = layer_dims or {}
+        self.encoder = Encoder(num_layers, d_model, num_heads, dff, input_vocab_size, pe_input, rate,
+                               layer_dims=layer_dims.get('encoder'))
 
-        self.decoder = Decoder(num_layers, d_model, num_heads, dff, target_vocab_size, pe_target, rate)
+        self.decoder = Decoder(num_decoder_layers or num_layers, d_model, num_heads, dff,
+                               target_vocab_size, pe_target, rate, layer_dims=layer_dims.get('decoder'))
 
         self.final_layer = tf.keras.layers.Dense(target_vocab_size)
 
@@ -217,6 +352,83 @@ class Transformer(tf.keras.Model):
 
         return final_output, attention_weights
 
+    def encode(self, inp, enc_padding_mask):
+        """
+        推断时单独运行编码器，每个源句子只需编码一次
+        @param inp: 源序列 (batch_size, inp_seq_len)
+        @param enc_padding_mask: 编码器填充遮挡
+        @return: 编码器输出 (batch_size, inp_seq_len, d_model)
+        """
+        return self.encoder(inp, False, enc_padding_mask)
+
+    def init_decode_cache(self, batch_size=1, max_length=None):
+        """
+        初始化增量解码的自注意力缓存
+        @param batch_size: 初始候选数量
+        @param max_length: 给出时预先分配定长缓存，解码各步的缓存shape不变，用于tf.while_loop
+        @return: 各解码器层的缓存列表
+        """
+        return self.decoder.init_cache(batch_size, max_length)
+
+    def compute_memory(self, enc_output):
+        """
+        由编码器输出一次性计算各层交叉注意力的K/V
+        @param enc_output: 编码器输出
+        @return: 各解码器层的交叉注意力K/V列表
+        """
+        return self.decoder.compute_memory(enc_output)
+
+    @staticmethod
+    def gather_memory(memory, dec_padding_mask, source_indices):
+        """
+        按每个候选所属的源句子下标选取交叉注意力K/V及填充遮挡
+        只有一个源句子时无需调用，batch维为1的memory会在所有候选间广播
+        @param memory: 各解码器层的交叉注意力K/V列表
+        @param dec_padding_mask: 编码器输出的填充遮挡
+        @param source_indices: 每个候选对应的源句子下标
+        @return: 选取后的memory及填充遮挡
+        """
+        return tf.nest.map_structure(lambda t: tf.gather(t, source_indices), (memory, dec_padding_mask))
+
+    def output_projection(self, indices):
+        """
+        取出输出层中给定目标语言token对应的权重，用于只对候选集计算logits
+        @param indices: 目标语言token候选集 (num_candidates,)
+        @return: 输出层权重 (d_model, num_candidates)，偏置 (num_candidates,)
+        """
+        return tf.gather(self.final_layer.kernel, indices, axis=1), tf.gather(self.final_layer.bias, indices)
+
+    def decode_step(self, tar, step, cache, memory, dec_padding_mask, fixed_cache=False, output_projection=None):
+        """
+        增量解码的单步调用，每一步只计算新的token，使整个解码过程的解码器计算量由O(L²)降为O(L)
+        @param tar: 当前时间步的输入token (batch_size, 1)
+        @param step: 当前时间步在目标序列中的位置
+        @param cache: 由init_decode_cache初始化或上一步返回的缓存
+        @param memory: 由compute_memory计算的交叉注意力K/V
+        @param dec_padding_mask: 编码器输出的填充遮挡
+        @param fixed_cache: 缓存是否为由init_decode_cache(max_length=...)初始化的定长缓存
+        @param output_projection: 由output_projection取出的候选集权重，给出时只计算候选集的logits
+        @return: 当前时间步的预测 (batch_size, target_vocab_size)或(batch_size, num_candidates)，更新后的缓存
+        """
+        dec_output, cache = self.decoder.call_step(tar, step, cache, memory, dec_padding_mask, fixed_cache)
+        if output_projection is None:
+            final_output = self.final_layer(dec_output[:, -1, :])  # (batch_size, target_vocab_size)
+        else:
+            kernel, bias = output_projection
+            final_output = tf.matmul(dec_output[:, -1, :], kernel) + bias  # (batch_size, num_candidates)
+        return final_output, cache
+
+    @staticmethod
+    def reorder_cache(cache, indices):
+        """
+        根据beam search的父候选下标重排自注意力缓存，使缓存的batch维与新的候选序列一一对应
+        交叉注意力的K/V不随beam变化，无需重排
+        @param cache: 增量解码缓存
+        @param indices: 每个新候选所对应的上一步候选的下标
+        @return: 重排后的缓存
+        """
+        return tf.nest.map_structure(lambda t: tf.gather(t, indices), cache)
+
 
 # 使用schedual sampling的transformer
 class ScheduledSamplingTransformer(tf.keras.Model):
@@ -1,6 +1,12 @@
+import io
+import os
 import re
+import pickle
+import multiprocessing as mp
+from argparse import ArgumentParser
 
 from hlp.mt.config import get_config as _config
+from hlp.mt.common import encoded_corpus
 from hlp.mt.common import text_vectorize
 from hlp.mt.common.text_split import preprocess_sentences
 from hlp.mt.common.load_dataset import load_sentences
@@ -54,8 +60,12 @@ def train_preprocess():
     - 预处理句子
     - 生成及保存字典
     - 编码句子
+    preprocess_processes大于1时分片使用进程池并行处理
 
     """
+    if _config.preprocess_processes > 1:
+        return parallel_train_preprocess(_config.preprocess_processes)
+
     # 获取source、target编码模式，字典保存路径，编码句子保存路径
     source_mode = get_tokenizer_mode(_config.source_lang)
     target_mode = get_tokenizer_mode(_config.source_lang)
@@ -139,12 +149,185 @@ def train_preprocess():
     return vocab_size_source, vocab_size_target
 
 
+def _shard_ranges(path, num_sentences, shard_size):
+    """
+    以二进制方式扫描文本的前num_sentences行，每shard_size行划分为一个分片
+    @return: 各分片在文件中的字节范围列表
+    """
+    ranges = []
+    start = position = 0
+    with open(path, 'rb') as file:
+        for i, line in enumerate(file):
+            if i == num_sentences:
+                break
+            position += len(line)
+            if (i + 1) % shard_size == 0:
+                ranges.append((start, position))
+                start = position
+    if position > start:
+        ranges.append((start, position))
+    return ranges
+
+
+def _read_shard(path, start, end):
+    """读取一个分片中的句子对，与load_sentences的读取方式一致"""
+    with open(path, 'rb') as file:
+        file.seek(start)
+        text = file.read(end - start).decode('UTF-8')
+    source_sentences = []
+    target_sentences = []
+    for line in io.StringIO(text, newline=None):
+        source_sentences.append(line.split('\t')[0])
+        target_sentences.append(line.split('\t')[1])
+    if _config.reverse == 'True':
+        return target_sentences, source_sentences
+    return source_sentences, target_sentences
+
+
+def _shard_path(language, shard_index):
+    """分片的已编码句子保存路径"""
+    return get_encoded_sequences_path(language, postfix='_train_shard%05d' % shard_index)
+
+
+def _split_shard(task):
+    """
+    进程池worker：读取并预处理一个分片，预处理后的句子暂存至文件供编码使用
+    @param task: (文本路径, 起始字节, 结束字节, 各语言的(语言, 编码类型, 分片保存路径)元组)
+    @return: 源语言词数，各语言的token统计量列表
+    """
+    path, start, end, shards = task
+    sentences_pair = _read_shard(path, start, end)
+    num_words = _count_words(sentences_pair[0])
+
+    counts = []
+    for (language, mode, shard_path), sentences in zip(shards, sentences_pair):
+        sentences = preprocess_sentences(sentences, language, mode)
+        with open(shard_path + '.pkl', 'wb') as file:
+            pickle.dump(sentences, file)
+        counts.append(text_vectorize.count_tokens(sentences, language, mode))
+    return num_words, counts
+
+
+_worker_tokenizers = None
+
+
+def _init_encode_worker(tokenizers):
+    global _worker_tokenizers
+    _worker_tokenizers = tokenizers
+
+
+def _encode_shard(task):
+    """
+    进程池worker：使用合并生成的字典编码一个分片，直接保存为二进制的已编码语料
+    @param task: 各语言的(语言, 编码类型, 分片保存路径)元组，与worker的字典一一对应
+    @return: 各语言的最大句子长度
+    """
+    max_lengths = []
+    for (language, mode, shard_path), tokenizer in zip(task, _worker_tokenizers):
+        with open(shard_path + '.pkl', 'rb') as file:
+            sentences = pickle.load(file)
+        os.remove(shard_path + '.pkl')
+        max_lengths.append(text_vectorize.encode_and_save(save_path=shard_path, sentences=sentences,
+                                                          tokenizer=tokenizer, language=language, mode=mode,
+                                                          num_processes=1))
+    return max_lengths
+
+
+def parallel_train_preprocess(num_processes, shard_size=_config.preprocess_shard_size):
+    """
+    分片并行的训练语料预处理，结果与train_preprocess一致
+    - 按行将语料划分为分片，进程池中各worker读取、预处理分片并统计token
+    - 按分片顺序合并各分片的token统计量生成字典，合并结果与分片数量及完成顺序无关
+    - 各worker使用字典将分片直接编码为二进制的已编码语料，最后按顺序合并为完整语料
+
+    @param num_processes: 进程数
+    @param shard_size: 每个分片的句子对数量
+    @return: 源语言字典大小，目标语言字典大小
+    """
+    source_mode = get_tokenizer_mode(_config.source_lang)
+    target_mode = get_tokenizer_mode(_config.source_lang)
+    source_tokenizer_path = get_tokenizer_path(_config.source_lang, source_mode)
+    target_tokenizer_path = get_tokenizer_path(_config.target_lang, target_mode)
+    source_sequences_path_train = get_encoded_sequences_path(_config.source_lang, postfix='_train')
+    target_sequences_path_train = get_encoded_sequences_path(_config.target_lang, postfix='_train')
+    for path in (source_sequences_path_train, target_sequences_path_train):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    shard_ranges = _shard_ranges(_config.path_to_train_file, _config.num_sentences, shard_size)
+    print('训练数据集划分为%d个分片，使用%d个进程处理...' % (len(shard_ranges), num_processes))
+    context = mp.get_context('spawn')
+
+    print('正在并行加载及预处理训练数据集...')
+    # 各worker只依据任务参数处理分片，不依赖主进程中的运行时配置
+    shards = [((_config.source_lang, source_mode, _shard_path(_config.source_lang, i)),
+               (_config.target_lang, target_mode, _shard_path(_config.target_lang, i)))
+              for i in range(len(shard_ranges))]
+    tasks = [(_config.path_to_train_file, start, end, shard) for (start, end), shard in zip(shard_ranges, shards)]
+    with context.Pool(num_processes) as pool:
+        results = pool.map(_split_shard, tasks)
+    num_words = sum(result[0] for result in results)
+    print('源语料(%s)词数：%d' % (_config.source_lang, num_words))
+
+    # 按分片顺序合并统计量生成字典
+    print('正在生成、保存源语言(%s)字典(分词方式:%s)...' % (_config.source_lang, _config.en_tokenize_type))
+    source_counts = text_vectorize.merge_token_counts([result[1][0] for result in results],
+                                                      _config.source_lang, source_mode)
+    tokenizer_source, vocab_size_source = text_vectorize.create_and_save_tokenizer_from_counts(
+        source_counts, source_tokenizer_path, _config.source_lang, source_mode)
+    print('源语言字典大小:%d' % vocab_size_source)
+
+    print('正在生成、保存目标语言(%s)字典(分词方式:%s)...' % (_config.target_lang, _config.zh_tokenize_type))
+    target_counts = text_vectorize.merge_token_counts([result[1][1] for result in results],
+                                                      _config.target_lang, target_mode)
+    tokenizer_target, vocab_size_target = text_vectorize.create_and_save_tokenizer_from_counts(
+        target_counts, target_tokenizer_path, _config.target_lang, target_mode)
+    print('目标语言字典大小:%d' % vocab_size_target)
+
+    print("正在并行编码训练集句子...")
+    with context.Pool(num_processes, initializer=_init_encode_worker,
+                      initargs=((tokenizer_source, tokenizer_target),)) as pool:
+        pool.map(_encode_shard, shards)
+    for language_index, path in enumerate((source_sequences_path_train, target_sequences_path_train)):
+        language = shards[0][language_index][0]
+        shard_paths = [shard[language_index][2] for shard in shards]
+        max_sequence_length = encoded_corpus.concatenate(shard_paths, path)
+        for shard_path in shard_paths:
+            encoded_corpus.remove(shard_path)
+        print('最大%s句子长度:%d' % (language, max_sequence_length))
+
+    if _config.validation_data == "True":
+        print('加载、预处理及编码验证数据集...')
+        source_sentences_val, target_sentences_val = load_sentences(_config.path_to_val_file,
+                                                                    _config.num_validate_sentences)
+        source_sentences_val = preprocess_sentences(source_sentences_val, _config.source_lang, source_mode)
+        target_sentences_val = preprocess_sentences(target_sentences_val, _config.target_lang, target_mode)
+        text_vectorize.encode_and_save(save_path=get_encoded_sequences_path(_config.source_lang, postfix='_val'),
+                                       sentences=source_sentences_val, tokenizer=tokenizer_source,
+                                       language=_config.source_lang, mode=source_mode)
+        text_vectorize.encode_and_save(save_path=get_encoded_sequences_path(_config.target_lang, postfix='_val'),
+                                       sentences=target_sentences_val, tokenizer=tokenizer_target,
+                                       language=_config.target_lang, mode=target_mode)
+    print("语料处理完成.\n")
+
+    return vocab_size_source, vocab_size_target
+
+
 def translate_proprecess():
     """翻译所需的预处理"""
 
 
 def main():
-    train_preprocess()
+    parser = ArgumentParser(description='训练语料预处理，进程数大于1时分片并行处理')
+    parser.add_argument('--num_processes', default=_config.preprocess_processes, type=int, required=False,
+                        help='预处理使用的进程数')
+    parser.add_argument('--shard_size', default=_config.preprocess_shard_size, type=int, required=False,
+                        help='并行处理时每个分片的句子对数量')
+    options = parser.parse_args()
+
+    if options.num_processes > 1:
+        parallel_train_preprocess(options.num_processes, options.shard_size)
+    else:
+        train_preprocess()
 
 
 if __name__ == '__main__':
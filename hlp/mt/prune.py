@@ -0,0 +1,266 @@
+"""
+注意力头及前馈网络神经元的结构化剪枝
+1. 在验证数据上累计损失对各注意力头及各前馈网络神经元门控的一阶梯度的绝对值作为其重要性，
+   门控等价于对其输出层中对应行的缩放，因此由输出层权重及其梯度即可算出，无需修改模型
+2. 各注意力模块内归一化后全局排序剪掉重要性最低的头(每个模块至少保留一个)，每层剪掉重要性最低的前馈网络神经元
+3. 按剪枝后各层的维度重新创建较小的稠密模型并复制保留部分的权重，检查点及各层维度保存至单独的目录
+4. 可选地在训练语料上微调，最后对比剪枝前后的参数量、BLEU、单句延迟及吞吐量
+"""
+import shutil
+from argparse import ArgumentParser
+
+import numpy
+import tensorflow as tf
+
+from hlp.mt.config import get_config as _config
+from hlp.mt.model import nmt_model
+from hlp.mt.model import transformer as _transformer
+from hlp.mt.common import encoded_corpus
+from hlp.mt.common import load_dataset
+from hlp.mt import distill
+from hlp.mt import preprocess
+from hlp.mt import trainer
+from hlp.utils import optimizers as _optimizers
+
+
+def _attention_modules(model):
+    """模型中所有的多头注意力模块，顺序为各编码器层的自注意力，再为各解码器层的自注意力及交叉注意力"""
+    modules = [enc_layer.mha for enc_layer in model.encoder.enc_layers]
+    for dec_layer in model.decoder.dec_layers:
+        modules += [dec_layer.mha1, dec_layer.mha2]
+    return modules
+
+
+def _ffn_modules(model):
+    """模型中所有的前馈网络，顺序为各编码器层，再为各解码器层"""
+    return [layer.ffn for layer in model.encoder.enc_layers + model.decoder.dec_layers]
+
+
+def _build(model):
+    """以只含一个token的输入build模型"""
+    inp, tar_inp = tf.constant([[1]]), tf.constant([[1]])
+    enc_padding_mask, combined_mask, dec_padding_mask = _transformer.create_masks(inp, tar_inp)
+    model(inp, tar_inp, False, enc_padding_mask, combined_mask, dec_padding_mask)
+
+
+def _validation_dataset():
+    """计算重要性使用的验证数据，有已编码的验证语料时使用之，否则从训练语料中划分"""
+    source_path = preprocess.get_encoded_sequences_path(_config.source_lang, postfix='_val')
+    target_path = preprocess.get_encoded_sequences_path(_config.target_lang, postfix='_val')
+    if encoded_corpus.exists(source_path):
+        return load_dataset.get_dataset(source_path, target_path, False, 0.0)[1]
+    source_path = preprocess.get_encoded_sequences_path(_config.source_lang, postfix='_train')
+    target_path = preprocess.get_encoded_sequences_path(_config.target_lang, postfix='_train')
+    return load_dataset.get_dataset(source_path, target_path, False, _config.train_size)[1]
+
+
+def compute_importance(model, dataset, num_batches=_config.prune_num_batches):
+    """
+    计算各注意力头及前馈网络神经元的重要性
+    头h的输出只经过输出层kernel中第h个头对应的depth行，神经元j的输出只经过前馈网络第二层kernel的第j行，
+    因此损失对其门控的梯度为这些行的权重与其梯度的逐元素乘积之和
+    @param model: 已恢复检查点的模型
+    @param dataset: 验证数据集
+    @param num_batches: 使用的batch数量
+    @return: 各注意力模块头的重要性列表 [(num_heads,)]，各前馈网络神经元的重要性列表 [(dff,)]
+    """
+    attention_modules = _attention_modules(model)
+    ffn_modules = _ffn_modules(model)
+    attention_kernels = [mha.dense.kernel for mha in attention_modules]
+    ffn_kernels = [ffn.layers[1].kernel for ffn in ffn_modules]
+    head_importance = [numpy.zeros(mha.num_heads) for mha in attention_modules]
+    ffn_importance = [numpy.zeros(kernel.shape[0]) for kernel in ffn_kernels]
+
+    for batch, (inp, tar) in enumerate(dataset.take(num_batches)):
+        tar_inp = tar[:, :-1]
+        tar_real = tar[:, 1:]
+        enc_padding_mask, combined_mask, dec_padding_mask = _transformer.create_masks(inp, tar_inp)
+        with tf.GradientTape() as tape:
+            predictions, _ = model(inp, tar_inp, False, enc_padding_mask, combined_mask, dec_padding_mask)
+            loss = _optimizers.loss_func_mask(tar_real, predictions)
+        gradients = tape.gradient(loss, attention_kernels + ffn_kernels)
+
+        for i, (mha, kernel, gradient) in enumerate(zip(attention_modules, attention_kernels, gradients)):
+            gate_gradient = tf.reduce_sum(tf.reshape(kernel * gradient, (mha.num_heads, mha.depth, -1)), axis=[1, 2])
+            head_importance[i] += numpy.abs(gate_gradient.numpy())
+        for i, (kernel, gradient) in enumerate(zip(ffn_kernels, gradients[len(attention_kernels):])):
+            ffn_importance[i] += numpy.abs(tf.reduce_sum(kernel * gradient, axis=1).numpy())
+        print('\r已计算%d个batch的重要性' % (batch + 1), end='')
+    print()
+    return head_importance, ffn_importance
+
+
+def select(head_importance, ffn_importance, head_ratio=_config.prune_head_ratio, ffn_ratio=_config.prune_ffn_ratio):
+    """
+    按重要性选择保留的头及神经元
+    头的重要性在各注意力模块内按L2范数归一化后全局排序，剪掉head_ratio比例的头，每个模块至少保留一个头；
+    前馈网络在每层内剪掉ffn_ratio比例的神经元
+    @return: 各注意力模块保留的头下标列表，各前馈网络保留的神经元下标列表，均为升序
+    """
+    normalized = [importance / max(numpy.linalg.norm(importance), 1e-12) for importance in head_importance]
+    candidates = sorted((score, module, head) for module, scores in enumerate(normalized)
+                        for head, score in enumerate(scores))
+    num_prune = int(len(candidates) * head_ratio)
+    kept_heads = [set(range(len(scores))) for scores in normalized]
+    for _, module, head in candidates:
+        if num_prune == 0:
+            break
+        if len(kept_heads[module]) > 1:
+            kept_heads[module].remove(head)
+            num_prune -= 1
+    kept_heads = [numpy.asarray(sorted(heads)) for heads in kept_heads]
+
+    kept_neurons = []
+    for importance in ffn_importance:
+        num_keep = max(int(round(len(importance) * (1 - ffn_ratio))), 1)
+        kept_neurons.append(numpy.sort(numpy.argsort(-importance, kind='stable')[:num_keep]))
+    return kept_heads, kept_neurons
+
+
+def get_layer_dims(model, kept_heads, kept_neurons):
+    """由保留的头及神经元得到剪枝后各层的维度，格式见transformer.Transformer的layer_dims"""
+    num_encoder_layers = len(model.encoder.enc_layers)
+    encoder_dims = [{'num_heads': len(kept_heads[i]), 'dff': len(kept_neurons[i])}
+                    for i in range(num_encoder_layers)]
+    decoder_dims = [{'num_heads': len(kept_heads[num_encoder_layers + 2 * i]),
+                     'cross_num_heads': len(kept_heads[num_encoder_layers + 2 * i + 1]),
+                     'dff': len(kept_neurons[num_encoder_layers + i])}
+                    for i in range(len(model.decoder.dec_layers))]
+    return {'encoder': encoder_dims, 'decoder': decoder_dims}
+
+
+def _copy_attention(source, target, heads):
+    """将注意力模块中保留的头对应的Q/K/V列及输出层行复制到剪枝后的模块"""
+    columns = numpy.concatenate([numpy.arange(head * source.depth, (head + 1) * source.depth) for head in heads])
+    for source_dense, target_dense in ((source.wq, target.wq), (source.wk, target.wk), (source.wv, target.wv)):
+        target_dense.kernel.assign(tf.gather(source_dense.kernel, columns, axis=1))
+        target_dense.bias.assign(tf.gather(source_dense.bias, columns))
+    target.dense.kernel.assign(tf.gather(source.dense.kernel, columns, axis=0))
+    target.dense.bias.assign(source.dense.bias)
+
+
+def _copy_ffn(source, target, neurons):
+    """将前馈网络中保留的神经元对应的第一层列及第二层行复制到剪枝后的前馈网络"""
+    target.layers[0].kernel.assign(tf.gather(source.layers[0].kernel, neurons, axis=1))
+    target.layers[0].bias.assign(tf.gather(source.layers[0].bias, neurons))
+    target.layers[1].kernel.assign(tf.gather(source.layers[1].kernel, neurons, axis=0))
+    target.layers[1].bias.assign(source.layers[1].bias)
+
+
+def prune(model, vocab_size_source, vocab_size_target, kept_heads, kept_neurons):
+    """
+    按保留的头及神经元创建较小的稠密模型，并复制保留部分的权重
+    @param model: 原模型
+    @param vocab_size_source: 源语言字典大小
+    @param vocab_size_target: 目标语言字典大小
+    @param kept_heads: 各注意力模块保留的头下标列表
+    @param kept_neurons: 各前馈网络保留的神经元下标列表
+    @return: 剪枝后的模型，各层维度
+    """
+    layer_dims = get_layer_dims(model, kept_heads, kept_neurons)
+    pruned = nmt_model.create_model(vocab_size_source, vocab_size_target, layer_dims=layer_dims)
+    _build(pruned)
+
+    for source, target in ((model.encoder.embedding, pruned.encoder.embedding),
+                           (model.decoder.embedding, pruned.decoder.embedding),
+                           (model.final_layer, pruned.final_layer)):
+        target.set_weights(source.get_weights())
+    for source, target, heads in zip(_attention_modules(model), _attention_modules(pruned), kept_heads):
+        _copy_attention(source, target, heads)
+    for source, target, neurons in zip(_ffn_modules(model), _ffn_modules(pruned), kept_neurons):
+        _copy_ffn(source, target, neurons)
+    for source_layer, target_layer in zip(model.encoder.enc_layers + model.decoder.dec_layers,
+                                          pruned.encoder.enc_layers + pruned.decoder.dec_layers):
+        for name in ('layernorm1', 'layernorm2', 'layernorm3'):
+            if hasattr(source_layer, name):
+                getattr(target_layer, name).set_weights(getattr(source_layer, name).get_weights())
+    return pruned, layer_dims
+
+
+def _num_params(model):
+    return sum(int(numpy.prod(variable.shape)) for variable in model.trainable_variables)
+
+
+def report(original_models, pruned_models, tokenizer_source, tokenizer_target, num_eval=_config.num_eval,
+           batch_size=_config.BATCH_SIZE, beam_size=_config.BEAM_SIZE, num_latency=100):
+    """
+    在验证文本上对比剪枝前后的模型
+    @return: 各模型的结果字典列表
+    """
+    source_sentences, target_sentences = load_dataset.load_sentences(_config.path_to_eval_file, num_eval)
+    results = []
+    for name, models in (('剪枝前', original_models), ('剪枝后', pruned_models)):
+        bleu, throughput, latency = distill._evaluate(models, tokenizer_source, tokenizer_target,
+                                                      source_sentences, target_sentences,
+                                                      batch_size, beam_size, num_latency)
+        results.append({'name': name, 'params': _num_params(models[0]), 'bleu': bleu,
+                        'throughput': throughput, 'latency': latency})
+
+    print('-' * 20)
+    print('%-6s%12s%8s%12s%12s' % ('模型', '参数量', 'BLEU', '吞吐量(句/s)', '延迟(ms)'))
+    for result in results:
+        print('%-6s%12d%8.2f%12.2f%12.2f' % (result['name'], result['params'], result['bleu'],
+                                             result['throughput'], result['latency']))
+    original, pruned = results
+    print('剪枝后相对剪枝前：参数量%.1f%%，BLEU变化%+.2f，单句延迟%.2f倍，吞吐量%.2f倍'
+          % (pruned['params'] / original['params'] * 100, pruned['bleu'] - original['bleu'],
+             pruned['latency'] / original['latency'], pruned['throughput'] / original['throughput']))
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='按验证数据上的重要性剪掉注意力头及前馈网络神经元，得到更小更快的稠密模型')
+    parser.add_argument('--head_ratio', default=_config.prune_head_ratio, type=float, required=False,
+                        help='剪掉的注意力头占全部头的比例')
+    parser.add_argument('--ffn_ratio', default=_config.prune_ffn_ratio, type=float, required=False,
+                        help='每层前馈网络剪掉的神经元比例')
+    parser.add_argument('--num_batches', default=_config.prune_num_batches, type=int, required=False,
+                        help='计算重要性使用的验证集batch数量')
+    parser.add_argument('--finetune', action='store_true', help='剪枝后在训练语料上微调')
+    parser.add_argument('--finetune_epochs', default=_config.prune_finetune_epochs, type=int, required=False,
+                        help='微调的epoch数')
+    parser.add_argument('--num_eval', default=_config.num_eval, type=int, required=False, help='用于对比的句子数量')
+    parser.add_argument('--beam_size', default=_config.BEAM_SIZE, type=int, required=False, help='对比时的beam大小')
+    parser.add_argument('--ema', action='store_true', help='对指数滑动平均权重进行剪枝')
+    options = parser.parse_args()
+
+    if not nmt_model.check_point():
+        print('没有发现训练好的模型，请先训练模型.')
+        return
+    models, tokenizer_source, tokenizer_target = nmt_model.load_translate_models(ema=options.ema)
+    model = models[-1]  # 对最新的检查点进行剪枝
+    _build(model)
+    _, vocab_size_source, _, vocab_size_target = nmt_model._load_tokenizers()
+
+    print('正在计算注意力头及前馈网络神经元的重要性...')
+    head_importance, ffn_importance = compute_importance(model, _validation_dataset(), options.num_batches)
+    kept_heads, kept_neurons = select(head_importance, ffn_importance, options.head_ratio, options.ffn_ratio)
+    pruned, layer_dims = prune(model, vocab_size_source, vocab_size_target, kept_heads, kept_neurons)
+    print('剪枝后各层维度：')
+    for i, dims in enumerate(layer_dims['encoder']):
+        print('编码器第%d层：%d个头，前馈网络%d维' % (i + 1, dims['num_heads'], dims['dff']))
+    for i, dims in enumerate(layer_dims['decoder']):
+        print('解码器第%d层：自注意力%d个头，交叉注意力%d个头，前馈网络%d维'
+              % (i + 1, dims['num_heads'], dims['cross_num_heads'], dims['dff']))
+
+    # 剪枝模型的检查点目录中只保存本次剪枝的结果
+    shutil.rmtree(_config.pruned_checkpoint_path, ignore_errors=True)
+    nmt_model.save_layer_dims(layer_dims)
+    if options.finetune:
+        trainer.train(pruned,
+                      validation_data=_config.validation_data,
+                      validation_split=1 - _config.train_size,
+                      validation_freq=_config.validation_freq,
+                      checkpoint_path=_config.pruned_checkpoint_path,
+                      epochs=options.finetune_epochs)
+    else:
+        ckpt = tf.train.Checkpoint(transformer=pruned)
+        ckpt_manager = tf.train.CheckpointManager(ckpt, _config.pruned_checkpoint_path, max_to_keep=1)
+        print('剪枝模型已保存至：%s' % ckpt_manager.save())
+
+    report(models[-1:], [pruned], tokenizer_source, tokenizer_target,
+           num_eval=options.num_eval, beam_size=options.beam_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+翻译模型的训练后动态范围int8量化
+由检查点导出图模式解码的SavedModel(见export.py)后转换为TFLite模型，
+量化模型的权重以int8保存，激活值仍为float32，矩阵乘法在运行时对激活值动态量化后以int8计算，
+在验证文本上对比float32与int8模型的BLEU、模型大小及翻译速度
+"""
+import os
+import time
+from argparse import ArgumentParser
+
+import numpy
+import tensorflow as tf
+
+from hlp.mt.config import get_config as _config
+from hlp.mt.model import nmt_model
+from hlp.mt.common import bleu as _bleu
+from hlp.mt.common import load_dataset
+from hlp.mt import export as _export
+from hlp.mt import translator
+
+
+def convert(saved_model_dir, output_path, quantize=True, signature='translate'):
+    """
+    将导出的SavedModel转换为TFLite模型
+    @param saved_model_dir: export.py导出的SavedModel目录
+    @param output_path: TFLite模型保存路径
+    @param quantize: 是否进行动态范围int8量化，为False时保持float32
+    @param signature: 转换的签名，translate或translate_greedy
+    @return: 模型文件大小(字节)
+    """
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir, signature_keys=[signature])
+    if quantize:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    tflite_model = converter.convert()
+    with open(output_path, 'wb') as file:
+        file.write(tflite_model)
+    return len(tflite_model)
+
+
+class TFLiteTranslator(object):
+    """
+    使用TFLite模型进行批量翻译，句子的预处理、编码及解码与translator.translate_batch一致
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        """
+        @param model_path: TFLite模型路径
+        @param num_threads: 解释器使用的线程数，为None时由TFLite决定
+        """
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        # 转换时只保留了一个签名，其唯一的输入为source_ids；输出的名称不含签名中的键，
+        # 以shape区分：scores、lengths为(batch_size,)，target_ids为(batch_size, max_target_length)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = [detail['index'] for detail in self.interpreter.get_output_details()
+                             if len(detail['shape']) == 2][0]
+        self.input_shape = None
+
+    def translate_batch(self, sentences, tokenizer_source, tokenizer_target, batch_size=_config.BATCH_SIZE):
+        """
+        对句子列表进行批量翻译
+        @param sentences: 需要翻译的句子列表
+        @param tokenizer_source: 源语言字典
+        @param tokenizer_target: 目标语言字典
+        @param batch_size: 每个batch的句子数量
+        @return: 与输入顺序一致的翻译结果列表
+        """
+        _, end_token = translator._get_special_tokens(tokenizer_target)
+        sequences, lengths = translator._encode_sources(sentences, tokenizer_source)
+        order = numpy.argsort(lengths, kind='stable')
+
+        predicted_sentences = [''] * len(sentences)
+        for i in range(0, len(order), batch_size):
+            batch_order = order[i:i + batch_size]
+            max_length = max(int(lengths[batch_order].max()), 1)
+            target_ids = self._run(sequences[batch_order, :max_length])
+            for index, predict_idx in zip(batch_order, target_ids):
+                predicted_sentences[index] = translator._decode_index(tf.constant(predict_idx),
+                                                                      tokenizer_target, end_token)
+        return predicted_sentences
+
+    def _run(self, source_ids):
+        """
+        以解释器翻译一个batch的已编码源句子，输入shape改变时重新分配张量
+        @param source_ids: 已编码的源句子 (batch_size, seq_len)
+        @return: 解码得到的target_ids (batch_size, max_target_length)
+        """
+        source_ids = numpy.ascontiguousarray(source_ids, dtype=numpy.int32)
+        if source_ids.shape != self.input_shape:
+            self.interpreter.resize_tensor_input(self.input_index, source_ids.shape)
+            self.interpreter.allocate_tensors()
+            self.input_shape = source_ids.shape
+        self.interpreter.set_tensor(self.input_index, source_ids)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+
+def _evaluate(translate_fn, source_sentences, target_sentences):
+    """
+    翻译验证文本并计算语料级BLEU及翻译速度
+    @param translate_fn: 输入句子列表返回翻译结果列表的函数
+    @param source_sentences: 源句子列表
+    @param target_sentences: 参考句子列表
+    @return: BLEU，每秒翻译的句子数
+    """
+    # 预热，排除首次执行的开销
+    translate_fn(source_sentences[:1])
+    start = time.time()
+    candidates = translate_fn(source_sentences)
+    elapsed = time.time() - start
+    references = [[sentence.strip()] for sentence in target_sentences]
+    return _bleu.corpus_bleu(candidates, references, _config.target_lang), len(source_sentences) / elapsed
+
+
+def compare(models, tokenizer_source, tokenizer_target, output_dir, num_eval=_config.num_eval,
+            batch_size=_config.BATCH_SIZE, beam_size=_config.BEAM_SIZE, num_threads=None):
+    """
+    导出并量化模型，在验证文本上对比eager float32、TFLite float32及TFLite int8三者
+    @param models: 已恢复检查点的模型列表
+    @param tokenizer_source: 源语言字典
+    @param tokenizer_target: 目标语言字典
+    @param output_dir: SavedModel及TFLite模型的保存目录
+    @param num_eval: 用于评价的句子数量
+    @param batch_size: 翻译的batch大小
+    @param beam_size: beam大小
+    @param num_threads: TFLite解释器使用的线程数
+    @return: 各模型的结果字典列表
+    """
+    saved_model_dir = os.path.join(output_dir, 'saved_model')
+    _export.export(saved_model_dir, models, tokenizer_target, beam_size=beam_size)
+    signature = 'translate' if beam_size > 1 else 'translate_greedy'
+
+    source_sentences, target_sentences = load_dataset.load_sentences(_config.path_to_eval_file, num_eval)
+    results = []
+
+    print('正在评价eager float32模型...')
+    model_size = sum(variable.numpy().nbytes for model in models for variable in model.variables)
+    bleu, speed = _evaluate(lambda sentences: translator.translate_batch(
+        sentences, models, tokenizer_source, tokenizer_target,
+        batch_size=batch_size, beam_size=beam_size, verbose=False), source_sentences, target_sentences)
+    results.append({'name': 'eager float32', 'size': model_size, 'bleu': bleu, 'speed': speed})
+
+    for name, quantize in (('TFLite float32', False), ('TFLite int8', True)):
+        print('正在转换并评价%s模型...' % name)
+        model_path = os.path.join(output_dir, 'translator_%s.tflite' % ('int8' if quantize else 'float32'))
+        model_size = convert(saved_model_dir, model_path, quantize=quantize, signature=signature)
+        tflite_translator = TFLiteTranslator(model_path, num_threads=num_threads)
+        bleu, speed = _evaluate(lambda sentences: tflite_translator.translate_batch(
+            sentences, tokenizer_source, tokenizer_target, batch_size=batch_size),
+                                source_sentences, target_sentences)
+        results.append({'name': name, 'size': model_size, 'bleu': bleu, 'speed': speed})
+
+    baseline = results[1]
+    print('-' * 20)
+    print('%-16s%12s%10s%12s%10s' % ('模型', '大小(MB)', 'BLEU', '句/s', 'ΔBLEU'))
+    for result in results:
+        print('%-16s%12.2f%10.2f%12.2f%+10.2f' % (result['name'], result['size'] / 2 ** 20, result['bleu'],
+                                                  result['speed'], result['bleu'] - baseline['bleu']))
+    quantized = results[-1]
+    print('int8相对TFLite float32：大小压缩为%.1f%%，速度%.2f倍，BLEU变化%+.2f'
+          % (quantized['size'] / baseline['size'] * 100, quantized['speed'] / baseline['speed'],
+             quantized['bleu'] - baseline['bleu']))
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='对翻译模型进行训练后动态范围int8量化并与float32模型对比')
+    parser.add_argument('--output_dir', default='./data/quantized_model', type=str, required=False,
+                        help='SavedModel及TFLite模型的保存目录')
+    parser.add_argument('--num_eval', default=_config.num_eval, type=int, required=False, help='用于评价的句子数量')
+    parser.add_argument('--batch_size', default=_config.BATCH_SIZE, type=int, required=False, help='翻译的batch大小')
+    parser.add_argument('--beam_size', default=_config.BEAM_SIZE, type=int, required=False, help='beam大小')
+    parser.add_argument('--num_threads', default=None, type=int, required=False, help='TFLite解释器使用的线程数')
+    parser.add_argument('--ema', action='store_true', help='使用训练时维护的指数滑动平均权重')
+    options = parser.parse_args()
+
+    if nmt_model.check_point():  # 检测是否有检查点
+        models, tokenizer_source, tokenizer_target = nmt_model.load_translate_models(ema=options.ema)
+        compare(models, tokenizer_source, tokenizer_target, options.output_dir, num_eval=options.num_eval,
+                batch_size=options.batch_size, beam_size=options.beam_size, num_threads=options.num_threads)
+    else:
+        print('没有发现训练好的模型，请先训练模型.')
+
+
+if __name__ == '__main__':
+    main()
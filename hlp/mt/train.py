@@ -11,12 +11,15 @@ def main():
 
     # 创建模型及相关变量
     model = nmt_model.create_model(vocab_size_source, vocab_size_target)
+    # 维护权重指数滑动平均的影子模型
+    ema_model = nmt_model.create_model(vocab_size_source, vocab_size_target) if _config.ema_decay > 0 else None
 
     # 开始训练
     trainer.train(model,
                   validation_data=_config.validation_data,
                   validation_split=1-_config.train_size,
-                  validation_freq=_config.validation_freq)
+                  validation_freq=_config.validation_freq,
+                  ema_model=ema_model)
 
 
 if __name__ == '__main__':
@@ -1,3 +1,5 @@
+import os
+import shutil
 import time
 
 import tensorflow as tf
@@ -6,6 +8,7 @@ from hlp.mt.common import load_dataset
 from hlp.mt.model import transformer as _transformer
 from hlp.mt.config import get_config as _config
 from hlp.mt.model import nmt_model
+from hlp.mt.model import checkpoint
 from hlp.utils import optimizers as _optimizers
 from hlp.utils import train_history
 from hlp.mt import preprocess
@@ -32,53 +35,132 @@ def _train_step(inp, tar, transformer, optimizer, train_loss, train_accuracy):
     train_accuracy(tar_real, predictions)
 
 
-def _train_epoch(dataset, transformer, optimizer, train_loss, train_accuracy, batch_sum, sample_sum):
+def _build_ema_model(ema_model, transformer, inp, tar, initialize):
+    """
+    使用一个batch的数据build影子模型(及训练模型)
+    @param ema_model: 保存指数滑动平均权重的影子模型
+    @param transformer: 训练的模型
+    @param inp: 输入
+    @param tar: 目标
+    @param initialize: 是否以训练模型的当前权重初始化影子模型，从包含影子权重的检查点恢复时为False
+    """
+    tar_inp = tar[:, :-1]
+    enc_padding_mask, combined_mask, dec_padding_mask = _transformer.create_masks(inp, tar_inp)
+    for model in (transformer, ema_model):
+        model(inp, tar_inp, False, enc_padding_mask, combined_mask, dec_padding_mask)
+    if initialize:
+        for ema_variable, variable in zip(ema_model.variables, transformer.variables):
+            ema_variable.assign(variable)
+
+
+def _update_ema(ema_model, transformer, decay, step):
+    """
+    以指数滑动平均更新影子模型的权重
+    训练初期衰减率取min(decay, (1 + step) / (10 + step))，使影子权重尽快脱离初始值
+    """
+    decay = min(decay, (1.0 + step) / (10.0 + step))
+    for ema_variable, variable in zip(ema_model.variables, transformer.variables):
+        ema_variable.assign_sub((1 - decay) * (ema_variable - variable))
+
+
+def _train_epoch(dataset, transformer, optimizer, train_loss, train_accuracy, batch_sum, sample_sum,
+                 ema_model=None, ema_decay=0.0, data_state=None, save_fn=None):
     """
     对dataset进行训练并打印相关信息
+    给出ema_model时每步训练后更新其指数滑动平均权重
+    给出data_state时每步训练后更新当前epoch已训练的batch数，并调用save_fn按时间间隔保存训练状态
+    @return: batch数，实际token数(不含填充)，填充后的token总数
     """
-    for (batch, (inp, tar)) in enumerate(dataset):
+    num_batches = 0
+    num_tokens = 0
+    num_padded_tokens = 0
+    first_batch = int(data_state.batch.numpy()) if data_state is not None else 0
+    for (batch, (inp, tar)) in enumerate(dataset, start=first_batch):
         _train_step(inp, tar, transformer, optimizer, train_loss, train_accuracy)
+        if ema_model is not None:
+            _update_ema(ema_model, transformer, ema_decay, int(optimizer.iterations))
+        if data_state is not None:
+            data_state.batch.assign_add(1)
+            if save_fn is not None:
+                save_fn()
         batch_sum = batch_sum + len(inp)
+        num_batches += 1
+        num_tokens += int(tf.math.count_nonzero(inp)) + int(tf.math.count_nonzero(tar))
+        num_padded_tokens += int(tf.size(inp)) + int(tf.size(tar))
         print('\r{}/{} [batch {} loss {:.4f} accuracy {:.4f}]'.format(batch_sum,
                                                                       sample_sum,
                                                                       batch + 1,
                                                                       train_loss.result(),
                                                                       train_accuracy.result()), end='')
     print('\r{}/{} [==============================]'.format(sample_sum, sample_sum), end='')
+    return num_batches, num_tokens, num_padded_tokens
 
 
 def train(transformer, validation_data='False', validation_split=0.0,
-          cache=True, min_delta=0.00003, patience=10, validation_freq=1):
+          cache=True, min_delta=0.00003, patience=10, validation_freq=1,
+          ema_model=None, ema_decay=_config.ema_decay, checkpoint_path=_config.checkpoint_path,
+          epochs=_config.EPOCHS):
     """
     @param transformer: 训练要使用的transformer模型
     @param validation_data: 为‘True’则从指定文本加载训练集，
     @param validation_split: 验证集划分比例
-    @param cache: 若为True则将数据集都加载进内存进行训练，否则使用生成器分批加载
+    @param cache: 若为True则将数据集都加载进内存进行训练，否则以内存映射方式分批读取
     @param min_delta: 增大或减小的阈值，只有大于这个部分才算作improvement
     @param patience: 能够容忍多少个val_accuracy都没有improvement
     @param validation_freq: 验证频率
+    @param ema_model: 与transformer结构相同的影子模型，训练中维护transformer权重的指数滑动平均，
+    作为检查点中单独的ema_transformer保存，为None时不维护
+    @param ema_decay: 指数滑动平均的衰减率
+    @param checkpoint_path: 检查点保存目录
+    @param epochs: 训练轮次
     @return: history，包含训练过程中所有的指标
     """
-    # stop-early参数初始化
-    max_acc = 0
-    patience_num = 0
-
     # 模型变量初始化
     train_size = 1 - validation_split
-    learning_rate = _optimizers.CustomSchedule(_config.d_model)
+    learning_rate = _optimizers.CustomSchedule(transformer.encoder.d_model)
     optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.98, epsilon=1e-9)
     train_loss = tf.keras.metrics.Mean(name='train_loss')
     train_accuracy = tf.keras.metrics.SparseCategoricalAccuracy(name='train_accuracy')
     history = {'accuracy': [], 'loss': [], 'val_accuracy': [], 'val_loss': []}
+    # 训练集迭代状态及stop-early参数随检查点一起保存
+    data_state = load_dataset.DatasetState()
+    max_acc = tf.Variable(0.0, trainable=False)
+    patience_num = tf.Variable(0, trainable=False)
 
     # 检查点设置，如果检查点存在，则恢复最新的检查点。
-    checkpoint_path = _config.checkpoint_path
-    ckpt = tf.train.Checkpoint(transformer=transformer,
-                               optimizer=optimizer)
+    # 除按epoch保存的检查点外，训练状态按时间间隔及在每个epoch结束时另外保存至resume子目录(只保留最新的一个)，
+    # 中断后重新运行时优先从其恢复，从中断时的batch继续训练
+    trackables = {'transformer': transformer, 'optimizer': optimizer, 'data_state': data_state,
+                  'train_loss': train_loss, 'train_accuracy': train_accuracy,
+                  'max_acc': max_acc, 'patience_num': patience_num}
+    if ema_model is not None:
+        trackables['ema_transformer'] = ema_model
+    ckpt = tf.train.Checkpoint(**trackables)
     ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_path, max_to_keep=_config.max_checkpoints_num)
-    if nmt_model.check_point():
-        ckpt.restore(ckpt_manager.latest_checkpoint)
+    resume_path = os.path.join(checkpoint_path, 'resume')
+    resume_manager = tf.train.CheckpointManager(ckpt, resume_path, max_to_keep=1)
+    ema_restored = False
+    if nmt_model.check_point(checkpoint_path):
+        latest_checkpoint = resume_manager.latest_checkpoint or ckpt_manager.latest_checkpoint
+        ckpt.restore(latest_checkpoint)
         print('已恢复至最新检查点！')
+        if latest_checkpoint:
+            ema_restored = checkpoint.has_ema_weights(latest_checkpoint)
+    start_epoch = int(data_state.epoch.numpy())
+    if start_epoch > 0 or int(data_state.batch.numpy()) > 0:
+        print('从第%d个epoch的第%d个batch继续训练，已训练%d步'
+              % (start_epoch + 1, int(data_state.batch.numpy()) + 1, int(optimizer.iterations)))
+
+    save_interval = _config.checkpoint_save_minutes * 60
+    last_save_time = time.time()
+
+    def save_on_time():
+        """距上次保存训练状态超过设定的时间间隔时保存"""
+        nonlocal last_save_time
+        if 0 < save_interval <= time.time() - last_save_time:
+            save_path = resume_manager.save(checkpoint_number=optimizer.iterations)
+            last_save_time = time.time()
+            print('\n训练状态已保存至：{}'.format(save_path))
 
     # 训练相关参数初始化
     batch_sum_train = 0
@@ -89,41 +171,55 @@ def train(transformer, validation_data='False', validation_split=0.0,
         sample_sum_val_txt = _config.num_validate_sentences
     else:
         print("从训练数据中划分验证数据.")
-    sample_sum_train = int((_config.num_sentences * train_size) // _config.BATCH_SIZE * _config.BATCH_SIZE)
-    sample_sum_val = int((_config.num_sentences * (1 - train_size)) // _config.BATCH_SIZE * _config.BATCH_SIZE)
-    steps = _config.num_sentences // _config.BATCH_SIZE
+    if _config.max_batch_tokens > 0:  # 按token数划分batch时不丢弃句子
+        sample_sum_train = int(_config.num_sentences * train_size)
+        sample_sum_val = _config.num_sentences - sample_sum_train
+    else:
+        sample_sum_train = int((_config.num_sentences * train_size) // _config.BATCH_SIZE * _config.BATCH_SIZE)
+        sample_sum_val = int((_config.num_sentences * (1 - train_size)) // _config.BATCH_SIZE * _config.BATCH_SIZE)
 
     # 读取数据
     print("加载训练数据...")
     source_sequences_path_train = preprocess.get_encoded_sequences_path(_config.source_lang, postfix='_train')
     target_sequences_path_train = preprocess.get_encoded_sequences_path(_config.target_lang, postfix='_train')
     train_dataset, val_dataset = load_dataset.get_dataset(source_sequences_path_train, target_sequences_path_train,
-                                                          cache, train_size, steps)
+                                                          cache, train_size, state=data_state)
     if validation_data == 'True':  # 从文本中加载val_dataset
         print("加载验证数据...")
         source_sequences_path_val = preprocess.get_encoded_sequences_path(_config.source_lang, postfix='_val')
         target_sequences_path_val = preprocess.get_encoded_sequences_path(_config.target_lang, postfix='_val')
         val_dataset, _ = load_dataset.get_dataset(source_sequences_path_val, target_sequences_path_val,
-                                                  cache, train_size, steps)
+                                                  cache, train_size)
+    if ema_model is not None:
+        # 以只含一个token的输入build模型，不从训练集中取数据(从epoch末尾继续时当前epoch已没有剩余的batch)
+        inp, tar = tf.constant([[1]]), tf.constant([[1, 1]])
+        _build_ema_model(ema_model, transformer, inp, tar, initialize=not ema_restored)
+        print('已启用权重的指数滑动平均，衰减率:%g' % ema_decay)
+
     print("开始训练...")
-    for epoch in range(_config.EPOCHS):
-        print('Epoch {}/{}'.format(epoch + 1, _config.EPOCHS))
+    for epoch in range(start_epoch, epochs):
+        print('Epoch {}/{}'.format(epoch + 1, epochs))
         start = time.time()
 
-        train_loss.reset_states()
-        train_accuracy.reset_states()
+        if int(data_state.batch.numpy()) == 0:  # 从epoch中间继续时保留已训练部分的指标
+            train_loss.reset_states()
+            train_accuracy.reset_states()
         # 训练部分
-        _train_epoch(train_dataset, transformer, optimizer, train_loss, train_accuracy,
-                     batch_sum_train, sample_sum_train)
+        num_batches, num_tokens, num_padded_tokens = _train_epoch(train_dataset, transformer, optimizer, train_loss,
+                                                                  train_accuracy, batch_sum_train, sample_sum_train,
+                                                                  ema_model=ema_model, ema_decay=ema_decay,
+                                                                  data_state=data_state, save_fn=save_on_time)
 
         history['accuracy'].append(train_accuracy.result().numpy())
         history['loss'].append(train_loss.result().numpy())
         epoch_time = (time.time() - start)
-        step_time = epoch_time * _config.BATCH_SIZE / sample_sum_train
+        step_time = epoch_time / max(num_batches, 1)
+        tokens_per_second = num_tokens / epoch_time
+        padding_ratio = 1 - num_tokens / max(num_padded_tokens, 1)
 
         # 验证部分
         # 若到达所设置验证频率或最后一个epoch，并且validate_from_txt为False和train_size不同时满足时使用验证集验证
-        if ((epoch + 1) % validation_freq == 0 or (epoch + 1) == _config.EPOCHS) \
+        if ((epoch + 1) % validation_freq == 0 or (epoch + 1) == epochs) \
                 and (validation_data == 'True' or train_size != 1):
             temp_loss = train_loss.result()
             temp_acc = train_accuracy.result()
@@ -135,31 +231,42 @@ def train(transformer, validation_data='False', validation_split=0.0,
 
             history['val_accuracy'].append(train_accuracy.result().numpy())
             history['val_loss'].append(train_loss.result().numpy())
-            print(' - {:.0f}s - {:.0f}ms/step - loss: {:.4f} - accuracy {:.4f} - val_loss: {:.4f} - val_accuracy {:.4f}'
-                  .format(epoch_time, step_time * 1000, temp_loss, temp_acc, train_loss.result(),
-                          train_accuracy.result()))
+            print(' - {:.0f}s - {:.0f}ms/step - {:.0f}tokens/s - padding: {:.2%} - loss: {:.4f} - accuracy {:.4f}'
+                  ' - val_loss: {:.4f} - val_accuracy {:.4f}'
+                  .format(epoch_time, step_time * 1000, tokens_per_second, padding_ratio, temp_loss, temp_acc,
+                          train_loss.result(), train_accuracy.result()))
             # stop-early判断
-            if train_accuracy.result().numpy() >= (max_acc * (1 + min_delta)):
-                max_acc = train_accuracy.result().numpy()
-                patience_num = 0
+            if train_accuracy.result().numpy() >= (max_acc.numpy() * (1 + min_delta)):
+                max_acc.assign(train_accuracy.result())
+                patience_num.assign(0)
             else:
-                patience_num += 1
+                patience_num.assign_add(1)
         else:
-            print(' - {:.0f}s - {:.0f}ms/step - loss: {:.4f} - accuracy {:.4f}'
-                  .format(epoch_time, step_time * 1000, train_loss.result(), train_accuracy.result()))
-
-        if (epoch + 1) % _config.checkpoints_save_freq == 0:
-            ckpt_save_path = ckpt_manager.save()
-            print('检查点已保存至：{}'.format(ckpt_save_path))
+            print(' - {:.0f}s - {:.0f}ms/step - {:.0f}tokens/s - padding: {:.2%} - loss: {:.4f} - accuracy {:.4f}'
+                  .format(epoch_time, step_time * 1000, tokens_per_second, padding_ratio, train_loss.result(),
+                          train_accuracy.result()))
 
+        data_state.next_epoch()
         # 若连续patience个val_accuracy不达标，则停止训练
-        if patience_num == patience:
+        if int(patience_num.numpy()) == patience:
             print('检测到连续%d个验证集增长不达标，停止训练' % patience)
             break
+        if epoch + 1 == epochs:
+            break
+
+        if (epoch + 1) % _config.checkpoints_save_freq == 0:
+            ckpt_save_path = ckpt_manager.save()
+            print('检查点已保存至：{}'.format(ckpt_save_path))
+        resume_manager.save(checkpoint_number=optimizer.iterations)
+        last_save_time = time.time()
 
-    if (epoch + 1) % _config.checkpoints_save_freq != 0:
-        ckpt_save_path = ckpt_manager.save()
-        print('检查点已保存至：{}'.format(ckpt_save_path))
+    # 本次训练完毕，重置训练状态后保存最后的检查点，再次运行时开始新一轮训练
+    data_state.reset()
+    max_acc.assign(0.0)
+    patience_num.assign(0)
+    ckpt_save_path = ckpt_manager.save()
+    print('检查点已保存至：{}'.format(ckpt_save_path))
+    shutil.rmtree(resume_path, ignore_errors=True)
 
     train_history.show_and_save_history(history, _config.result_save_dir, validation_freq)
     print('训练完毕！')
@@ -1,11 +1,65 @@
+from argparse import ArgumentParser
+
+from hlp.mt.config import get_config as _config
 from hlp.mt.model import nmt_model
+from hlp.mt.common import shortlist as _shortlist
+from hlp.mt.common import translation_memory as _translation_memory
 from hlp.mt import translator
+from hlp.mt.lm import lm_rescore
 
 
 def main():
-    if nmt_model.check_point():  # 检测是否有检查点
+    parser = ArgumentParser(description='机器翻译，不指定输入文件时进入交互式翻译')
+    parser.add_argument('--input', default='', type=str, required=False, help='需要翻译的文件路径，每行一个句子')
+    parser.add_argument('--output', default='', type=str, required=False, help='翻译结果保存路径')
+    parser.add_argument('--batch_size', default=_config.BATCH_SIZE, type=int, required=False, help='批量翻译的batch大小')
+    parser.add_argument('--beam_size', default=_config.BEAM_SIZE, type=int, required=False, help='beam大小')
+    parser.add_argument('--lm_rescore', action='store_true', help='使用训练好的语言模型对beam search的n-best候选重排序')
+    parser.add_argument('--lm_fusion_weight', default=_config.lm_fusion_weight, type=float, required=False,
+                        help='beam search中与语言模型浅融合的权重，为0时不进行浅融合')
+    parser.add_argument('--ema', action='store_true', help='使用训练时维护的指数滑动平均权重')
+    parser.add_argument('--student', action='store_true', help='使用知识蒸馏(distill.py)得到的学生模型')
+    parser.add_argument('--pruned', action='store_true', help='使用结构化剪枝(prune.py)得到的模型')
+    parser.add_argument('--shortlist', action='store_true',
+                        help='使用build_shortlist.py构建的词汇翻译表，输出层只计算候选集的logits')
+    parser.add_argument('--translation_memory', action='store_true',
+                        help='使用翻译记忆，重复的句子直接返回保存的翻译，退出时保存至config.json中配置的路径')
+    parser.add_argument('--fuzzy', action='store_true', help='翻译记忆进行模糊匹配')
+    options = parser.parse_args()
+
+    # 检测是否有检查点
+    if nmt_model.check_point(nmt_model.get_checkpoint_dir(student=options.student, pruned=options.pruned)):
         # 读取保存的需要的配置
-        transformer, _, tokenizer_source, tokenizer_target = nmt_model.load_model()
+        models, tokenizer_source, tokenizer_target = nmt_model.load_translate_models(
+            ema=options.ema, student=options.student, pruned=options.pruned)
+        use_lm = options.lm_rescore or options.lm_fusion_weight > 0
+        lm_model, lm_tokenizer = lm_rescore.load_language_model() if use_lm else (None, None)
+        lm_weight = _config.lm_rescore_weight if options.lm_rescore else 0.0
+        lexical_table = _shortlist.load(_config.lexical_table_path) if options.shortlist else None
+        translation_memory = None
+        if options.translation_memory:
+            fingerprint = translator.model_fingerprint(
+                models, tokenizer_target, lexical_table=lexical_table, lm_model=lm_model,
+                beam_size=options.beam_size, lm_weight=lm_weight, lm_fusion_weight=options.lm_fusion_weight,
+                max_length_a=_config.max_length_a, max_length_b=_config.max_length_b,
+                length_penalty=_config.length_penalty)
+            translation_memory = _translation_memory.TranslationMemory(
+                fingerprint, path=_config.tm_path, max_entries=_config.tm_max_entries,
+                fuzzy=options.fuzzy or _config.tm_fuzzy_match == 'True',
+                fuzzy_threshold=_config.tm_fuzzy_threshold, ngram_size=_config.tm_ngram_size)
+            print('已加载翻译记忆：%d个条目' % len(translation_memory))
+
+        if options.input != '':
+            output_path = options.output if options.output != '' else options.input + '.' + _config.target_lang
+            translator.translate_file(options.input, output_path, models, tokenizer_source, tokenizer_target,
+                                      batch_size=options.batch_size, beam_size=options.beam_size,
+                                      lm_model=lm_model, lm_tokenizer=lm_tokenizer,
+                                      lm_weight=lm_weight, lm_fusion_weight=options.lm_fusion_weight,
+                                      lexical_table=lexical_table, translation_memory=translation_memory)
+            print('翻译结果已保存至：%s' % output_path)
+            if translation_memory is not None:
+                translation_memory.save()
+            return
 
         # translate
         while True:
@@ -13,9 +67,17 @@ def main():
             print('输入0可退出程序')
             sentence = input('请输入要翻译的句子 :')
             if sentence == '0':
+                if translation_memory is not None:
+                    translation_memory.save()
+                    print('翻译记忆已保存，命中率%.2f%%' % (translation_memory.stats()['hit_rate'] * 100))
                 break
             else:
-                print('翻译结果:', translator.translate(sentence, transformer, tokenizer_source, tokenizer_target))
+                print('翻译结果:', translator.translate(sentence, models, tokenizer_source, tokenizer_target,
+                                                    beam_size=options.beam_size,
+                                                    lm_model=lm_model, lm_tokenizer=lm_tokenizer,
+                                                    lm_weight=lm_weight, lm_fusion_weight=options.lm_fusion_weight,
+                                                    lexical_table=lexical_table,
+                                                    translation_memory=translation_memory))
     else:
         print('请先训练才可使用翻译功能...')
 
@@ -1,115 +1,488 @@
 """
 对输出的句子进行翻译
 """
+import hashlib
+import json
+import time
+import weakref
+from collections import OrderedDict
+
+import numpy
 import tensorflow as tf
-import copy
 
 from hlp.mt.config import get_config as _config
 from hlp.mt.model import transformer as _transformer
-from hlp.mt.model import checkpoint
 from hlp.mt.common import text_vectorize
-from hlp.utils import beamsearch
 from hlp.mt.common import text_split
+from hlp.mt.common import shortlist as _shortlist
 from hlp.mt import preprocess
+from hlp.mt.lm import lm_rescore
 
 
-def _checkpoint_ensembling(checkpoints_path, model, inputs, decoder_input):
+def _checkpoint_ensembling(models, caches, memories, decoder_input, dec_padding_mask, output_projections=None):
     """
-    使用路径中的检查点得到此步的predictions
-    @param checkpoints_path: 使用的检查点路径列表
-    @param model: 模型
-    @param inputs: 输入
+    使用常驻内存的多个检查点模型增量解码一步得到此步的predictions，在log概率上进行平均
+    @param models: 已恢复好检查点的模型列表
+    @param caches: 各模型的增量解码缓存列表
+    @param memories: 各模型的交叉注意力K/V列表
     @param decoder_input: 解码器输入
-    @param enc_padding_mask: 编码器遮挡
-    @param combined_mask: 遮挡
-    @param dec_padding_mask: 解码器遮挡
-    @return:使用多个检查点模型后的平均predictions
-    """
-    # 首先使用首个检查点模型得到结果
-    enc_padding_mask, combined_mask, dec_padding_mask = _transformer.create_masks(inputs, decoder_input)
-    checkpoint_path = checkpoints_path[0]
-    checkpoint.load_checkpoint(model, tf.keras.optimizers.Adam(), checkpoint_path=checkpoint_path)
-    predictions, _ = model(inputs, decoder_input, False, enc_padding_mask, combined_mask, dec_padding_mask)
-    # 从 seq_len 维度选择最后一个词
-    predictions = tf.squeeze(predictions[:, -1:, :], axis=1)  # (batch_size, vocab_size)
-    predictions_sum = copy.deepcopy(predictions)
-    if len(checkpoints_path) > 1:
-        for i in range(len(checkpoints_path)-1):  # 分别读取n个检查点模型并预测得到predictions进行累加
-            checkpoint_path = checkpoints_path[i+1]
-            checkpoint.load_checkpoint(model, tf.keras.optimizers.Adam(), checkpoint_path=checkpoint_path)
-            predictions, _ = model(inputs, decoder_input, False, enc_padding_mask, combined_mask, dec_padding_mask)
-            predictions = tf.squeeze(predictions[:, -1:, :], axis=1)  # (batch_size, vocab_size)
-            predictions_sum = tf.add(predictions_sum, predictions)
-    predictions_avg = tf.divide(predictions_sum, len(checkpoints_path))
-
-    return predictions_avg
-
-
-def _predict_index(checkpoints_path, inp_sentence, model, beam_search_container, input_tokenizer, target_tokenizer):
-    """对输入句子进行翻译并返回编码的句子列表"""
-    input_mode = preprocess.get_tokenizer_mode(_config.source_lang)
-    target_mode = preprocess.get_tokenizer_mode(_config.target_lang)
+    @param dec_padding_mask: 解码器中遮挡编码器输出的填充遮挡
+    @param output_projections: 各模型候选集的输出层权重列表，为None时计算全部词表
+    @return:多个检查点模型在log概率上平均后的结果 (batch_size, vocab_size)，更新后的缓存列表
+    """
+    step = decoder_input.shape[1] - 1
+    last_token = decoder_input[:, -1:]  # 只需输入最新的token，历史token的K/V已在缓存中
+    if output_projections is None:
+        output_projections = [None] * len(models)
+    log_probs_sum = 0
+    new_caches = []
+    for model, cache, memory, output_projection in zip(models, caches, memories, output_projections):
+        # (batch_size, vocab_size)
+        predictions, cache = model.decode_step(last_token, step, cache, memory, dec_padding_mask,
+                                               output_projection=output_projection)
+        log_probs_sum += tf.nn.log_softmax(predictions, axis=-1)
+        new_caches.append(cache)
+    log_probs_avg = log_probs_sum / len(models)
+
+    return log_probs_avg, new_caches
 
-    sentence = text_split.preprocess_sentences([inp_sentence], _config.source_lang, input_mode)
 
-    inp_sequence, _ = text_vectorize.encode_sentences(sentence, input_tokenizer,
-                                                      language=_config.source_lang, mode=input_mode)
-    inp_sequence = tf.squeeze(inp_sequence)
-    inp_sequence = tf.expand_dims(inp_sequence, 0)
+_special_tokens_cache = weakref.WeakKeyDictionary()
 
+
+def _get_special_tokens(target_tokenizer):
+    """获取目标语言的开始及结束token，每个字典只编码一次"""
+    if target_tokenizer in _special_tokens_cache:
+        return _special_tokens_cache[target_tokenizer]
+    target_mode = preprocess.get_tokenizer_mode(_config.target_lang)
     # start_token  shape:(1,)
     start_token = text_vectorize.get_start_token(_config.start_word, target_tokenizer, language=_config.target_lang)
     end_token, _ = text_vectorize.encode_sentences([_config.end_word], target_tokenizer,
                                                    language=_config.target_lang, mode=target_mode)
-    end_token = tf.squeeze(end_token)
-
-    decoder_input = tf.expand_dims(start_token, 0)  # shape --> (1,1) 即(batch_size,sentence_length)
-
-    beam_search_container.reset(inputs=inp_sequence, dec_input=decoder_input)
-    inputs, decoder_input = beam_search_container.get_search_inputs()
-    if len(checkpoints_path) == 1:  # 如果只使用一个检查点，则不使用checkpoint_ensembling
-        checkpoint_path = checkpoints_path[0]
-        checkpoint.load_checkpoint(model, tf.keras.optimizers.Adam(), checkpoint_path=checkpoint_path)
-    for i in range(_config.max_target_length):
-        if len(checkpoints_path) == 1:  # 如果只使用一个检查点，则不使用checkpoint_ensembling
-            enc_padding_mask, combined_mask, dec_padding_mask = _transformer.create_masks(inputs, decoder_input)
-            predictions, _ = model(inputs, decoder_input, False, enc_padding_mask, combined_mask, dec_padding_mask)
-            predictions = tf.squeeze(predictions[:, -1:, :], axis=1)  # (batch_size, vocab_size)
+    special_tokens = int(tf.squeeze(start_token[0])), int(numpy.squeeze(end_token))
+    _special_tokens_cache[target_tokenizer] = special_tokens
+    return special_tokens
+
+
+def _encode_sources(sentences, input_tokenizer):
+    """
+    对源句子批量进行预处理及编码
+    @param sentences: 源句子列表
+    @param input_tokenizer: 源语言字典
+    @return: 编码好的句子 (num_sentences, max_length)，各句子的实际长度
+    """
+    input_mode = preprocess.get_tokenizer_mode(_config.source_lang)
+    sentences = text_split.preprocess_sentences(sentences, _config.source_lang, input_mode)
+    sequences, _ = text_vectorize.encode_sentences(sentences, input_tokenizer,
+                                                   language=_config.source_lang, mode=input_mode)
+    sequences = numpy.asarray(sequences, dtype='int32')
+    lengths = numpy.count_nonzero(sequences, axis=1)
+    return sequences, lengths
+
+
+def _lm_vocab_mapping(tokenizer_target, lm_tokenizer):
+    """
+    建立目标语言字典到语言模型字典的下标映射，语言模型字典中不存在的词映射为其未登录词(或0)
+    @param tokenizer_target: 目标语言字典
+    @param lm_tokenizer: 语言模型字典
+    @return: 映射表 (target_vocab_size,)，第i项为目标语言第i个token在语言模型字典中的下标
+    """
+    if not hasattr(tokenizer_target, 'word_index') or not hasattr(lm_tokenizer, 'word_index'):
+        raise ValueError("浅融合仅支持按词或字切分的字典")
+    unknown_index = lm_tokenizer.word_index.get(lm_tokenizer.oov_token, 0)
+    mapping = numpy.zeros(len(tokenizer_target.word_index) + 1, dtype='int32')
+    for word, index in tokenizer_target.word_index.items():
+        mapping[index] = lm_tokenizer.word_index.get(word, unknown_index)
+    return tf.constant(mapping)
+
+
+def _length_penalty(lengths, alpha):
+    """GNMT长度惩罚((5 + length) / 6) ^ alpha，alpha为0时恒为1"""
+    return tf.pow((5.0 + tf.cast(lengths, tf.float32)) / 6.0, alpha)
+
+
+def _decode_budget(inp_sequences, max_length_a, max_length_b, max_target_length=_config.max_target_length):
+    """
+    各句子的最大解码长度：min(a * 源句子长度 + b, max_target_length)，源句子长度含开始及结束token
+    batch大小由tf.shape取得，导出的图(export.py)中同样可用
+    @return: (batch_size,)，a不大于0时均为max_target_length
+    """
+    if max_length_a <= 0:
+        return tf.fill(tf.shape(inp_sequences)[:1], max_target_length)
+    source_lengths = tf.cast(tf.math.count_nonzero(inp_sequences, axis=1), tf.float32)
+    budget = tf.cast(tf.math.ceil(max_length_a * source_lengths + max_length_b), tf.int32)
+    return tf.clip_by_value(budget, 1, max_target_length)
+
+
+def _predict_index(models, inp_sequences, start_token, end_token, beam_size, return_n_best=False,
+                   lm_model=None, lm_vocab_mapping=None, lm_fusion_weight=0.0, shortlist=None,
+                   max_length_a=_config.max_length_a, max_length_b=_config.max_length_b,
+                   length_penalty=_config.length_penalty, early_stop=True, stats=None):
+    """
+    对一个batch的已编码源句子进行beam search，返回每个句子得分最高的编码序列或全部beam_size个候选
+    batch中的每个句子固定保有beam_size个候选，所有候选在同一次模型调用中解码，
+    已结束的候选之后只以0分续接填充token
+    给出语言模型时进行浅融合，每步以翻译模型与加权的语言模型log概率之和扩展候选，
+    语言模型对每个候选保有各自的状态并随beam重排
+    每个句子最多解码a * 源句子长度 + b步；候选间按长度惩罚归一化后的得分比较，
+    early_stop时一旦句子已结束候选的最高得分不低于所有未结束候选可能达到的得分上界即停止该句子的搜索
+
+    @param models: 模型列表
+    @param inp_sequences: 已编码的源句子 (batch_size, inp_seq_len)
+    @param start_token: 开始token
+    @param end_token: 结束token
+    @param beam_size: beam大小
+    @param return_n_best: 是否返回全部候选
+    @param lm_model: 用于浅融合的语言模型，为None时不进行浅融合
+    @param lm_vocab_mapping: 目标语言字典到语言模型字典的下标映射
+    @param lm_fusion_weight: 浅融合时语言模型log概率的权重
+    @param shortlist: 目标语言token候选集(升序且第一个为填充token 0)，给出时输出层只计算候选集的logits，
+    softmax及beam search均在候选集上进行
+    @param max_length_a: 最大解码长度关于源句子长度的系数，不大于0时最大解码长度为max_target_length
+    @param max_length_b: 最大解码长度的常数项
+    @param length_penalty: 长度惩罚的alpha，为0时直接比较log概率之和
+    @param early_stop: 是否在没有未结束候选能超过已结束的最优候选时提前停止搜索
+    @param stats: 统计字典，给出时累加解码步数(steps)及句子数(sentences)
+    @return: return_n_best为False时返回每个句子得分最高的编码序列 (batch_size, seq_len)，
+    否则返回全部候选 (batch_size, beam_size, seq_len)及其长度惩罚后的得分 (batch_size, beam_size)
+    """
+    batch_size = inp_sequences.shape[0]
+    num_hypotheses = batch_size * beam_size
+
+    # 每个源句子只编码一次，候选与源句子的对应关系在解码过程中不变，因此memory只需选取一次
+    enc_padding_mask, _, dec_padding_mask = _transformer.create_masks(inp_sequences, inp_sequences[:, :1])
+    source_indices = tf.repeat(tf.range(batch_size), beam_size)
+    memories = []
+    for model in models:
+        memory = model.compute_memory(model.encode(inp_sequences, enc_padding_mask))
+        memory, hypotheses_mask = model.gather_memory(memory, dec_padding_mask, source_indices)
+        memories.append(memory)
+    caches = [model.init_decode_cache(num_hypotheses) for model in models]
+    output_projections = None
+    if shortlist is not None:
+        # 每个batch只取出一次候选集的输出层权重
+        output_projections = [model.output_projection(shortlist) for model in models]
+    if lm_model is not None:
+        lm_states = lm_model.initial_states(num_hypotheses)
+        if shortlist is not None:
+            lm_output_mapping = tf.gather(lm_vocab_mapping, shortlist)
         else:
-            predictions = _checkpoint_ensembling(checkpoints_path, model, inputs, decoder_input)
+            lm_output_mapping = lm_vocab_mapping
 
-        beam_search_container.expand(predictions=predictions, end_sign=end_token)
-        if beam_search_container.beam_size == 0:
-            break
-        inputs, decoder_input = beam_search_container.get_search_inputs()
-    beam_search_result = beam_search_container.get_result()
+    decoder_input = tf.fill([num_hypotheses, 1], start_token)
+    # 初始时每个句子只有第一个候选有效，避免beam_size个相同候选
+    scores = tf.tile(tf.constant([[0.0] + [-1e9] * (beam_size - 1)]), [batch_size, 1])  # (batch_size, beam_size)
+    finished = tf.zeros((batch_size, beam_size), dtype=tf.bool)  # 以结束token结束或已停止搜索的候选
+    ended = tf.zeros((batch_size, beam_size), dtype=tf.bool)  # 以结束token结束的候选
+    lengths = tf.zeros((batch_size, beam_size), dtype=tf.int32)  # 不含开始token及填充的候选长度
+    beam_offsets = tf.expand_dims(tf.range(batch_size) * beam_size, axis=1)
+    max_lengths = _decode_budget(inp_sequences, max_length_a, max_length_b)
+    # 未结束候选的得分只会降低，长度惩罚随长度增大，因此以最大解码长度的长度惩罚得到其得分上界
+    max_length_penalty = _length_penalty(max_lengths, length_penalty)[:, tf.newaxis]
+
+    num_steps = 0
+    for step in range(int(tf.reduce_max(max_lengths))):
+        num_steps += 1
+        # 只有一个模型时即不使用checkpoint_ensembling
+        log_probs, caches = _checkpoint_ensembling(models, caches, memories, decoder_input, hypotheses_mask,
+                                                   output_projections)
+        if lm_model is not None:
+            lm_log_probs, lm_states = lm_model.step(tf.gather(lm_vocab_mapping, decoder_input[:, -1]), lm_states)
+            log_probs += lm_fusion_weight * tf.gather(lm_log_probs, lm_output_mapping, axis=-1)
+        vocab_size = log_probs.shape[-1]
+        log_probs = tf.reshape(log_probs, (batch_size, beam_size, vocab_size))
 
-    return beam_search_result
+        # 已结束的候选只能以0分续接填充token
+        pad_only = tf.one_hot(0, vocab_size, on_value=0.0, off_value=-1e9)
+        log_probs = tf.where(finished[:, :, tf.newaxis], pad_only, log_probs)
 
+        total_scores = tf.reshape(scores[:, :, tf.newaxis] + log_probs, (batch_size, beam_size * vocab_size))
+        scores, top_indices = tf.math.top_k(total_scores, k=beam_size)
+        parent_indices = tf.reshape(top_indices // vocab_size + beam_offsets, [-1])
+        tokens = tf.cast(top_indices % vocab_size, tf.int32)
+        if shortlist is not None:
+            tokens = tf.gather(shortlist, tokens)  # 候选集中的下标转换为目标语言token
+
+        decoder_input = tf.concat([tf.gather(decoder_input, parent_indices), tf.reshape(tokens, (-1, 1))], axis=-1)
+        caches = [model.reorder_cache(cache, parent_indices) for model, cache in zip(models, caches)]
+        if lm_model is not None:
+            lm_states = lm_model.reorder_states(lm_states, parent_indices)
+        parent_finished = tf.reshape(tf.gather(tf.reshape(finished, [-1]), parent_indices), finished.shape)
+        lengths = tf.reshape(tf.gather(tf.reshape(lengths, [-1]), parent_indices), lengths.shape) \
+            + tf.cast(tf.logical_not(parent_finished), tf.int32)
+        ended = tf.logical_or(tf.reshape(tf.gather(tf.reshape(ended, [-1]), parent_indices), ended.shape),
+                              tf.equal(tokens, end_token))
+        finished = tf.logical_or(parent_finished, tf.equal(tokens, end_token))
+        # 达到最大解码长度的句子停止搜索
+        stopped = tf.greater_equal(step + 1, max_lengths)
+        if early_stop:
+            best_ended = tf.reduce_max(tf.where(ended, scores / _length_penalty(lengths, length_penalty), -numpy.inf),
+                                       axis=-1)
+            live_bound = tf.reduce_max(tf.where(finished, -numpy.inf, scores / max_length_penalty), axis=-1)
+            stopped = tf.logical_or(stopped, tf.greater_equal(best_ended, live_bound))
+        finished = tf.logical_or(finished, stopped[:, tf.newaxis])
+        if tf.reduce_all(finished):
+            break
 
-def translate(sentence, model, tokenizer_source, tokenizer_target, beam_size=_config.BEAM_SIZE):
-    """对句子(经过预处理未经过编码)进行翻译,未进行检查点的判断"""
-    beam_search_container = beamsearch.BeamSearch(
-        beam_size=beam_size,
-        max_length=_config.max_target_length,
-        worst_score=0)
+    if stats is not None:
+        stats['steps'] = stats.get('steps', 0) + num_steps
+        stats['sentences'] = stats.get('sentences', 0) + batch_size
 
-    # 采用checkpoint_ensembling,获取需要使用的检查点路径列表
-    checkpoints_path = checkpoint.get_checkpoints_path()
-    if _config.checkpoint_ensembling == "False":
-        checkpoints_path = checkpoints_path[-1:]
+    # 以长度惩罚后的得分选择候选，句子中有以结束token结束的候选时只在其中选择
+    scores = scores / _length_penalty(lengths, length_penalty)
+    scores = tf.where(tf.logical_or(ended, tf.logical_not(tf.reduce_any(ended, axis=-1, keepdims=True))),
+                      scores, -numpy.inf)
+    if return_n_best:
+        return tf.reshape(decoder_input, (batch_size, beam_size, -1)), scores
 
-    predict_idxes = _predict_index(checkpoints_path, sentence, model, beam_search_container, tokenizer_source, tokenizer_target)
+    best_indices = tf.reshape(tf.argmax(scores, axis=-1, output_type=tf.int32), (-1, 1)) + beam_offsets
+    return tf.gather(decoder_input, tf.reshape(best_indices, [-1]))
 
-    predicted_sentences = []
+
+def _decode_index(predict_idx, tokenizer_target, end_token):
+    """将编码序列截断至结束token并解码为句子"""
     target_mode = preprocess.get_tokenizer_mode(_config.target_lang)
-    # 从容器中抽取序列，生成最终结果
-    for i in range(len(predict_idxes)):
-        predict_idx = predict_idxes[i].numpy()
-        predict_idx = tf.squeeze(predict_idx)
-        predict_sentence = text_vectorize.decode_sentence(predict_idx, tokenizer_target,
-                                                          _config.target_lang, target_mode)
-        predict_sentence = predict_sentence.replace(_config.start_word, '') \
-            .replace(_config.end_word, '').strip()
-        predicted_sentences.append(predict_sentence)
+    predict_idx = predict_idx.numpy()
+    end_positions = numpy.where(predict_idx == end_token)[0]
+    if len(end_positions) > 0:
+        predict_idx = predict_idx[:end_positions[0] + 1]
+    predict_idx = tf.constant(predict_idx[predict_idx != 0])
+    predict_sentence = text_vectorize.decode_sentence(predict_idx, tokenizer_target,
+                                                      _config.target_lang, target_mode)
+    predict_sentence = predict_sentence.replace(_config.start_word, '') \
+        .replace(_config.end_word, '').strip()
+    return predict_sentence
+
+
+def _rerank(predict_idxes, scores, tokenizer_target, end_token, lm_model, lm_tokenizer, lm_weight):
+    """
+    使用语言模型对各句子的n-best候选重打分，翻译模型得分与语言模型得分加权求和后选出最优候选
+    @param predict_idxes: 全部候选的编码序列 (batch_size, beam_size, seq_len)
+    @param scores: 翻译模型得分 (batch_size, beam_size)
+    @param tokenizer_target: 目标语言字典
+    @param end_token: 结束token
+    @param lm_model: 语言模型
+    @param lm_tokenizer: 语言模型字典
+    @param lm_weight: 语言模型得分权重
+    @return: 每个句子的最优候选句子，最优候选的编码序列
+    """
+    nbest_lists = [[_decode_index(predict_idx, tokenizer_target, end_token) for predict_idx in nbest_idxes]
+                   for nbest_idxes in predict_idxes]
+    lm_scores = numpy.asarray(lm_rescore.nbest_rescore(nbest_lists, lm_model, lm_tokenizer))
+    best = numpy.argmax(scores.numpy() + lm_weight * lm_scores, axis=-1)
+    return [nbest[i] for nbest, i in zip(nbest_lists, best)], tf.gather(predict_idxes, best, batch_dims=1)
+
+
+def translate_batch(sentences, models, tokenizer_source, tokenizer_target,
+                    batch_size=_config.BATCH_SIZE, beam_size=_config.BEAM_SIZE, verbose=True,
+                    lm_model=None, lm_tokenizer=None, lm_weight=_config.lm_rescore_weight,
+                    lm_fusion_weight=_config.lm_fusion_weight, lexical_table=None, translation_memory=None,
+                    decode_options=None):
+    """对句子列表(未经过预处理及编码)进行批量翻译
+    统一进行预处理及编码后按源句子长度排序分batch以减少填充，整batch进行beam search，
+    给出语言模型时在beam search中进行浅融合及/或对n-best候选重排序，结果按原句子顺序返回，
+    给出翻译记忆时只翻译未命中的句子，并将其翻译结果加入翻译记忆
+
+    @param sentences: 需要翻译的句子列表
+    @param models: 由nmt_model.load_translate_models加载的模型列表，多于一个时采用checkpoint_ensembling
+    @param tokenizer_source: 源语言字典
+    @param tokenizer_target: 目标语言字典
+    @param batch_size: 每个batch的句子数量
+    @param beam_size: beam大小
+    @param verbose: 是否打印翻译速度
+    @param lm_model: 用于浅融合及重排序的语言模型，为None时均不进行
+    @param lm_tokenizer: 语言模型字典
+    @param lm_weight: 重排序时语言模型得分的权重，为0时不进行重排序
+    @param lm_fusion_weight: 浅融合时语言模型log概率的权重，为0时不进行浅融合
+    @param lexical_table: 由common.shortlist加载的词汇翻译表，给出时每个batch只在候选集上计算输出层
+    @param translation_memory: common.translation_memory.TranslationMemory，为None时不使用翻译记忆
+    @param decode_options: 传给_predict_index的其余解码参数，如max_length_a、max_length_b、length_penalty、
+    early_stop及stats，未给出的使用config.json中的设置
+    @return: 与输入顺序一致的翻译结果列表
+    """
+    if len(sentences) == 0:
+        # 空文件或空文档，无需编码及解码
+        return []
+
+    decode_settings = {'batch_size': batch_size, 'beam_size': beam_size, 'verbose': verbose,
+                       'lm_model': lm_model, 'lm_tokenizer': lm_tokenizer, 'lm_weight': lm_weight,
+                       'lm_fusion_weight': lm_fusion_weight, 'lexical_table': lexical_table,
+                       'decode_options': decode_options}
+    if translation_memory is not None:
+        return _translate_with_memory(sentences, models, tokenizer_source, tokenizer_target,
+                                      translation_memory, decode_settings)
+
+    start = time.time()
+    start_token, end_token = _get_special_tokens(tokenizer_target)
+    rerank = lm_model is not None and lm_weight > 0
+    decode_kwargs = dict(decode_options or {})
+    if lm_model is not None and lm_fusion_weight > 0:
+        decode_kwargs.update({'lm_model': lm_model, 'lm_fusion_weight': lm_fusion_weight,
+                              'lm_vocab_mapping': _lm_vocab_mapping(tokenizer_target, lm_tokenizer)})
+    sequences, lengths = _encode_sources(sentences, tokenizer_source)
+    order = numpy.argsort(lengths, kind='stable')
+
+    predicted_sentences = [''] * len(sentences)
+    num_target_tokens = 0
+    num_candidates = num_batches = 0
+    for i in range(0, len(order), batch_size):
+        batch_order = order[i:i + batch_size]
+        max_length = max(int(lengths[batch_order].max()), 1)
+        inp_sequences = tf.constant(sequences[batch_order, :max_length])
+        if lexical_table is not None:
+            decode_kwargs['shortlist'] = tf.constant(_shortlist.select(lexical_table, inp_sequences.numpy(),
+                                                                       (start_token, end_token)))
+            num_candidates += int(decode_kwargs['shortlist'].shape[0])
+            num_batches += 1
+
+        if rerank:
+            predict_idxes, scores = _predict_index(models, inp_sequences, start_token, end_token, beam_size,
+                                                   return_n_best=True, **decode_kwargs)
+            batch_sentences, predict_idxes = _rerank(predict_idxes, scores, tokenizer_target, end_token,
+                                                     lm_model, lm_tokenizer, lm_weight)
+        else:
+            predict_idxes = _predict_index(models, inp_sequences, start_token, end_token, beam_size,
+                                           **decode_kwargs)
+            batch_sentences = [_decode_index(predict_idx, tokenizer_target, end_token)
+                               for predict_idx in predict_idxes]
+        for index, predicted_sentence, predict_idx in zip(batch_order, batch_sentences, predict_idxes):
+            predicted_sentences[index] = predicted_sentence
+            num_target_tokens += int(tf.math.count_nonzero(predict_idx)) - 1
+
+    if verbose:
+        elapsed = time.time() - start
+        print('已翻译%d个句子，用时%.2fs，%.2f句/s，源语言%.2f tokens/s，目标语言%.2f tokens/s'
+              % (len(sentences), elapsed, len(sentences) / elapsed,
+                 lengths.sum() / elapsed, num_target_tokens / elapsed))
+        if num_batches > 0:
+            print('词表候选集平均大小：%.1f' % (num_candidates / num_batches))
     return predicted_sentences
+
+
+def _memory_keys(sentences):
+    """翻译记忆的键为预处理后的源句子，预处理后相同的句子模型的输入也相同"""
+    input_mode = preprocess.get_tokenizer_mode(_config.source_lang)
+    return text_split.preprocess_sentences(sentences, _config.source_lang, input_mode)
+
+
+def _translate_with_memory(sentences, models, tokenizer_source, tokenizer_target, translation_memory,
+                           decode_settings):
+    """
+    先在翻译记忆中查找，只对未命中的句子(相同的句子只翻译一次)进行批量翻译，并将结果加入翻译记忆
+    @param decode_settings: 传给translate_batch的其余解码参数
+    @return: 与输入顺序一致的翻译结果列表
+    """
+    keys = _memory_keys(sentences)
+    predicted_sentences = [translation_memory.lookup(key) for key in keys]
+    misses = OrderedDict()  # 未命中的键 -> 首个对应句子的下标
+    for index, (key, predicted_sentence) in enumerate(zip(keys, predicted_sentences)):
+        if predicted_sentence is None:
+            misses.setdefault(key, index)
+
+    if misses:
+        translations = translate_batch([sentences[index] for index in misses.values()], models,
+                                       tokenizer_source, tokenizer_target, **decode_settings)
+        translated = dict(zip(misses.keys(), translations))
+        for key, translation in translated.items():
+            translation_memory.add(key, translation)
+        predicted_sentences = [translated[key] if predicted_sentence is None else predicted_sentence
+                               for key, predicted_sentence in zip(keys, predicted_sentences)]
+
+    if decode_settings['verbose']:
+        stats = translation_memory.stats()
+        print('翻译记忆：本次%d个句子中翻译%d个，累计命中率%.2f%%(精确%d，模糊%d，未命中%d)，条目数%d'
+              % (len(sentences), len(misses), stats['hit_rate'] * 100, stats['exact_hits'],
+                 stats['fuzzy_hits'], stats['misses'], stats['entries']))
+    return predicted_sentences
+
+
+def model_fingerprint(models, tokenizer_target, lexical_table=None, lm_model=None, **decode_settings):
+    """
+    由模型权重、词汇翻译表、语言模型权重及解码设置计算翻译记忆使用的模型指纹，
+    更换检查点、词汇翻译表、语言模型或解码设置后原有的翻译记忆不再命中
+    @param models: 模型列表
+    @param tokenizer_target: 目标语言字典
+    @param lexical_table: 翻译时使用的词汇翻译表，为None时不使用词表候选集
+    @param lm_model: 翻译时用于浅融合及重排序的语言模型，为None时不使用
+    @param decode_settings: 影响翻译结果的其余解码设置，如beam_size，max_target_length总是计入
+    @return: 十六进制的指纹字符串
+    """
+    # 检查点的变量在模型首次调用时才恢复，先解码一步使所有变量创建好
+    start_token, end_token = _get_special_tokens(tokenizer_target)
+    _predict_index(models, tf.constant([[1]]), start_token, end_token, 1)
+    digest = hashlib.sha1()
+    for model in models:
+        for variable in model.variables:
+            digest.update(variable.numpy().tobytes())
+    if lexical_table is not None:
+        for key in sorted(lexical_table):
+            array = numpy.ascontiguousarray(lexical_table[key])
+            digest.update(('%s%s' % (key, array.shape)).encode('UTF-8'))
+            digest.update(array.tobytes())
+    if lm_model is not None:
+        lm_model.step(tf.constant([1]), lm_model.initial_states(1))
+        for variable in lm_model.variables:
+            digest.update(variable.numpy().tobytes())
+    decode_settings = dict(decode_settings, max_target_length=_config.max_target_length,
+                           lexical_table=lexical_table is not None, lm_model=lm_model is not None)
+    digest.update(json.dumps(decode_settings, sort_keys=True).encode('UTF-8'))
+    return digest.hexdigest()
+
+
+def translate(sentence, models, tokenizer_source, tokenizer_target, beam_size=_config.BEAM_SIZE,
+              lm_model=None, lm_tokenizer=None, lm_weight=_config.lm_rescore_weight,
+              lm_fusion_weight=_config.lm_fusion_weight, lexical_table=None, translation_memory=None):
+    """对句子(经过预处理未经过编码)进行翻译
+
+    @param sentence: 需要翻译的句子
+    @param models: 由nmt_model.load_translate_models加载的模型列表，多于一个时采用checkpoint_ensembling
+    @param tokenizer_source: 源语言字典
+    @param tokenizer_target: 目标语言字典
+    @param beam_size: beam大小
+    @param lm_model: 用于beam search浅融合及n-best候选重排序的语言模型，为None时均不进行
+    @param lm_tokenizer: 语言模型字典
+    @param lm_weight: 重排序时语言模型得分的权重，为0时不进行重排序
+    @param lm_fusion_weight: 浅融合时语言模型log概率的权重，为0时不进行浅融合
+    @param lexical_table: 词汇翻译表，给出时只在候选集上计算输出层
+    @param translation_memory: 翻译记忆，命中时直接返回保存的翻译
+    @return: 翻译结果列表
+    """
+    return translate_batch([sentence], models, tokenizer_source, tokenizer_target,
+                           batch_size=1, beam_size=beam_size, verbose=False,
+                           lm_model=lm_model, lm_tokenizer=lm_tokenizer, lm_weight=lm_weight,
+                           lm_fusion_weight=lm_fusion_weight, lexical_table=lexical_table,
+                           translation_memory=translation_memory)
+
+
+def translate_file(input_path, output_path, models, tokenizer_source, tokenizer_target,
+                   batch_size=_config.BATCH_SIZE, beam_size=_config.BEAM_SIZE, lm_model=None, lm_tokenizer=None,
+                   lm_weight=_config.lm_rescore_weight, lm_fusion_weight=_config.lm_fusion_weight,
+                   lexical_table=None, translation_memory=None):
+    """对文件进行翻译，输入文件每行一个源句子，翻译结果按相同顺序逐行写入输出文件
+
+    @param input_path: 输入文件路径
+    @param output_path: 输出文件路径
+    @param models: 模型列表
+    @param tokenizer_source: 源语言字典
+    @param tokenizer_target: 目标语言字典
+    @param batch_size: 每个batch的句子数量
+    @param beam_size: beam大小
+    @param lm_model: 用于浅融合及重排序的语言模型，为None时均不进行
+    @param lm_tokenizer: 语言模型字典
+    @param lm_weight: 重排序时语言模型得分的权重，为0时不进行重排序
+    @param lm_fusion_weight: 浅融合时语言模型log概率的权重，为0时不进行浅融合
+    @param lexical_table: 词汇翻译表，给出时只在候选集上计算输出层
+    @param translation_memory: 翻译记忆，为None时不使用
+    """
+    with open(input_path, encoding='UTF-8') as file:
+        sentences = [line.strip() for line in file]
+
+    predicted_sentences = translate_batch(sentences, models, tokenizer_source, tokenizer_target,
+                                          batch_size=batch_size, beam_size=beam_size,
+                                          lm_model=lm_model, lm_tokenizer=lm_tokenizer,
+                                          lm_weight=lm_weight, lm_fusion_weight=lm_fusion_weight,
+                                          lexical_table=lexical_table, translation_memory=translation_memory)
+
+    with open(output_path, 'w', encoding='UTF-8') as file:
+        for predicted_sentence in predicted_sentences:
+            file.write(predicted_sentence + '\n')
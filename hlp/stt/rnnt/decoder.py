@@ -0,0 +1,178 @@
+"""
+RNN-T流式解码
+音频特征按固定帧数分块送入，编码器在相邻的块间传递各层LSTM状态，只对新到达的帧计算；
+预测网络只在假设输出非空白token时前进一步，其输出及状态随假设缓存，输出空白时直接复用
+支持贪婪解码及逐帧进行的beam search，每块解码后即可取得当前的部分识别结果
+"""
+import numpy
+import tensorflow as tf
+
+
+class Hypothesis(object):
+    """
+    一个解码假设：已输出的token、对数概率得分，以及预测网络读入这些token后的输出及各层状态
+    """
+
+    def __init__(self, tokens, score, pred_output, pred_state):
+        self.tokens = tokens  # tuple，不含开始时输入预测网络的空白token
+        self.score = score
+        self.pred_output = pred_output  # (proj_size,)
+        self.pred_state = pred_state  # 各层[h, c]，每个为 (lstm_units,)
+
+
+class StreamingDecoder(object):
+    """
+    单条音频流的RNN-T流式解码器
+    用法：对每段新到达的特征帧调用accept取得部分结果，音频结束后调用finalize取得最终结果，reset后可解码下一条音频
+    """
+
+    def __init__(self, model, chunk_size, beam_size=1, blank=0, max_symbols_per_step=5):
+        """
+        @param model: RNNT模型
+        @param chunk_size: 编码器每次计算的输入帧数，需为编码器时间缩减倍数的整数倍
+        @param beam_size: beam大小，为1时贪婪解码
+        @param blank: 空白token的下标，解码开始时也作为预测网络的输入
+        @param max_symbols_per_step: 每个编码器输出帧上每个假设最多输出的非空白token数量
+        """
+        if chunk_size % model.encoder.time_reduction != 0:
+            raise ValueError("chunk_size(%d)需为编码器时间缩减倍数(%d)的整数倍"
+                             % (chunk_size, model.encoder.time_reduction))
+        self.model = model
+        self.chunk_size = chunk_size
+        self.beam_size = beam_size
+        self.blank = blank
+        self.max_symbols_per_step = max_symbols_per_step
+        self.reset()
+
+    def reset(self):
+        """清空缓存的帧、编码器状态及假设，开始解码新的音频"""
+        self._buffer = None
+        self._encoder_states = self.model.encoder.initial_states(1)
+        pred_outputs, pred_states = self.model.prediction_network.step(
+            tf.constant([self.blank]), self.model.prediction_network.initial_states(1))
+        self._hyps = [Hypothesis((), 0.0, pred_outputs[0], tf.nest.map_structure(lambda x: x[0], pred_states))]
+        self.num_frames = 0  # 已解码的编码器输出帧数
+        self.num_pred_steps = 0  # 预测网络计算的假设-步数
+
+    @property
+    def hypotheses(self):
+        """当前的全部假设，按得分降序排列"""
+        return sorted(self._hyps, key=lambda hyp: -hyp.score)
+
+    def partial(self):
+        """当前得分最高的假设输出的token"""
+        return list(self.hypotheses[0].tokens)
+
+    def accept(self, features):
+        """
+        送入新到达的特征帧，凑满chunk_size帧即编码并解码，不足一块的帧留待下次
+        @param features: 新到达的特征帧 (num_frames, feature_dim)
+        @return: 当前的部分识别结果(token列表)
+        """
+        features = numpy.asarray(features, dtype='float32')
+        self._buffer = features if self._buffer is None else numpy.concatenate([self._buffer, features])
+        while len(self._buffer) >= self.chunk_size:
+            self._decode_chunk(self._buffer[:self.chunk_size])
+            self._buffer = self._buffer[self.chunk_size:]
+        return self.partial()
+
+    def finalize(self):
+        """
+        音频结束，解码剩余不足一块的帧(由编码器的时间缩减层填充)
+        @return: 最终识别结果(token列表)
+        """
+        if self._buffer is not None and len(self._buffer) > 0:
+            self._decode_chunk(self._buffer)
+            self._buffer = self._buffer[:0]
+        return self.partial()
+
+    def _decode_chunk(self, frames):
+        encoder_outputs, self._encoder_states = self.model.encoder(frames[tf.newaxis], states=self._encoder_states,
+                                                                   return_states=True)
+        for encoder_output in tf.unstack(encoder_outputs[0]):
+            if self.beam_size == 1:
+                self._greedy_step(encoder_output)
+            else:
+                self._beam_step(encoder_output)
+            self.num_frames += 1
+
+    def _log_probs(self, encoder_output, hyps):
+        """各假设在当前帧上对下一个token的对数概率 (len(hyps), vocab_size)"""
+        # 与训练时的 [B, T, U, V] 一致，按 [N, 1, 1, proj_size] 计算联合网络
+        pred_outputs = tf.stack([hyp.pred_output for hyp in hyps])[:, tf.newaxis, tf.newaxis]
+        logits = self.model.joint(encoder_output[tf.newaxis, tf.newaxis, tf.newaxis], pred_outputs)[:, 0, 0]
+        return tf.nn.log_softmax(logits, axis=-1).numpy()
+
+    def _extend(self, parents, tokens, scores):
+        """
+        为各父假设追加一个非空白token，预测网络对全部父假设批量前进一步
+        @return: 新假设列表
+        """
+        states = tf.nest.map_structure(lambda *state: tf.stack(state), *[parent.pred_state for parent in parents])
+        pred_outputs, states = self.model.prediction_network.step(tf.constant(tokens, dtype=tf.int32), states)
+        self.num_pred_steps += len(parents)
+        return [Hypothesis(parent.tokens + (token,), score, pred_outputs[i],
+                           tf.nest.map_structure(lambda state: state[i], states))
+                for i, (parent, token, score) in enumerate(zip(parents, tokens, scores))]
+
+    def _greedy_step(self, encoder_output):
+        """在一帧上不断输出概率最大的token，直到其为空白或达到每帧的上限，达到上限时强制输出空白"""
+        hyp = self._hyps[0]
+        for num_symbols in range(self.max_symbols_per_step + 1):
+            log_probs = self._log_probs(encoder_output, [hyp])[0]
+            token = int(numpy.argmax(log_probs))
+            if token == self.blank or num_symbols == self.max_symbols_per_step:
+                hyp.score += float(log_probs[self.blank])
+                break
+            hyp = self._extend([hyp], [token], [hyp.score + float(log_probs[token])])[0]
+        self._hyps = [hyp]
+
+    def _beam_step(self, encoder_output):
+        """
+        beam search的一帧：假设输出空白时加上空白的对数概率并进入下一帧，输出非空白token时留在本帧继续扩展，
+        每帧最多扩展max_symbols_per_step个token，达到上限的假设强制输出空白；
+        进入下一帧的假设中token序列相同的合并概率，与仍在扩展的候选共用beam，每轮只保留得分最高的beam_size个
+        """
+        next_hyps = {}  # token序列 -> 输出空白进入下一帧的假设
+        hyps = self._hyps
+        for num_symbols in range(self.max_symbols_per_step + 1):
+            log_probs = self._log_probs(encoder_output, hyps)
+            extensions = []  # (得分, 父假设, 追加的token)
+            for hyp, hyp_log_probs in zip(hyps, log_probs):
+                score = hyp.score + float(hyp_log_probs[self.blank])
+                if hyp.tokens in next_hyps:
+                    next_hyp = next_hyps[hyp.tokens]
+                    next_hyp.score = float(numpy.logaddexp(next_hyp.score, score))
+                else:
+                    next_hyps[hyp.tokens] = Hypothesis(hyp.tokens, score, hyp.pred_output, hyp.pred_state)
+                if num_symbols == self.max_symbols_per_step:
+                    continue
+                tokens = [int(token) for token in numpy.argsort(-hyp_log_probs, kind='stable')
+                          if token != self.blank][:self.beam_size]
+                extensions += [(hyp.score + float(hyp_log_probs[token]), hyp, token) for token in tokens]
+
+            # 得分相同时进入下一帧的假设优先，beam_size为1时与贪婪解码一致
+            pool = [(next_hyp.score, 0, next_hyp.tokens) for next_hyp in next_hyps.values()]
+            pool += [(extension[0], 1, i) for i, extension in enumerate(extensions)]
+            best = sorted(pool, key=lambda item: (-item[0], item[1]))[:self.beam_size]
+            next_hyps = {key: next_hyps[key] for _, kind, key in best if kind == 0}
+            extensions = [extensions[key] for _, kind, key in best if kind == 1]
+            if not extensions:
+                break
+            hyps = self._extend([parent for _, parent, _ in extensions], [token for _, _, token in extensions],
+                                [score for score, _, _ in extensions])
+        self._hyps = list(next_hyps.values())
+
+
+def recognize_stream(model, features, chunk_size, beam_size=1, blank=0, max_symbols_per_step=5):
+    """
+    模拟音频分块到达：将一条音频的特征按chunk_size帧依次送入流式解码器，每块解码后产出当前的部分结果
+    @param model: RNNT模型
+    @param features: 一条音频的特征 (num_frames, feature_dim)
+    @return: 生成器，依次产出(部分或最终识别结果的token列表, 是否为最终结果)
+    """
+    decoder = StreamingDecoder(model, chunk_size, beam_size, blank, max_symbols_per_step)
+    for start in range(0, len(features) - chunk_size + 1, chunk_size):
+        yield decoder.accept(features[start:start + chunk_size]), False
+    decoder.accept(features[len(features) // chunk_size * chunk_size:])
+    yield decoder.finalize(), True
@@ -0,0 +1,74 @@
+import numpy
+import tensorflow as tf
+
+from hlp.stt.rnnt.model import RNNT
+from hlp.stt.rnnt.decoder import StreamingDecoder
+
+_VOCAB_SIZE = 12
+_CHUNK_SIZE = 8
+
+
+def _small_model(blank_bias=0.0):
+    """
+    随机初始化的小模型，编码器时间缩减2倍
+    @param blank_bias: 加到联合网络输出层空白token偏置上的值，为负时每帧倾向于输出多个非空白token
+    """
+    tf.random.set_seed(1)
+    model = RNNT(4, 32, 16, 0.1, 2, 24, _VOCAB_SIZE, 8, 1, 32, 16, 0.1)
+    model(tf.zeros([1, _CHUNK_SIZE, 10]), tf.constant([[0, 3, 4]]))
+    bias = model.ds2.layer.bias.numpy()
+    bias[0] += blank_bias
+    model.ds2.layer.bias.assign(bias)
+    return model
+
+
+def _features():
+    return numpy.random.RandomState(1).randn(37, 10).astype('float32')
+
+
+def _decode(model, beam_size, max_symbols_per_step=5):
+    """分块送入全部特征帧后取得最终结果，返回解码器以便检查假设"""
+    decoder = StreamingDecoder(model, _CHUNK_SIZE, beam_size=beam_size, max_symbols_per_step=max_symbols_per_step)
+    features = _features()
+    for start in range(0, len(features), 5):
+        decoder.accept(features[start:start + 5])
+    decoder.finalize()
+    return decoder
+
+
+def test_beam_size_one_matches_greedy():
+    """beam_size为1的beam search与贪婪解码的结果及得分一致，每帧输出多个token时也是如此"""
+    for blank_bias in (1.0, 1.5, -4.0):
+        model = _small_model(blank_bias)
+        for max_symbols_per_step in (1, 3):
+            greedy = _decode(model, 1, max_symbols_per_step).hypotheses[0]
+            beam_search = StreamingDecoder(model, _CHUNK_SIZE, beam_size=1, max_symbols_per_step=max_symbols_per_step)
+            # 直接逐帧调用_beam_step，绕过beam_size为1时的贪婪解码
+            encoder_outputs = model.encoder(_features()[tf.newaxis])
+            for encoder_output in tf.unstack(encoder_outputs[0]):
+                beam_search._beam_step(encoder_output)
+            best = beam_search.hypotheses[0]
+            assert best.tokens == greedy.tokens, (best.tokens, greedy.tokens)
+            assert abs(best.score - greedy.score) < 1e-4, (best.score, greedy.score)
+            print('空白偏置%.1f，每帧最多%d个token：%d个token，得分%.4f'
+                  % (blank_bias, max_symbols_per_step, len(greedy.tokens), greedy.score))
+
+
+def test_beam_multiple_symbols_per_frame():
+    """beam search每帧可输出多个token，假设缓存的预测网络输出与读入全部token后重新计算的一致"""
+    model = _small_model(-4.0)
+    greedy = _decode(model, 1)
+    decoder = _decode(model, 4)
+    assert len(greedy.partial()) > decoder.num_frames
+    assert decoder.num_frames < len(decoder.partial()) <= decoder.num_frames * decoder.max_symbols_per_step
+    assert len(decoder.hypotheses) <= 4
+    for hyp in decoder.hypotheses:
+        pred_outputs = model.prediction_network(tf.constant([[0] + list(hyp.tokens)]))
+        assert numpy.abs(pred_outputs[0, -1].numpy() - hyp.pred_output.numpy()).max() < 1e-5
+    print('%d帧：贪婪解码%d个token，beam search %d个token'
+          % (decoder.num_frames, len(greedy.partial()), len(decoder.partial())))
+
+
+if __name__ == '__main__':
+    test_beam_size_one_matches_greedy()
+    test_beam_multiple_symbols_per_frame()
@@ -11,12 +11,13 @@ class TimeReduction(tf.keras.layers.Layer):
         self.reduction_factor = reduction_factor
 
     def call(self, inputs):
-        batch_size = inputs.shape[0]
+        batch_size = tf.shape(inputs)[0]
 
-        max_time = inputs.shape[1]
+        max_time = tf.shape(inputs)[1]
         num_units = inputs.shape[-1]
 
-        paddings = [[0, 0], [0, tf.floormod(max_time, self.reduction_factor)], [0, 0]]
+        # 将时间维填充至reduction_factor的整数倍
+        paddings = [[0, 0], [0, tf.math.floormod(-max_time, self.reduction_factor)], [0, 0]]
         outputs = tf.pad(inputs, paddings)
 
         return tf.reshape(outputs, (batch_size, -1, num_units * self.reduction_factor))
@@ -33,23 +34,40 @@ class Encoder(tf.keras.layers.Layer):
                                                      epsilon=0.001)
 
         self.encoder_layers = encoder_layers
+        self.encoder_lstm_units = encoder_lstm_units
         self.lstm = []
         self.dense = []
         self.dropout = []
         self.ln = []
         for i in range(self.encoder_layers):
             self.lstm.append(tf.keras.layers.LSTM(
-                encoder_lstm_units, return_sequences=True))
+                encoder_lstm_units, return_sequences=True, return_state=True))
             self.dense.append(tf.keras.layers.TimeDistributed(tf.keras.layers.Dense(proj_size)))
             self.dropout.append(tf.keras.layers.Dropout(dropout))
             self.ln.append(tf.keras.layers.LayerNormalization())
         self.reduction_factor = reduction_factor
         self.tr = TimeReduction(self.reduction_factor)
 
-    def call(self, inputs):
+    @property
+    def time_reduction(self):
+        """输入帧数与输出帧数之比，reduction_factor不小于层数时不进行时间缩减"""
+        return self.reduction_factor if self.reduction_factor < self.encoder_layers else 1
+
+    def initial_states(self, batch_size):
+        """返回给定batch大小的各层LSTM全零初始状态"""
+        return [[tf.zeros([batch_size, self.encoder_lstm_units]), tf.zeros([batch_size, self.encoder_lstm_units])]
+                for _ in range(self.encoder_layers)]
+
+    def call(self, inputs, states=None, return_states=False):
+        """
+        states为None时从全零状态开始计算，否则从给定的各层LSTM状态开始计算
+        return_states为True时一并返回各层的最终状态，流式识别时将其作为下一段音频的初始状态
+        """
+        final_states = []
         x = self.bn(inputs)
         for i in range(self.encoder_layers):
-            x = self.lstm[i](x)
+            x, *state = self.lstm[i](x, initial_state=None if states is None else states[i])
+            final_states.append(state)
             x = self.dense[i](x)
             x = self.dropout[i](x)
             x = self.ln[i](x)
@@ -57,6 +75,8 @@ class Encoder(tf.keras.layers.Layer):
             if i == self.reduction_factor:
                 x = self.tr(x)
 
+        if return_states:
+            return x, final_states
         return x
 
 
@@ -70,28 +90,53 @@ class PredictionNetwork(tf.keras.layers.Layer):
         self.embedding_layer = tf.keras.layers.Embedding(vocab_size, embedding_size)
 
         self.prediction_network_layers = prediction_network_layers
+        self.prediction_network_lstm_units = prediction_network_lstm_units
         self.lstm = []
         self.dense = []
         self.dropout = []
         self.ln = []
         for i in range(self.prediction_network_layers):
             self.lstm.append(
-                tf.keras.layers.LSTM(prediction_network_lstm_units, return_sequences=True))
+                tf.keras.layers.LSTM(prediction_network_lstm_units, return_sequences=True, return_state=True))
             self.dense.append(
                 tf.keras.layers.TimeDistributed(tf.keras.layers.Dense(proj_size)))
             self.dropout.append(tf.keras.layers.Dropout(dropout))
             self.ln.append(tf.keras.layers.LayerNormalization())
 
-    def call(self, inputs):
+    def initial_states(self, batch_size):
+        """返回给定batch大小的各层LSTM全零初始状态"""
+        units = self.prediction_network_lstm_units
+        return [[tf.zeros([batch_size, units]), tf.zeros([batch_size, units])]
+                for _ in range(self.prediction_network_layers)]
+
+    def call(self, inputs, states=None, return_states=False):
+        """
+        states为None时从全零状态开始计算，否则从给定的各层LSTM状态开始计算
+        return_states为True时一并返回各层的最终状态
+        """
+        final_states = []
         x = self.embedding_layer(inputs)
         for i in range(self.prediction_network_layers):
-            x = self.lstm[i](x)
+            x, *state = self.lstm[i](x, initial_state=None if states is None else states[i])
+            final_states.append(state)
             x = self.dense[i](x)
             x = self.dropout[i](x)
             x = self.ln[i](x)
 
+        if return_states:
+            return x, final_states
         return x
 
+    def step(self, tokens, states):
+        """
+        增量计算一步，只输入每个假设最新输出的token，此前的token的信息已包含在状态中
+        @param tokens: 最新的token (batch_size,)
+        @param states: 各假设的状态
+        @return: 预测网络输出 (batch_size, proj_size)，更新后的状态
+        """
+        outputs, states = self(tokens[:, tf.newaxis], states=states, return_states=True)
+        return outputs[:, 0], states
+
 
 # RNNT，将Encoder和预测网络拼接
 class RNNT(tf.keras.Model):
@@ -114,6 +159,18 @@ class RNNT(tf.keras.Model):
             tf.keras.layers.Dense(joint_dense_units, activation="tanh"))
         self.ds2 = tf.keras.layers.TimeDistributed(tf.keras.layers.Dense(vocab_size))
 
+    def joint(self, encoder_outputs, pred_outputs):
+        """
+        联合网络，编码器输出与预测网络输出相加后经两层全连接得到logits
+        两者的shape可互相广播，如训练时的 [B, T, 1, V] 与 [B, 1, U, V]，解码时的 [1, 1, 1, V] 与 [N, 1, 1, V]
+        """
+        # TODO: 加合适吗？
+        joint_inputs = encoder_outputs + pred_outputs
+
+        # Dense作用于最后一维，直接调用TimeDistributed包装的层，使U及解码时的假设数量可变
+        joint_outputs = self.ds1.layer(joint_inputs)
+        return self.ds2.layer(joint_outputs)
+
     def call(self, encoder_inputs, pre_inputs):
         encoder_outputs = self.encoder(encoder_inputs)
         pred_outputs = self.prediction_network(pre_inputs)
@@ -125,13 +182,7 @@ class RNNT(tf.keras.Model):
         pred_outputs = tf.expand_dims(pred_outputs, axis=1)
 
         # 拼接(joint):[B, T, U, V]
-        # TODO: 加合适吗？
-        joint_inputs = encoder_outputs + pred_outputs
-
-        joint_outputs = self.ds1(joint_inputs)
-        outputs = self.ds2(joint_outputs)
-
-        return outputs
+        return self.joint(encoder_outputs, pred_outputs)
 
 
 if __name__ == "__main__":
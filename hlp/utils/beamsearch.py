@@ -41,27 +41,30 @@ class BeamSearch(object):
 
         :return: requests, dec_inputs
         """
-        # 生成多beam输入
-        inputs = self.inputs
-        for i in range(len(self) - 1):
-            inputs = tf.concat([inputs, self.inputs], 0)
-        requests = inputs
+        # 生成多beam输入，一次性沿batch维平铺
+        multiples = [len(self)] + [1] * (len(self.inputs.shape) - 1)
+        requests = tf.tile(self.inputs, multiples)
 
-        # 生成多beam的decoder的输入
-        temp = self.candidates[0][1]
-        for i in range(1, len(self)):
-            temp = tf.concat([temp, self.candidates[i][1]], axis=0)
-        self.dec_inputs = copy.deepcopy(temp)
+        return requests, self.get_candidates()
 
-        return requests, self.dec_inputs
+    def get_candidates(self):
+        """获得目前的所有候选解码序列，即多beam的decoder的输入
+
+        对编码器输出只计算一次的模型，只需此方法而无需平铺输入
+        :return: dec_inputs
+        """
+        self.dec_inputs = tf.concat([dec for _, dec in self.candidates], axis=0)
+
+        return self.dec_inputs
 
     def _reduce_end(self, end_sign):
         """
         当序列遇到了结束token，需要将该序列从容器中移除
         :return: 无返回值
         """
-        for idx, (s, dec) in enumerate(self.candidates):
-            temp = dec.numpy()
+        # 倒序遍历，避免删除元素后跳过下一个候选
+        for idx in reversed(range(len(self.candidates))):
+            temp = self.candidates[idx][1].numpy()
             if temp[0][-1] == end_sign:
                 self.result.append((self.candidates[idx][0], self.candidates[idx][1]))
                 self.result_plus.append(self.candidates_plus[idx])
@@ -121,18 +121,25 @@ def scaled_dot_product_attention(q, k, v, mask=None):
 
 # 多头注意力层
 class MultiHeadAttention(tf.keras.layers.Layer):
-    def __init__(self, d_model, num_heads):
+    def __init__(self, d_model, num_heads, depth=None):
+        """
+        depth为每个头的维度，为None时为d_model // num_heads；
+        给出时各头拼接后的维度num_heads * depth可小于d_model，用于剪枝掉部分头后的模型
+        """
         super(MultiHeadAttention, self).__init__()
         self.num_heads = num_heads
         self.d_model = d_model
 
-        assert d_model % self.num_heads == 0
+        if depth is None:
+            assert d_model % self.num_heads == 0
+            depth = d_model // self.num_heads
 
-        self.depth = d_model // self.num_heads
+        self.depth = depth
+        self.attention_dim = num_heads * depth  # 各头拼接后的维度
 
-        self.wq = tf.keras.layers.Dense(d_model)
-        self.wk = tf.keras.layers.Dense(d_model)
-        self.wv = tf.keras.layers.Dense(d_model)
+        self.wq = tf.keras.layers.Dense(self.attention_dim)
+        self.wk = tf.keras.layers.Dense(self.attention_dim)
+        self.wv = tf.keras.layers.Dense(self.attention_dim)
 
         self.dense = tf.keras.layers.Dense(d_model)
 
@@ -163,7 +170,7 @@ class MultiHeadAttention(tf.keras.layers.Layer):
                                         perm=[0, 2, 1, 3])  # (batch_size, seq_len_q, num_heads, depth)
 
         concat_attention = tf.reshape(scaled_attention,
-                                      (batch_size, -1, self.d_model))  # (batch_size, seq_len_q, d_model)
+                                      (batch_size, -1, self.attention_dim))  # (batch_size, seq_len_q, attention_dim)
 
         output = self.dense(concat_attention)  # (batch_size, seq_len_q, d_model)
 